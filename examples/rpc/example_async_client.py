@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+#
+# submit jobs to a larch server started with worker threads, as with
+#    larch -r -w 2
+#
+import xmlrpclib
+import time
+from larch.utils.jsonutils import decode4js
+
+s = xmlrpclib.ServerProxy('http://127.0.0.1:4966')
+
+# a separate session has its own interpreter, so this long job
+# does not block jobs in the main session
+sess = s.new_session()
+slow = s.submit('''
+x = linspace(0, 1, 1000001)
+for i in range(20):
+    y = sin(x*i)
+endfor
+''', sess)
+
+fast = s.submit('g = group(x=linspace(0, 10, 11))\ng.z = cos(g.x)')
+print 'fast job: ', s.job_result(fast, 10)
+
+while s.job_status(slow)['status'] in ('queued', 'running'):
+    print 'waiting for slow job'
+    time.sleep(0.5)
+print 'slow job: ', s.job_result(slow)
+
+# numpy arrays sent as base64-encoded buffers
+gz = decode4js(s.get_data('g.z', True))
+print 'g.z = ', gz, gz.dtype
+
+s.close_session(sess)
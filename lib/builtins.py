@@ -6,6 +6,8 @@ import imp
 import sys
 import time
 import re
+import json
+import tempfile
 
 from .helper import Helper
 from . import inputText
@@ -13,9 +15,12 @@ from . import site_config
 from . import fitting
 from . import larchlib
 from .symboltable import isgroup
+from .version import __version__
 
 PLUGINSTXT = 'plugins.txt'
 PLUGINSREQ = 'requirements.txt'
+PLUGINMANIFEST = 'plugin_manifest.json'
+MISSINGMATCH = re.compile(r"No module named '?([\w\.]+)'?").match
 REQMATCH = re.compile(r"(.*)\s*(<=?|>=?|==|!=)\s*(.*)", re.IGNORECASE).match
 
 helper = Helper()
@@ -132,22 +137,10 @@ def _group(_larch=None, **kws):
         setattr(group, key, val)
     return group
 
-def _eval(text=None, filename=None, _larch=None,
-          new_module=None, interactive=False,
-          printall=False):
-    """evaluate a string of larch text
-    """
-    if _larch is None:
-        raise Warning("cannot eval string. larch broken?")
-
-    if text is None:
-        return None
-
-    symtable = _larch.symtable
-    lineno = 0
-    output = None
-    fname = filename
-
+def _translate(text, filename=None, _larch=None, interactive=False):
+    """translate larch text to a list of (block, filename, lineno)
+    for the blocks of python code to be run, recording any errors
+    for incomplete input."""
     inptext = inputText.InputText(interactive=interactive, _larch=_larch)
     is_complete = inptext.put(text, filename=filename)
     # print 'eval complete? ', is_complete, inptext.keys
@@ -165,6 +158,31 @@ def _eval(text=None, filename=None, _larch=None,
         _larch.raise_exception(None, expr="run('%s')" % filename,
                                fname=filename, lineno=inptext.lineno,
                                exc=IOError, msg=msg % inptext.keys[0])
+    blocks = []
+    while len(inptext) > 0:
+        blocks.append(inptext.get())
+    return blocks
+
+def _eval(text=None, filename=None, _larch=None,
+          new_module=None, interactive=False,
+          printall=False, blocks=None):
+    """evaluate a string of larch text, or a list of already
+    translated blocks, as from _translate()
+    """
+    if _larch is None:
+        raise Warning("cannot eval string. larch broken?")
+
+    if text is None and blocks is None:
+        return None
+
+    symtable = _larch.symtable
+    lineno = 0
+    output = None
+    fname = filename
+
+    if blocks is None:
+        blocks = _translate(text, filename=filename, _larch=_larch,
+                            interactive=interactive)
 
     if new_module is not None:
         # save current module group
@@ -175,13 +193,11 @@ def _eval(text=None, filename=None, _larch=None,
         symtable.set_frame((thismod, thismod))
 
     output = []
-    # print 'eval %i lines of text ' % len(inptext)
+    # print 'eval %i lines of text ' % len(blocks)
     if len(_larch.error) > 0:
-        inptext.clear()
         return output
 
-    while len(inptext) > 0:
-        block, fname, lineno = inptext.get()
+    for block, fname, lineno in blocks:
         b = block.strip()
         if len(b) <= 0:
             continue
@@ -198,9 +214,7 @@ def _eval(text=None, filename=None, _larch=None,
         if len(_larch.error) > 0:
             break
         #
-    if len(_larch.error) > 0:
-        inptext.clear()
-    elif printall and ret is not None:
+    if len(_larch.error) == 0 and printall and ret is not None:
         output.append("%s" % ret)
 
     # for a "newly created module" (as on import),
@@ -222,20 +236,38 @@ def _run(filename=None, new_module=None, _larch=None):
         raise Warning("cannot run file '%s' -- larch broken?" % filename)
 
     text = None
+    blocks = None
+    cache = getattr(_larch, 'script_cache', None)
+    cachekey = None
     if isinstance(filename, file):
         text = filename.read()
         filename = filename.name
     elif os.path.exists(filename) and os.path.isfile(filename):
-        try:
-            text = open(filename).read()
-        except IOError:
-            _larch.writer.write("cannot read file '%s'\n" % filename)
-            return
+        # translated scripts are cached by path and modification time,
+        # and by the commands that may be used without parentheses
+        if cache is not None:
+            stat = os.stat(filename)
+            commands = _larch.symtable._sys.valid_commands
+            cachekey = (filename, os.path.abspath(filename), stat.st_mtime,
+                        stat.st_size, tuple(commands))
+            blocks = cache.get(cachekey)
+        if blocks is None:
+            try:
+                text = open(filename).read()
+            except IOError:
+                _larch.writer.write("cannot read file '%s'\n" % filename)
+                return
     else:
         _larch.writer.write("file not found '%s'\n" % filename)
         return
 
-    return  _eval(text=text, filename=filename, _larch=_larch,
+    if blocks is None:
+        nerrors = len(_larch.error)
+        blocks = _translate(text, filename=filename, _larch=_larch)
+        if cachekey is not None and len(_larch.error) == nerrors:
+            cache.put(cachekey, blocks)
+
+    return  _eval(blocks=blocks, filename=filename, _larch=_larch,
                   new_module=new_module, interactive=False, printall=False)
 
 def _reload(mod, _larch=None, **kws):
@@ -278,6 +310,112 @@ def _help(*args, **kws):
     else:
         return helper.getbuffer()
 
+class PluginManifest(object):
+    """persistent cache of the symbols exported by each plugin file,
+    keyed by file path and checked against its modification time, so
+    that plugins can be added as stubs without being imported.
+    """
+    def __init__(self, fname=None):
+        if fname is None:
+            fname = os.path.join(site_config.larchdir, PLUGINMANIFEST)
+        self.fname = fname
+        self.entries = {}
+        self.changed = False
+        try:
+            with open(fname, 'r') as fh:
+                data = json.load(fh)
+            if data.get('version', None) == __version__:
+                self.entries = data.get('plugins', {})
+        except (IOError, OSError, ValueError):
+            pass
+
+    def _mtime(self, path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def get(self, path):
+        "return entry for plugin file, or None if missing or stale"
+        entry = self.entries.get(path, None)
+        if entry is not None and entry['mtime'] != self._mtime(path):
+            entry = None
+        return entry
+
+    def get_missing(self, path):
+        """return saved error message for a plugin file that failed to
+        import a missing module, or None if that module is now found"""
+        entry = self.get(path)
+        if entry is None or entry.get('missing', None) is None:
+            return None
+        try:
+            fh, mpath, desc = imp.find_module(entry['missing'])
+            if fh is not None:
+                fh.close()
+            return None
+        except ImportError:
+            return entry['message']
+
+    def set_missing(self, path, exc, message):
+        "record a plugin file that failed to import a missing module"
+        match = MISSINGMATCH(str(exc))
+        if match is None:
+            return
+        entry = {'mtime': self._mtime(path), 'lazy': False,
+                 'missing': match.group(1).split('.')[0],
+                 'message': message}
+        if self.entries.get(path, None) != entry:
+            self.entries[path] = entry
+            self.changed = True
+
+    def set(self, path, info):
+        "record group, symbols, and laziness for a plugin file"
+        if info is None:
+            return
+        entry = {'mtime': self._mtime(path), 'group': info['group'],
+                 'symbols': info['symbols'], 'lazy': info['lazy']}
+        if self.entries.get(path, None) != entry:
+            self.entries[path] = entry
+            self.changed = True
+
+    def save(self):
+        """write manifest file, if changed.  The file is written to a
+        temporary file in the same folder and renamed, so that other
+        larch sessions never read a partly written manifest."""
+        if not self.changed:
+            return
+        tmpname = None
+        try:
+            fd, tmpname = tempfile.mkstemp(prefix='.plugins_',
+                                           dir=os.path.dirname(self.fname))
+            with os.fdopen(fd, 'w') as fh:
+                json.dump({'version': __version__,
+                           'plugins': self.entries}, fh)
+            if os.name == 'nt' and os.path.exists(self.fname):
+                os.unlink(self.fname)
+            os.rename(tmpname, self.fname)
+            tmpname = None
+            self.changed = False
+        except (IOError, OSError):
+            pass
+        finally:
+            if tmpname is not None:
+                try:
+                    os.unlink(tmpname)
+                except OSError:
+                    pass
+
+_plugin_manifest = None
+
+def get_plugin_manifest():
+    "return shared plugin manifest, or None if lazy loading is disabled"
+    global _plugin_manifest
+    if not site_config.lazy_plugins:
+        return None
+    if _plugin_manifest is None:
+        _plugin_manifest = PluginManifest()
+    return _plugin_manifest
+
 def _addplugin(plugin, _larch=None, **kws):
     """add plugin components from plugin directory"""
     if _larch is None:
@@ -401,9 +539,23 @@ def _addplugin(plugin, _larch=None, **kws):
                 retval = all(retvals)
         else:
             fh, modpath, desc = mod
+            entry, missing = None, None
+            if manifest is not None:
+                entry = manifest.get(modpath)
+                missing = manifest.get_missing(modpath)
             try:
-                out = imp.load_module(plugin, fh, modpath, desc)
-                _larch.symtable.add_plugin(out, on_error, **kws)
+                if missing is not None:
+                    write(missing)
+                    retval = False
+                elif entry is not None and entry['lazy']:
+                    _larch.symtable.add_plugin_stubs(
+                        plugin, os.path.dirname(modpath), entry['group'],
+                        entry['symbols'], on_error, **kws)
+                else:
+                    out = imp.load_module(plugin, fh, modpath, desc)
+                    info = _larch.symtable.add_plugin(out, on_error, **kws)
+                    if manifest is not None:
+                        manifest.set(modpath, info)
             except:
                 err, exc, tback = sys.exc_info()
                 lineno = getattr(exc, 'lineno', 0)
@@ -411,9 +563,12 @@ def _addplugin(plugin, _larch=None, **kws):
                 etext  = getattr(exc, 'text', '')
                 emsg   = getattr(exc, 'message', '')
                 # write(traceback.print_tb(tback))
-                write("""Python Error in plugin '%s', line %d
+                msg = """Python Error in plugin '%s', line %d
   %s %s^
-%s: %s\n""" % (modpath, lineno, etext, ' '*offset, err.__name__, emsg))
+%s: %s\n""" % (modpath, lineno, etext, ' '*offset, err.__name__, emsg)
+                write(msg)
+                if manifest is not None and issubclass(err, ImportError):
+                    manifest.set_missing(modpath, exc, msg)
                 retval = False
 
         if _larch.error:
@@ -433,7 +588,11 @@ def _addplugin(plugin, _larch=None, **kws):
             fh.close()
         return retval
 
-    return _plugin_file(plugin)
+    manifest = get_plugin_manifest()
+    retval = _plugin_file(plugin)
+    if manifest is not None:
+        manifest.save()
+    return retval
 
 def _dir(obj=None, _larch=None, **kws):
     "return directory of an object -- thin wrapper about python builtin"
@@ -478,6 +637,27 @@ def _exists(sym, _larch=None):
     "return True if a named symbol exists and can be found, False otherwise"
     return which(sym, _larch=_larch, **kws) is not None
 
+def _lookup_stats(reset=False, _larch=None):
+    """return statistics for the symbol lookup cache: a dict of
+    hits, misses, invalidations, size, and hit_rate (in percent)
+
+    with reset=True, the counters are set back to 0.
+    """
+    if _larch is None:
+        raise Warning("cannot run lookup_stats() -- larch broken?")
+    return _larch.symtable.lookup_stats(reset=reset)
+
+def _parse_cache_stats(reset=False, _larch=None):
+    """return statistics for the caches of parsed statements ('ast')
+    and of translated script files ('scripts'), each a dict of
+    hits, misses, size, maxsize, and hit_rate (in percent)
+
+    with reset=True, the hit and miss counts are set back to 0.
+    """
+    if _larch is None:
+        raise Warning("cannot run parse_cache_stats() -- larch broken?")
+    return _larch.parse_cache_stats(reset=reset)
+
 def _isgroup(obj, *args, **kws):
     """return whether argument is a group or the name of a group
 
@@ -535,6 +715,8 @@ local_funcs = {'_builtin': {'group':_group,
                             'dir': _dir,
                             'which': _which,
                             'exists': _exists,
+                            'lookup_stats': _lookup_stats,
+                            'parse_cache_stats': _parse_cache_stats,
                             'isgroup': _isgroup,
                             'subgroups': _subgroups,
                             'group_items': _groupitems,
@@ -0,0 +1,499 @@
+#!/usr/bin/env python
+"""
+Compile Larch procedures and loops to Python code objects
+
+The Larch AST of a Procedure body or of a script-level for/while loop
+is translated to Python source in which every name lookup and
+assignment still goes through the Larch symbol table, every operator
+through the interpreter OPERATORS (so that Parameters behave as they
+do in the tree-walking interpreter), and every function call through
+the same ufunc/Parameter handling as Interpreter.on_call.  The source
+is compiled once and the code object cached on the Procedure or loop
+node, so that repeated calls skip the per-node dispatch of
+Interpreter.run.
+
+Anything that cannot be translated (try/except, import, def, del,
+raise, assert, chained comparisons, ...) makes the whole block fall
+back to the tree-walking interpreter.
+
+Compilation is off by default, and is turned on with
+    _sys.config.compile_code = True
+or by setting the environmental variable LARCHCOMPILE=1.
+"""
+from __future__ import print_function
+import sys
+import ast
+import types
+import itertools
+import numpy
+
+from .fitting import isParameter
+from .symboltable import isgroup
+
+FNAME_FORMAT = '<larch-compiled %i: %s>'
+
+_unit_counter = itertools.count(1)
+
+class CompileError(Exception):
+    """Larch syntax that cannot be compiled"""
+    pass
+
+class LarchStop(Exception):
+    """stop compiled code, as Larch has already recorded an error"""
+    pass
+
+def _has_call(node):
+    "whether an AST node contains a function call"
+    for child in ast.walk(node):
+        if isinstance(child, ast.Call):
+            return True
+    return False
+
+def _number(val):
+    "python source for a number"
+    out = repr(val)
+    if 'inf' in out or 'nan' in out:
+        out = "%s('%s')" % (val.__class__.__name__, out.strip('()'))
+    elif out.startswith('-'):
+        out = '(%s)' % out
+    return out
+
+class Translator(object):
+    """translate Larch AST for a block of statements to Python source
+
+    The output is a list of (indent, text, node) with node being
+    the Larch statement each line came from.
+    """
+    def __init__(self, unsafe_attrs=(), procedure=False):
+        self.unsafe_attrs = unsafe_attrs
+        self.procedure = procedure
+        self.lines = []
+        self.ntemp = 0
+        self.node = None
+
+    def temp(self):
+        "name of a new temporary variable"
+        self.ntemp += 1
+        return '_t%i' % self.ntemp
+
+    def emit(self, indent, text):
+        self.lines.append((indent, text, self.node))
+
+    def block(self, nodes, indent):
+        "translate a list of statements"
+        if len(nodes) == 0:
+            self.emit(indent, 'pass')
+        for node in nodes:
+            self.stmt(node, indent)
+
+    # statements
+    def stmt(self, node, indent):
+        self.node = node
+        meth = getattr(self, 's_%s' % node.__class__.__name__.lower(), None)
+        if meth is None:
+            raise CompileError("'%s' not compiled" % node.__class__.__name__)
+        meth(node, indent)
+        self.node = node
+        if (not isinstance(node, (ast.If, ast.For, ast.While, ast.Return))
+            and _has_call(node)):
+            self.emit(indent, '_check()')
+
+    def s_expr(self, node, indent):
+        self.emit(indent, self.expr(node.value))
+
+    def s_pass(self, node, indent):
+        self.emit(indent, 'pass')
+
+    def s_break(self, node, indent):
+        self.emit(indent, 'break')
+
+    def s_continue(self, node, indent):
+        self.emit(indent, 'continue')
+
+    def s_return(self, node, indent):
+        if not self.procedure:
+            raise CompileError("'return' outside procedure")
+        if node.value is None:
+            self.emit(indent, 'return None')
+        elif _has_call(node.value):
+            tmp = self.temp()
+            self.emit(indent, '%s = %s' % (tmp, self.expr(node.value)))
+            self.emit(indent, '_check()')
+            self.emit(indent, 'return %s' % tmp)
+        else:
+            self.emit(indent, 'return %s' % self.expr(node.value))
+
+    def s_print(self, node, indent):
+        dest = 'None'
+        if node.dest is not None:
+            dest = self.expr(node.dest)
+        vals = ''.join(['%s, ' % self.expr(n) for n in node.values])
+        self.emit(indent, '_print(%s, (%s), %s)' % (dest, vals, bool(node.nl)))
+
+    def s_assign(self, node, indent):
+        value = self.expr(node.value)
+        if len(node.targets) > 1:
+            tmp = self.temp()
+            self.emit(indent, '%s = %s' % (tmp, value))
+            value = tmp
+        for target in node.targets:
+            self.assign(target, value, indent)
+
+    def s_augassign(self, node, indent):
+        # as with the interpreter, 'x += y' becomes 'x = x + y'
+        value = '_op_%s(%s, %s)' % (node.op.__class__.__name__,
+                                    self.expr(node.target),
+                                    self.expr(node.value))
+        self.assign(node.target, value, indent)
+
+    def assign(self, target, value, indent):
+        "assign python expression 'value' to a Larch target"
+        if isinstance(target, ast.Name):
+            self.emit(indent, '_set(%r, %s)' % (target.id, value))
+        elif isinstance(target, ast.Attribute):
+            if target.attr in self.unsafe_attrs:
+                raise CompileError("unsafe attribute")
+            self.emit(indent, '(%s).%s = %s' % (self.expr(target.value),
+                                                target.attr, value))
+        elif isinstance(target, ast.Subscript):
+            xslice = target.slice
+            if isinstance(xslice, ast.Slice):
+                # the interpreter ignores the step for slice assignment
+                xslice = ast.Slice(lower=xslice.lower, upper=xslice.upper,
+                                   step=None)
+            self.emit(indent, '(%s)[%s] = %s' % (self.expr(target.value),
+                                                 self.slice(xslice), value))
+        elif isinstance(target, (ast.Tuple, ast.List)):
+            tmp = self.temp()
+            self.emit(indent, '%s = _unpack(%s, %i)' % (tmp, value,
+                                                       len(target.elts)))
+            for i, elt in enumerate(target.elts):
+                self.assign(elt, '%s[%i]' % (tmp, i), indent)
+        else:
+            raise CompileError("cannot assign to '%s'" %
+                               target.__class__.__name__)
+
+    def s_if(self, node, indent):
+        test = self.expr(node.test)
+        if _has_call(node.test):
+            tmp = self.temp()
+            self.emit(indent, '%s = %s' % (tmp, test))
+            self.emit(indent, '_check()')
+            test = tmp
+        self.emit(indent, 'if %s:' % test)
+        self.block(node.body, indent+1)
+        if len(node.orelse) > 0:
+            self.node = node
+            self.emit(indent, 'else:')
+            self.block(node.orelse, indent+1)
+
+    def s_while(self, node, indent):
+        test = self.expr(node.test)
+        if _has_call(node.test):
+            if len(node.orelse) > 0:
+                raise CompileError("while-else with function call in test")
+            tmp = self.temp()
+            self.emit(indent, 'while True:')
+            self.emit(indent+1, '%s = %s' % (tmp, test))
+            self.emit(indent+1, '_check()')
+            self.emit(indent+1, 'if not %s:' % tmp)
+            self.emit(indent+2, 'break')
+        else:
+            self.emit(indent, 'while %s:' % test)
+        self.block(node.body, indent+1)
+        if len(node.orelse) > 0:
+            self.node = node
+            self.emit(indent, 'else:')
+            self.block(node.orelse, indent+1)
+
+    def s_for(self, node, indent):
+        tmp = self.temp()
+        iterval = self.expr(node.iter)
+        if _has_call(node.iter):
+            self.emit(indent, '%s = %s' % (tmp, iterval))
+            self.emit(indent, '_check()')
+            iterval = tmp
+        self.emit(indent, 'for %s in %s:' % (tmp, iterval))
+        self.assign(node.target, tmp, indent+1)
+        self.block(node.body, indent+1)
+        if len(node.orelse) > 0:
+            self.node = node
+            self.emit(indent, 'else:')
+            self.block(node.orelse, indent+1)
+
+    # expressions
+    def expr(self, node):
+        "python source for a Larch expression"
+        meth = getattr(self, 'x_%s' % node.__class__.__name__.lower(), None)
+        if meth is None:
+            raise CompileError("'%s' not compiled" % node.__class__.__name__)
+        return meth(node)
+
+    def x_num(self, node):
+        return _number(node.n)
+
+    def x_str(self, node):
+        return repr(node.s)
+
+    def x_name(self, node):
+        if node.id in ('True', 'False', 'None'):
+            return node.id
+        return '_lookup(%r)' % node.id
+
+    def x_attribute(self, node):
+        if node.attr in self.unsafe_attrs:
+            raise CompileError("unsafe attribute")
+        return '_getattr(%s, %r)' % (self.expr(node.value), node.attr)
+
+    def x_subscript(self, node):
+        return '(%s)[%s]' % (self.expr(node.value), self.slice(node.slice))
+
+    def slice(self, node):
+        "python source for a subscript"
+        if isinstance(node, ast.Index):
+            return self.expr(node.value)
+        elif isinstance(node, ast.Ellipsis):
+            return '...'
+        elif isinstance(node, ast.Slice):
+            out = []
+            for part in (node.lower, node.upper, node.step):
+                out.append('' if part is None else self.expr(part))
+            if node.step is None:
+                out.pop()
+            return ':'.join(out)
+        elif isinstance(node, ast.ExtSlice):
+            return ', '.join([self.slice(dim) for dim in node.dims])
+        raise CompileError("unknown subscript")
+
+    def x_ellipsis(self, node):
+        return 'Ellipsis'
+
+    def x_binop(self, node):
+        return '_op_%s(%s, %s)' % (node.op.__class__.__name__,
+                                   self.expr(node.left), self.expr(node.right))
+
+    def x_unaryop(self, node):
+        if isinstance(node.op, ast.Not):
+            return '(not %s)' % self.expr(node.operand)
+        return '_op_%s(%s)' % (node.op.__class__.__name__,
+                               self.expr(node.operand))
+
+    def x_boolop(self, node):
+        oper = ' and ' if isinstance(node.op, ast.And) else ' or '
+        return '(%s)' % oper.join([self.expr(n) for n in node.values])
+
+    def x_compare(self, node):
+        if len(node.ops) != 1:
+            raise CompileError("chained comparison")
+        return '_op_%s(%s, %s)' % (node.ops[0].__class__.__name__,
+                                   self.expr(node.left),
+                                   self.expr(node.comparators[0]))
+
+    def x_ifexp(self, node):
+        return '(%s if %s else %s)' % (self.expr(node.body),
+                                       self.expr(node.test),
+                                       self.expr(node.orelse))
+
+    def x_call(self, node):
+        args = [self.expr(node.func)]
+        args.extend([self.expr(n) for n in node.args])
+        for key in node.keywords:
+            args.append('%s=%s' % (key.arg, self.expr(key.value)))
+        if getattr(node, 'starargs', None) is not None:
+            args.append('*%s' % self.expr(node.starargs))
+        if getattr(node, 'kwargs', None) is not None:
+            args.append('**%s' % self.expr(node.kwargs))
+        return '_call(%s)' % ', '.join(args)
+
+    def x_list(self, node):
+        return '[%s]' % ', '.join([self.expr(n) for n in node.elts])
+
+    def x_tuple(self, node):
+        return '(%s)' % ''.join(['%s, ' % self.expr(n) for n in node.elts])
+
+    def x_dict(self, node):
+        return '{%s}' % ', '.join(['%s: %s' % (self.expr(k), self.expr(v))
+                                   for k, v in zip(node.keys, node.values)])
+
+    def x_repr(self, node):
+        return 'repr(%s)' % self.expr(node.value)
+
+    def x_listcomp(self, node):
+        if len(node.generators) != 1:
+            raise CompileError("list comprehension with several loops")
+        gen = node.generators[0]
+        tmp = self.temp()
+        target = gen.target
+        if isinstance(target, ast.Name):
+            setval = '_set(%r, %s)' % (target.id, tmp)
+        elif (isinstance(target, (ast.Tuple, ast.List)) and
+              all([isinstance(t, ast.Name) for t in target.elts])):
+            setval = '_setseq(%r, %s)' % (tuple([t.id for t in target.elts]),
+                                          tmp)
+        else:
+            raise CompileError("list comprehension target")
+        out = ['[%s for %s in %s' % (self.expr(node.elt), tmp,
+                                     self.expr(gen.iter)),
+               'for _ in (%s,)' % setval]
+        for cond in gen.ifs:
+            out.append('if %s' % self.expr(cond))
+        return '%s]' % ' '.join(out)
+
+def translate(body, name='block', unsafe_attrs=(), procedure=False):
+    """translate a list of Larch statements to a code object for
+    a Python function without arguments.
+
+    returns (code, nodes) with nodes giving the Larch statement
+    for each line of the generated source.
+    raises CompileError for unsupported syntax.
+    """
+    trans = Translator(unsafe_attrs=unsafe_attrs, procedure=procedure)
+    trans.block(body, 1)
+    src = ['def _larch_compiled():']
+    nodes = [None, None]
+    for indent, text, node in trans.lines:
+        src.append('%s%s' % ('    '*indent, text))
+        nodes.append(node)
+    fname = FNAME_FORMAT % (next(_unit_counter), name)
+    try:
+        mod = compile('\n'.join(src) + '\n', fname, 'exec', 0, True)
+    except SyntaxError:
+        raise CompileError("could not compile %s" % name)
+    for const in mod.co_consts:
+        if isinstance(const, types.CodeType):
+            return const, nodes
+    raise CompileError("could not compile %s" % name)
+
+class Compiler(object):
+    """compile and run Larch procedures and loops for an Interpreter"""
+    def __init__(self, _larch=None, operators=None, unsafe_attrs=()):
+        self._larch = _larch
+        self.unsafe_attrs = unsafe_attrs
+        self.namespace = {'__builtins__': __builtins__, '_lookup': self._lookup, '_set': self._set,
+                          '_getattr': self._getattr,
+                          '_setseq': self._setseq, '_unpack': self._unpack,
+                          '_call': self._call, '_print': self._print,
+                          '_check': self._check}
+        for op, func in operators.items():
+            self.namespace['_op_%s' % op.__name__] = func
+
+    @property
+    def enabled(self):
+        "whether compilation is turned on"
+        config = getattr(self._larch.symtable._sys, 'config', None)
+        return getattr(config, 'compile_code', False)
+
+    def compile_procedure(self, proc):
+        """return compiled body of a Procedure, or None if it
+        cannot be compiled"""
+        unit = getattr(proc, '_compiled', None)
+        if unit is None:
+            try:
+                unit = translate(proc.body, name=proc.name, procedure=True,
+                                 unsafe_attrs=self.unsafe_attrs)
+            except CompileError:
+                unit = False
+            proc._compiled = unit
+        return unit or None
+
+    def compile_loop(self, node):
+        """return compiled for or while loop, or None if it
+        cannot be compiled"""
+        unit = getattr(node, '_larch_compiled', None)
+        if unit is None:
+            try:
+                unit = translate([node], name=node.__class__.__name__.lower(),
+                                 unsafe_attrs=self.unsafe_attrs)
+            except CompileError:
+                unit = False
+            node._larch_compiled = unit
+        return unit or None
+
+    def execute(self, unit, fname=None, lineno=None, func=None):
+        """run compiled code, recording any exception as a Larch error.
+        lineno, if given, is the line of the Procedure definition."""
+        code, nodes = unit
+        try:
+            return types.FunctionType(code, self.namespace)()
+        except LarchStop:
+            return None
+        except:
+            node = None
+            tback = sys.exc_info()[2]
+            while tback is not None:
+                if tback.tb_frame.f_code is code:
+                    node = nodes[tback.tb_lineno]
+                tback = tback.tb_next
+            if lineno is not None and node is not None:
+                lineno = node.lineno + lineno - 1
+            self._larch.raise_exception(node, fname=fname, lineno=lineno,
+                                        func=func)
+
+    # functions used by the compiled code
+    def _lookup(self, name):
+        try:
+            return self._larch.symtable.get_symbol(name)
+        except (NameError, LookupError):
+            raise NameError("name '%s' is not defined" % name)
+
+    def _getattr(self, obj, attr):
+        try:
+            return getattr(obj, attr)
+        except AttributeError:
+            pass
+        fmt = "%s does not have member '%s'"
+        if not isgroup(obj):
+            obj = obj.__class__
+            fmt = "%s does not have attribute '%s'"
+        raise AttributeError(fmt % (obj, attr))
+
+    def _set(self, name, value):
+        self._larch.symtable.set_symbol(name, value=value)
+
+    def _setseq(self, names, value):
+        for name, val in zip(names, self._unpack(value, len(names))):
+            self._larch.symtable.set_symbol(name, value=val)
+
+    def _unpack(self, value, nvals):
+        if len(value) != nvals:
+            raise ValueError('too many values to unpack')
+        return list(value)
+
+    def _check(self):
+        if len(self._larch.error) > 0:
+            raise LarchStop()
+
+    def _call(self, *args, **kws):
+        func, args = args[0], args[1:]
+        if (not hasattr(func, '__call__') and
+            not isinstance(func, (type, types.ClassType))):
+            raise TypeError("'%s' is not callable!!" % (func))
+        # cast Parameters to floats for the many numpy ufuncs.
+        if isinstance(func, numpy.ufunc):
+            args = [arg.value if isParameter(arg) else arg for arg in args]
+        larch = self._larch
+        larch.func = func
+        out = func(*args, **kws)
+        larch.func = None
+        # a Procedure records its errors and returns None: stop here,
+        # before that None is used
+        self._check()
+        if isinstance(out, numpy.ndarray) and out.dtype == numpy.object:
+            try:
+                out = out.astype(float)
+            except TypeError:
+                try:
+                    out = out.astype(complex)
+                except TypeError:
+                    out = list(out)
+        elif isinstance(out, enumerate):
+            out = list(out)
+        return out
+
+    def _print(self, dest, values, newline):
+        dest = dest or self._larch.writer
+        end = ''
+        if newline:
+            end = '\n'
+        if values and len(self._larch.error) == 0:
+            print(*values, file=dest, end=end)
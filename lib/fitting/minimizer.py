@@ -51,7 +51,7 @@ except ImportError:
 # use local version of uncertainties package
 from . import uncertainties
 
-from .parameter import isParameter
+from .parameter import isParameter, ConstraintEvaluator
 
 try:
     from larch import Group
@@ -309,9 +309,15 @@ or set  leastsq_kws['maxfev']  to increase this maximum."""
         if not self.__prepared:
             print('fit not prepared!')
         group = self.paramgroup
+        changed = []
         for name, val in zip(self.var_names, fvars):
             par = getattr(group, name)
-            par._val  = par._from_internal(val)
+            val = par._from_internal(val)
+            if val != par._val:
+                changed.append(name)
+            par._val = val
+        # re-evaluate only constraints that depend on changed variables
+        self.constraints.update(changed)
 
     def __residual(self, fvars):
         """
@@ -330,7 +336,14 @@ or set  leastsq_kws['maxfev']  to increase this maximum."""
         """
         # computing the jacobian
         self.__update_params(fvars)
-        return self.jacfcn(self.paramgroup, *self.userargs, **self.userkws)
+        jac = asarray(self.jacfcn(self.paramgroup, *self.userargs,
+                                  **self.userkws), dtype='float64')
+        # the user function gives derivatives with respect to parameter
+        # values: scale these to the internal, bounded variables
+        for ivar, name in enumerate(self.var_names):
+            par = getattr(self.paramgroup, name)
+            jac[:, ivar] *= par.scale_gradient(fvars[ivar])
+        return jac
 
 
     def prepare_fit(self, force=False):
@@ -359,11 +372,12 @@ or set  leastsq_kws['maxfev']  to increase this maximum."""
                 if par.vary:
                     self.var_names.append(name)
                     self.vars.append(val0)
-                elif par.expr is not None:
-                    par._getval()
                 if not hasattr(par, 'name') or par.name is None:
                    par.name = name
         self.nvarys = len(self.vars)
+        # compile and order constraint expressions, evaluating
+        # each of them once.
+        self.constraints = ConstraintEvaluator(self.paramgroup)
         # now evaluate make sure initial values are set
         # are used to set values of the defined expressions.
         # this also acts as a check of expression syntax.
@@ -393,6 +407,7 @@ or set  leastsq_kws['maxfev']  to increase this maximum."""
 
         if lskws['Dfun'] is not None:
             self.jacfcn = lskws['Dfun']
+        if self.jacfcn is not None:
             lskws['Dfun'] = self.__jacobian
 
         lsout = leastsq(self.__residual, self.vars, **lskws)
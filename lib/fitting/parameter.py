@@ -1,10 +1,19 @@
-from numpy import arcsin, cos, inf, nan, sin, sqrt
+from __future__ import division
+import ast
 import json
+import types
+from numpy import arcsin, cos, inf, nan, sin, sqrt, ufunc
 from ..larchlib import isNamedClass
 
 # use local version of uncertainties package
 from . import uncertainties
 
+# callables that can be bound into a compiled constraint expression:
+# plain functions whose results depend only on their arguments.
+# Anything else (Procedures, plugin closures, non-Parameter values)
+# makes the expression be evaluated by the larch interpreter.
+COMPILABLE_FUNCS = (types.BuiltinFunctionType, types.FunctionType, ufunc)
+
 class Parameter(object):
     """returns a parameter object: a floating point value with bounds that can
     be flagged as a variable for a fit, or given an expression to use to
@@ -35,6 +44,7 @@ class Parameter(object):
         self.units = units
         self.decimals = decimals
         self._ast = None
+        self._code = None
         self._larch = None
         self._from_internal = lambda val: val
         if (hasattr(_larch, 'run') and
@@ -71,6 +81,7 @@ class Parameter(object):
     @expr.setter
     def expr(self, val):
         self._ast = None
+        self._code = None
         self._expr = val
 
     @property
@@ -97,7 +108,14 @@ class Parameter(object):
                 self._ast = self._larch.parse(self._expr)
                 if self._ast is None:
                     self._larch.writer.write(self.__invalid % self._expr)
-            if self._ast is not None:
+                else:
+                    self._compile()
+            val = None
+            if self._code is not None:
+                val = self._eval_compiled()
+            if val is not None:
+                self._val = val
+            elif self._ast is not None:
                 self._val = self._larch.run(self._ast, expr=self._expr)
                 # self._larch.symtable.save_frame()
                 # self._larch.symtable.restore_frame()
@@ -118,6 +136,90 @@ class Parameter(object):
             self._val = self._val.value
         return self._val
 
+    def _compile(self):
+        """compile the constraint expression to a Python code object.
+
+        This succeeds only if every name in the expression resolves to
+        either a Parameter or to a function in COMPILABLE_FUNCS.  The
+        resulting code is evaluated with the values of the Parameters it
+        depends on, and the result is re-used until one of those values
+        changes.  Otherwise, the expression is evaluated by the larch
+        interpreter each time.  Names are looked up as by the interpreter,
+        and the code is recompiled whenever any of them resolves to a
+        different object.
+        """
+        self._code = None
+        self._deps = []
+        self._bound = []
+        self._depvals = None
+        self._exprval = None
+        try:
+            tree = ast.parse(self._expr, mode='eval')
+        except SyntaxError:
+            return
+        symtable = self._larch.symtable
+
+        names = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name):
+                if not isinstance(node.ctx, ast.Load):
+                    return
+                names.add(node.id)
+
+        deps, funcs, bound = [], {}, []
+        for name in names:
+            try:
+                obj = symtable.get_symbol(name)
+            except (NameError, LookupError):
+                return
+            bound.append((name, obj))
+            if isParameter(obj) and obj is not self:
+                deps.append((name, obj))
+            elif isinstance(obj, COMPILABLE_FUNCS):
+                funcs[name] = obj
+            else:
+                return
+        funcs['__builtins__'] = {}
+        try:
+            self._code = compile(tree, '<%s>' % self._expr, 'eval')
+        except (SyntaxError, TypeError, ValueError):
+            return
+        self._deps = deps
+        self._bound = bound
+        self._funcs = funcs
+
+    def _eval_compiled(self):
+        """evaluate compiled constraint expression, returning None if
+        it cannot be used, so that the larch interpreter can be used
+        instead."""
+        get_symbol = self._larch.symtable.get_symbol
+        for name, obj in self._bound:
+            try:
+                current = get_symbol(name)
+            except (NameError, LookupError):
+                current = None
+            if current is not obj:
+                # a name has been replaced or shadowed: recompile
+                self._compile()
+                if self._code is None:
+                    return None
+                return self._eval_compiled()
+        depvals = {}
+        for name, par in self._deps:
+            depvals[name] = par._getval()
+        try:
+            if depvals == self._depvals:
+                return self._exprval
+        except (TypeError, ValueError):
+            pass
+        try:
+            val = eval(self._code, self._funcs, depvals)
+        except Exception:
+            return None
+        self._depvals = depvals
+        self._exprval = val
+        return val
+
     def setup_bounds(self):
         """set up Minuit-style internal/external parameter transformation
         of min/max bounds.
@@ -262,6 +364,72 @@ class Parameter(object):
     # def __sizeof__(self, other):  return self._getval()
     # def __subclasshook__(self, other):  return self._getval()
 
+class ConstraintEvaluator(object):
+    """dependency-ordered evaluator for the constrained Parameters
+    of a parameter group.
+
+    The constraints are sorted so that each is evaluated after any
+    constraint it depends on.  update() then re-evaluates only the
+    constraints downstream of a list of changed Parameter names, plus
+    any constraints that could not be compiled (see Parameter._compile),
+    as these may depend on values outside the parameter group.
+    """
+    def __init__(self, group):
+        self.params = {}
+        for name in dir(group):
+            par = getattr(group, name)
+            if isParameter(par):
+                self.params[name] = par
+
+        deps = {}
+        self.always = set()
+        for name, par in self.params.items():
+            if par.vary or par.expr is None:
+                continue
+            par._getval()
+            if par._code is None:
+                self.always.add(name)
+                deps[name] = []
+            else:
+                deps[name] = [dname for dname, dpar in par._deps
+                              if self.params.get(dname, None) is dpar]
+        self.order = []
+        visited = set()
+        def visit(name, stack):
+            if name in visited or name in stack:
+                return
+            stack.append(name)
+            for dname in deps.get(name, []):
+                visit(dname, stack)
+            stack.pop()
+            visited.add(name)
+            if name in deps:
+                self.order.append(name)
+        for name in sorted(deps):
+            visit(name, [])
+
+        # constraints that depend (directly or not) on each Parameter
+        self.downstream = {}
+        for name in self.order:
+            self.downstream[name] = set()
+            for dname in deps[name]:
+                self.downstream.setdefault(dname, set()).add(name)
+        for name in reversed(self.order):
+            for dname in deps[name]:
+                self.downstream[dname] |= self.downstream[name]
+
+    def update(self, changed=None):
+        """re-evaluate constraints affected by the changed Parameter
+        names, or all constraints if changed is None"""
+        targets = None
+        if changed is not None:
+            targets = set(self.always)
+            for name in changed:
+                targets |= self.downstream.get(name, set())
+        for name in self.order:
+            if targets is None or name in targets:
+                self.params[name]._getval()
+
 def isParameter(x):
     return (isinstance(x, Parameter) or
             x.__class__.__name__ == 'Parameter')
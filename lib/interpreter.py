@@ -19,7 +19,8 @@ from . import site_config
 from .symboltable import SymbolTable, Group, isgroup
 from .larchlib import LarchExceptionHolder, Procedure, ReturnedNone
 from .fitting  import isParameter
-from .utils import Closure
+from .utils import Closure, LRUCache
+from .codegen import Compiler
 
 UNSAFE_ATTRS = ('__subclasses__', '__bases__', '__code__',
                 '__closure__', '__globals__', 'func_code',
@@ -56,6 +57,10 @@ OPERATORS = {
     ast.UAdd:   lambda a: +a,
     ast.USub:   lambda a: -a}
 
+# number of parsed statements and of translated scripts to keep
+AST_CACHE_SIZE = 1024
+SCRIPT_CACHE_SIZE = 64
+
 PYTHON_RESERVED_WORDS = ('and', 'as', 'assert', 'break', 'class',
                          'continue', 'def', 'del', 'elif', 'else',
                          'except', 'exec', 'finally', 'for', 'from',
@@ -102,6 +107,8 @@ class Interpreter:
         self.func       = None
         self.fname      = '<stdin>'
         self.lineno     = 0
+        self.ast_cache  = LRUCache(maxsize=AST_CACHE_SIZE)
+        self.script_cache = LRUCache(maxsize=SCRIPT_CACHE_SIZE)
         builtingroup = symtable._builtin
         mathgroup    = symtable._math
         setattr(mathgroup, 'j', 1j)
@@ -143,6 +150,8 @@ class Interpreter:
 
         self.node_handlers = dict(((node, getattr(self, "on_%s" % node))
                                    for node in self.supported_nodes))
+        self.compiler = Compiler(_larch=self, operators=OPERATORS,
+                                 unsafe_attrs=UNSAFE_ATTRS)
 
     def add_plugin(self, mod, **kws):
         """add plugin components from plugin directory"""
@@ -183,10 +192,16 @@ class Interpreter:
     #  run:    ast -> result
     #  eval:   string statement -> result = run(parse(statement))
     def parse(self, text, fname=None, lineno=-1):
-        """parse statement/expression to Ast representation    """
+        """parse statement/expression to Ast representation,
+        using previously parsed Ast for the same text if available"""
         self.expr  = text
+        node = self.ast_cache.get(text)
+        if node is not None:
+            return node
         try:
-            return ast.parse(text)
+            node = ast.parse(text)
+            self.ast_cache.put(text, node)
+            return node
         except:
             etype, exc, tb = sys.exc_info()
             if (isinstance(exc, SyntaxError) and
@@ -275,6 +290,12 @@ class Interpreter:
         except RuntimeError:
             return
 
+    def parse_cache_stats(self, reset=False):
+        """return statistics for the caches of parsed statements ('ast')
+        and translated script files ('scripts')"""
+        return {'ast': self.ast_cache.stats(reset=reset),
+                'scripts': self.script_cache.stats(reset=reset)}
+
     def run_init_scripts(self):
         for fname in site_config.init_files:
             if os.path.exists(fname):
@@ -560,8 +581,22 @@ class Interpreter:
             expr = node.body
         return self.run(expr)
 
+    def run_compiled(self, node):
+        "run a for or while loop as compiled code, if possible"
+        if not self.compiler.enabled:
+            return False
+        unit = self.compiler.compile_loop(node)
+        if unit is None:
+            return False
+        self.compiler.execute(unit)
+        if len(self.error) == 0:
+            self._interrupt = None
+        return True
+
     def on_while(self, node):    # ('test', 'body', 'orelse')
         "while blocks"
+        if self.run_compiled(node):
+            return
         while self.run(node.test):
             self._interrupt = None
             for tnode in node.body:
@@ -577,6 +612,8 @@ class Interpreter:
 
     def on_for(self, node):    # ('target', 'iter', 'body', 'orelse')
         "for blocks"
+        if self.run_compiled(node):
+            return
         for val in self.run(node.iter):
             self.node_assign(node.target, val)
             if len(self.error) > 0:
@@ -234,6 +234,7 @@ class Procedure(object):
         self.lineno   = lineno
         self.__file__ = fname
         self.__name__ = name
+        self._compiled = None
 
     def __repr__(self):
         sig = self._signature()
@@ -348,15 +349,25 @@ class Procedure(object):
         retval = None
         self._larch.retval = None
         self._larch.debug = True
-        for node in self.body:
-            self._larch.run(node, fname=self.__file__, func=self,
-                            lineno=node.lineno+self.lineno-1, with_raise=False)
-            if len(self._larch.error) > 0:
-                break
-            if self._larch.retval is not None:
-                retval = self._larch.retval
-                if retval is ReturnedNone: retval = None
-                break
+        compiler = getattr(self._larch, 'compiler', None)
+        unit = None
+        if compiler is not None and compiler.enabled:
+            unit = compiler.compile_procedure(self)
+        if unit is not None:
+            self._larch.func = self
+            retval = compiler.execute(unit, fname=self.__file__,
+                                      lineno=self.lineno, func=self)
+        else:
+            for node in self.body:
+                self._larch.run(node, fname=self.__file__, func=self,
+                                lineno=node.lineno+self.lineno-1,
+                                with_raise=False)
+                if len(self._larch.error) > 0:
+                    break
+                if self._larch.retval is not None:
+                    retval = self._larch.retval
+                    if retval is ReturnedNone: retval = None
+                    break
         stable.restore_frame()
         self._larch.debug = False
         self._larch.retval = None
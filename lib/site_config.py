@@ -164,6 +164,13 @@ for pth in _path:
     if exists(pdir) and pdir not in plugins_path:
         plugins_path.append(pdir)
 
+# add plugins as stubs from a cached manifest, importing
+# each plugin module only when one of its functions is used
+lazy_plugins = os.environ.get('LARCHLAZYPLUGINS', '1').lower() not in ('0', 'no', 'false')
+
+# compile procedures and loops to python code objects
+compile_code = os.environ.get('LARCHCOMPILE', '0').lower() in ('1', 'yes', 'true')
+
 # initialization larch files to be run on startup
 init_files = [join(larchdir, 'init.lar')]
 
@@ -5,12 +5,23 @@ SymbolTable for Larch interpreter
 from __future__ import print_function
 import os
 import sys
+import imp
 import types
 import numpy
 import copy
 from .utils import Closure, fixName, isValidName
 from . import site_config
 
+# each Group counts its structural changes (members added or removed,
+# or subgroups replaced) in a hidden member, which the SymbolTable lookup
+# cache uses to check that a cached name still resolves the same way
+_GEN = '_Group__gen'
+_setattr = object.__setattr__
+
+def _group_gen(grp):
+    "return generation of a Group"
+    return grp.__dict__.get(_GEN, 0)
+
 class Group(object):
     """Generic Group: a container for variables, modules, and subgroups.
 
@@ -28,6 +39,18 @@ class Group(object):
         for key, val in kws.items():
             setattr(self, key, val)
 
+    def __setattr__(self, name, value):
+        members = self.__dict__
+        if (name not in members or isinstance(value, Group) or
+            isinstance(members[name], Group)):
+            members[_GEN] = members.get(_GEN, 0) + 1
+        _setattr(self, name, value)
+
+    def __delattr__(self, name):
+        members = self.__dict__
+        members[_GEN] = members.get(_GEN, 0) + 1
+        object.__delattr__(self, name)
+
     def __len__(self):
         return max(1, len(dir(self))-1)
 
@@ -39,14 +62,14 @@ class Group(object):
     def __copy__(self):
         out = Group()
         for k, v in self.__dict__.items():
-            if k != '__name__':
+            if k not in ('__name__', _GEN):
                 setattr(out, k,  copy.copy(v))
         return out
 
     def __deepcopy__(self, memo):
         out = Group()
         for k, v in self.__dict__.items():
-            if k != '__name__':
+            if k not in ('__name__', _GEN):
                 setattr(out, k,  copy.deepcopy(v, memo))
         return out
 
@@ -120,6 +143,92 @@ Mathematical functions, including a host of functtion from numpy and scipy
 """
 
 
+class PluginLoader(object):
+    """loads a plugin module on first use of any of its stubs"""
+    def __init__(self, symtable, name, path, groupname, symbols,
+                 on_error, **kws):
+        self.symtable = symtable
+        self.name = name
+        self.path = path
+        self.groupname = groupname
+        self.group = symtable.get_group(groupname)
+        self.symbols = symbols
+        self.on_error = on_error
+        self.kws = kws
+        self.stubs = {}
+        self.loaded = False
+        self.loading = False
+
+    def load(self):
+        """import plugin, replacing its stubs in the symbol table.
+        If the import fails, its exception is raised, and the import
+        is tried again on the next use of a stub."""
+        if self.loaded or self.loading:
+            return
+        self.loading = True
+        try:
+            self._load()
+        finally:
+            self.loading = False
+        self.loaded = True
+
+    def _load(self):
+        symtable = self.symtable
+        fh, modpath, desc = imp.find_module(self.name, [self.path])
+        symtable.save_frame()
+        symtable._sys.localGroup = symtable
+        symtable._sys.moduleGroup = symtable
+        try:
+            group = self.group
+            mod = imp.load_module(self.name, fh, modpath, desc)
+            # keep symbols that were redefined after stubs were made
+            current = dict((key, getattr(group, key, None))
+                           for key in self.symbols)
+            symtable.add_plugin(mod, self.on_error, **self.kws)
+            for key, val in current.items():
+                if val is not self.stubs.get(key, None):
+                    setattr(group, key, val)
+        finally:
+            symtable.restore_frame()
+            if fh is not None:
+                fh.close()
+
+    def resolve(self, key):
+        "return real symbol for a stub"
+        self.load()
+        val = getattr(self.group, key)
+        if isinstance(val, PluginStub):
+            raise ImportError("plugin '%s' did not define '%s'" %
+                              (self.name, key))
+        return val
+
+class PluginStub(object):
+    """placeholder for a plugin function, which imports the plugin
+    and is replaced by the real function on first access"""
+    def __init__(self, loader, name):
+        self.__dict__['_loader'] = loader
+        self.__dict__['__name__'] = name
+        loader.stubs[name] = self
+
+    def _resolve(self):
+        return self._loader.resolve(self.__name__)
+
+    def __call__(self, *args, **kws):
+        return self._resolve()(*args, **kws)
+
+    def __getattr__(self, attr):
+        if attr.startswith('__') and attr.endswith('__'):
+            raise AttributeError(attr)
+        return getattr(self._resolve(), attr)
+
+    @property
+    def __doc__(self):
+        return self._resolve().__doc__
+
+    def __repr__(self):
+        return "<function %s, plugin=%s (not loaded)>" % (self.__name__,
+                                                           self._loader.name)
+
 class SymbolTable(Group):
     """Main Symbol Table for Larch.
     """
@@ -130,10 +239,17 @@ class SymbolTable(Group):
                 'has_symbol', 'has_group', 'get_group',
                 'create_group', 'new_group', 'isgroup',
                 'get_symbol', 'set_symbol',  'del_symbol',
-                'get_parent', 'add_plugin', '_path', '__parents')
+                'get_parent', 'add_plugin', 'add_plugin_stubs',
+                'lookup_stats', '_path', '__parents')
 
     def __init__(self, larch=None):
         Group.__init__(self, name=self.top_group)
+        self.__search_gen = 0
+        self.__search_cacheable = False
+        self.__lookup_gen = None
+        self.__parents = []
+        self.__lookup_cache = {}
+        self.__lookup_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
         # self.__writer = writer  or sys.stdout.write
         self._larch = larch
         self._sys = None
@@ -183,7 +299,8 @@ class SymbolTable(Group):
                                  history_file= site_config.history_file,
                                  init_files  = site_config.init_files,
                                  modules_path= site_config.modules_path,
-                                 larchdir    = site_config.larchdir)
+                                 larchdir    = site_config.larchdir,
+                                 compile_code= site_config.compile_code)
 
     def save_frame(self):
         " save current local/module group"
@@ -280,6 +397,8 @@ class SymbolTable(Group):
 
         self._sys.searchGroups = cache[3] = snames[:]
         sys.searchGroupObjects = cache[4] = sgroups[:]
+        self.__search_gen += 1
+        self.__search_cacheable = all([isinstance(g, Group) for g in sgroups])
         return sys.searchGroupObjects
 
     def get_parentpath(self, sym):
@@ -297,29 +416,63 @@ class SymbolTable(Group):
     def _lookup(self, name=None, create=False):
         """looks up symbol in search path
         returns symbol given symbol name,
-        creating symbol if needed (and create=True)"""
-        debug = False # not ('force'in name)
-        if debug:  print( '====\nLOOKUP ', name)
+        creating symbol if needed (and create=True)
+
+        The group and member name a symbol resolves to are cached,
+        together with the generation of each Group the resolution
+        depends on.  A cached entry is used only while none of those
+        Groups has had members added or deleted or subgroups replaced
+        (including by set_symbol() and del_symbol()), and the cache is
+        cleared when the search groups change.
+        """
         searchGroups = self._fix_searchGroups()
-        self.__parents = []
         if self not in searchGroups:
             searchGroups.append(self)
 
+        stats = self.__lookup_stats
+        cache = self.__lookup_cache
+        use_cache = self.__search_cacheable and not create
+        if use_cache:
+            if self.__lookup_gen != self.__search_gen:
+                if len(cache) > 0:
+                    cache.clear()
+                    stats['invalidations'] += 1
+                self.__lookup_gen = self.__search_gen
+            elif name in cache:
+                holder, attr, parents, watched = cache[name]
+                for grp, gen in watched:
+                    if _group_gen(grp) != gen:
+                        del cache[name]
+                        stats['invalidations'] += 1
+                        break
+                else:
+                    stats['hits'] += 1
+                    self.__parents[:] = parents
+                    return getattr(holder, attr)
+            stats['misses'] += 1
+
+        self.__parents = []
+
         def public_attr(grp, name):
             return (hasattr(grp, name)  and
                     not (grp is self and name in self._private))
 
         parts = name.split('.')
         if len(parts) == 1:
-            for grp in searchGroups:
+            for i, grp in enumerate(searchGroups):
                 if public_attr(grp, name):
                     self.__parents.append(grp)
+                    if use_cache:
+                        watched = [(g, _group_gen(g))
+                                   for g in searchGroups[:i+1]]
+                        cache[name] = (grp, name, self.__parents[:], watched)
                     return getattr(grp, name)
 
         # more complex case: not immediately found in Local or Module Group
         parts.reverse()
         top   = parts.pop()
         out   = self.__invalid_name
+        holder = None
         if top == self.top_group:
             out = self
         else:
@@ -327,16 +480,29 @@ class SymbolTable(Group):
                 if public_attr(grp, top):
                     self.__parents.append(grp)
                     out = getattr(grp, top)
+                    holder = grp
         if out is self.__invalid_name:
             raise NameError("'%s' is not defined" % name)
 
         if len(parts) == 0:
             return out
 
+        # only cache paths through subgroups that are Group members
+        cacheable = use_cache and isinstance(out, Group) and (
+            holder is None or top in holder.__dict__)
+        watched = []
+        if cacheable:
+            watched = [(g, _group_gen(g)) for g in searchGroups]
         while parts:
             prt = parts.pop()
             if hasattr(out, prt):
+                holder = out
                 out = getattr(out, prt)
+                if cacheable:
+                    watched.append((holder, _group_gen(holder)))
+                if len(parts) > 0:
+                    cacheable = (cacheable and isinstance(out, Group) and
+                                 prt in holder.__dict__)
             elif create:
                 val = None
                 if len(parts) > 0:
@@ -346,6 +512,23 @@ class SymbolTable(Group):
             else:
                 raise LookupError(
                     "cannot locate member '%s' of '%s'" % (prt,out))
+        if cacheable:
+            cache[name] = (holder, prt, self.__parents[:], watched)
+        return out
+
+    def lookup_stats(self, reset=False):
+        """return statistics for the symbol lookup cache, as a dict with
+        hits, misses, invalidations, size, and hit_rate (in percent)"""
+        stats = self.__lookup_stats
+        out = dict(stats)
+        out['size'] = len(self.__lookup_cache)
+        total = stats['hits'] + stats['misses']
+        out['hit_rate'] = 0.0
+        if total > 0:
+            out['hit_rate'] = 100.0*stats['hits']/total
+        if reset:
+            for key in stats:
+                stats[key] = 0
         return out
 
     def has_symbol(self, symname):
@@ -477,9 +660,14 @@ class SymbolTable(Group):
             on_error("%s is not a valid larch plugin" % repr(plugin))
 
         registrar = getattr(plugin, 'registerLarchPlugin', None)
+        plugin_init = getattr(plugin, 'initializeLarchPlugin', None)
         if registrar is None:
-            return
+            return {'group': None, 'symbols': [], 'lazy': True}
         groupname, syms = registrar()
+        # plugins with an initializer are loaded at startup, unless
+        # the initializer only prepares data that is also made on demand
+        lazy = (plugin_init is None or
+                getattr(plugin, 'LARCH_LAZY_INIT', False))
 
         if not self.has_group(groupname):
             self.new_group(groupname)
@@ -489,6 +677,8 @@ class SymbolTable(Group):
         self._fix_searchGroups(force=True)
 
         for key, val in syms.items():
+            if not hasattr(val, '__call__'):
+                lazy = False
             if hasattr(val, '__call__'):
                 # test whether plugin func has a '_larch' kw arg
                 #    __code__.co_flags & 8 == 'uses **kws'
@@ -500,9 +690,32 @@ class SymbolTable(Group):
                 val = Closure(**kws)
             self.set_symbol("%s.%s" % (groupname, key), val)
 
-        plugin_init = getattr(plugin, 'initializeLarchPlugin', None)
         if plugin_init is not None:
             plugin_init(_larch=self._larch)
+        return {'group': groupname, 'symbols': list(syms.keys()),
+                'lazy': lazy}
+
+    def add_plugin_stubs(self, name, path, groupname, symbols,
+                         on_error, **kws):
+        """Add stubs for the functions of a plugin module, as listed in
+        the plugin manifest.  The module at path is imported and its
+        functions replace the stubs when any of them is first used.
+        """
+        if groupname is None:
+            return
+        if not self.has_group(groupname):
+            self.new_group(groupname)
+
+        if groupname not in self._sys.searchGroups:
+            self._sys.searchGroups.append(groupname)
+        self._fix_searchGroups(force=True)
+
+        loader = PluginLoader(self, name, path, groupname, symbols,
+                              on_error, **kws)
+        for key in symbols:
+            self.set_symbol("%s.%s" % (groupname, key),
+                            PluginStub(loader, key))
+        return loader
 
     def show_group(self, groupname):
         """display group members --- simple version for tests"""
@@ -8,5 +8,6 @@ except ImportError:
         pass
 from .closure import Closure
 from .debugtime import debugtime
+from .lrucache import LRUCache
 from .strutils import (fixName, isValidName, isNumber,
                       isLiteralStr, strip_comments, find_delims)
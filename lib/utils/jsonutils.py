@@ -6,19 +6,29 @@
 import larch
 from larch import isParameter, Parameter, isgroup, Group
 
+import base64
 import numpy as np
 
-def encode4js(obj):
+def encode4js(obj, binary=False):
     """return an object ready for json encoding.
     has special handling for many Python types
       numpy array
       complex numbers
       Larch Groups
       Larch Parameters
+
+    with binary=True, numeric numpy arrays are encoded as base64 strings
+    of their data buffer, which is much smaller and faster to encode and
+    decode than lists of numbers.
     """
     if isinstance(obj, np.ndarray):
         out = {'__class__': 'Array', '__shape__': obj.shape,
                '__dtype__': obj.dtype.name}
+        if binary and obj.dtype.kind in 'biufc':
+            out['__dtype__'] = obj.dtype.str
+            out['__encoding__'] = 'base64'
+            out['value'] = base64.b64encode(np.ascontiguousarray(obj).tostring())
+            return out
         out['value'] = obj.flatten().tolist()
         if 'complex' in obj.dtype.name:
             out['value'] = [(obj.real).tolist(), (obj.imag).tolist()]
@@ -32,7 +42,7 @@ def encode4js(obj):
     elif isgroup(obj):
         out = {'__class__': 'Group'}
         for item in dir(obj):
-            out[item] = encode4js(getattr(obj, item))
+            out[item] = encode4js(getattr(obj, item), binary=binary)
         return out
     elif isParameter(obj):
         out = {'__class__': 'Parameter'}
@@ -46,12 +56,12 @@ def encode4js(obj):
         ctype = 'List'
         if isinstance(obj, tuple):
             ctype = 'Tuple'
-        val = [encode4js(item) for item in obj]
+        val = [encode4js(item, binary=binary) for item in obj]
         return {'__class__': ctype, 'value': val}
     elif isinstance(obj, dict):
         out = {'__class__': 'Dict'}
         for key, val in obj.items():
-            out[encode4js(key)] = encode4js(val)
+            out[encode4js(key)] = encode4js(val, binary=binary)
         return out
     return obj
 
@@ -73,7 +83,10 @@ def decode4js(obj):
             if classname == 'Tuple':
                 out = tuple(out)
         elif classname == 'Array':
-            if obj['__dtype__'].startswith('complex'):
+            if obj.get('__encoding__', None) == 'base64':
+                out = np.frombuffer(base64.b64decode(obj['value']),
+                                    dtype=obj['__dtype__']).copy()
+            elif obj['__dtype__'].startswith('complex'):
                 re = np.fromiter(obj['value'][0], dtype='double')
                 im = np.fromiter(obj['value'][1], dtype='double')
                 out = re + 1j*im
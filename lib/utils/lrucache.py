@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+bounded cache, discarding least recently used entries
+"""
+try:
+    from collections import OrderedDict
+except ImportError:
+    from .ordereddict import OrderedDict
+
+class LRUCache(object):
+    """dictionary-like cache holding at most maxsize entries, discarding
+    the least recently used entry when full, and counting hits and misses.
+
+       >>> cache = LRUCache(maxsize=2)
+       >>> cache.put('a', 1)
+       >>> cache.get('a')
+       1
+       >>> cache.get('b') is None
+       True
+       >>> cache.stats()['hits']
+       1
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        "return cached value for key, marking it as most recently used"
+        try:
+            val = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data[key] = val
+        self.hits += 1
+        return val
+
+    def put(self, key, val):
+        "add value for key, discarding the oldest entries if needed"
+        self.data.pop(key, None)
+        self.data[key] = val
+        while len(self.data) > max(0, self.maxsize):
+            self.data.popitem(last=False)
+
+    def clear(self):
+        "remove all entries"
+        self.data.clear()
+
+    def stats(self, reset=False):
+        """return dict of hits, misses, size, maxsize, and hit_rate
+        (in percent), optionally resetting the hit and miss counts"""
+        out = {'hits': self.hits, 'misses': self.misses,
+               'size': len(self.data), 'maxsize': self.maxsize,
+               'hit_rate': 0.0}
+        total = self.hits + self.misses
+        if total > 0:
+            out['hit_rate'] = 100.0*self.hits/total
+        if reset:
+            self.hits = self.misses = 0
+        return out
@@ -1,9 +1,14 @@
 #!/usr/bin/env python
 from __future__ import print_function
 from SimpleXMLRPCServer import SimpleXMLRPCServer
+from SocketServer import ThreadingMixIn
+from Queue import Queue
 import os
 import sys
 import time
+import itertools
+import threading
+import traceback
 import larch
 from larch.interpreter import Interpreter
 from larch.inputText import InputText
@@ -22,18 +27,189 @@ try:
 except ImportError:
     HAS_WX = False
 
-class LarchServer(SimpleXMLRPCServer):
+# finished jobs to keep for status/result polling
+MAX_JOBS = 1000
+
+class LarchSession(object):
+    """Larch interpreter and input buffer for one server session.
+
+    With threaded=True, the interpreter is created and all commands for
+    the session are run in one dedicated thread, taking requests from a
+    queue, so that thread-bound resources (such as the sqlite connection
+    of the xraydb plugin) are always used from the thread that made them.
+    Otherwise commands are run in the calling thread.
+    """
+    def __init__(self, name='main', writer=None, local_echo=False,
+                 threaded=False):
+        self.name = name
+        self.local_echo = local_echo
+        self.queue = None
+        self.thread = None
+        self.closed = False
+        self.lock = threading.Lock()
+        if threaded:
+            self.queue = Queue()
+            self.thread = threading.Thread(target=self.run,
+                                           name='larch_session_%s' % name)
+            self.thread.daemon = True
+            self.thread.start()
+        self.call(self._setup, writer)
+
+    def _setup(self, writer):
+        self.larch  = Interpreter(writer=writer)
+        self.input  = InputText(prompt='', _larch=self.larch,
+                                interactive=False)
+        self.larch.symtable.set_symbol('_sys.color_exceptions', False)
+        self.larch.run_init_scripts()
+
+    def run(self):
+        "session thread: run requests until closed"
+        while True:
+            request = self.queue.get()
+            if request is None:
+                break
+            func, args, kws, done, out = request
+            try:
+                out.append(func(*args, **kws))
+            except Exception:
+                out.append(sys.exc_info()[1])
+                out.append(None)
+            done.set()
+
+    def call(self, func, *args, **kws):
+        """run func(*args, **kws) in the session thread, waiting for
+        it to finish and returning its value or raising its exception"""
+        if self.queue is None or threading.current_thread() is self.thread:
+            return func(*args, **kws)
+        done, out = threading.Event(), []
+        with self.lock:
+            if self.closed:
+                raise ValueError("larch session '%s' is closed" % self.name)
+            self.queue.put((func, args, kws, done, out))
+        done.wait()
+        if len(out) > 1:
+            raise out[0]
+        return out[0]
+
+    def close(self):
+        """stop the session thread after any pending requests.
+        Later calls raise a ValueError"""
+        with self.lock:
+            if self.queue is not None and not self.closed:
+                self.queue.put(None)
+            self.closed = True
+
+    def execute(self, text, write, debug=True, writer=None):
+        """execute larch text, writing output of the last statement
+        and any errors with write(), and sending other output of the
+        interpreter to writer, if given.
+        returns (value of last statement, whether there were errors)"""
+        return self.call(self._execute, text, write, debug, writer)
+
+    def _execute(self, text, write, debug, writer):
+        save_writer = self.larch.writer
+        if writer is not None:
+            self.larch.writer = writer
+        try:
+            return self._execute_text(text, write, debug)
+        finally:
+            self.larch.writer = save_writer
+
+    def _execute_text(self, text, write, debug):
+        ret = None
+        self.input.put(text, lineno=0)
+        while len(self.input) > 0:
+            block, fname, lineno = self.input.get()
+            if len(block) == 0:
+                continue
+            if self.local_echo:
+                print( block)
+            ret = self.larch.eval(block, fname=fname, lineno=lineno)
+            if self.larch.error:
+                err = self.larch.error.pop(0)
+                fname, lineno = err.fname, err.lineno
+                write("%s\n" % err.get_error()[1])
+                for err in self.larch.error:
+                    if debug or ((err.fname != fname or err.lineno != lineno)
+                                 and err.lineno > 0 and lineno > 0):
+                        write("%s\n" % (err.get_error()[1]))
+                self.input.clear()
+                return None, True
+            elif ret is not None:
+                write("%s\n" % repr(ret))
+        return ret, False
+
+    def get_data(self, expr, binary=False):
+        "return json encoded value of a larch expression"
+        return self.call(self._get_data, expr, binary)
+
+    def _get_data(self, expr, binary):
+        return encode4js(self.larch.eval(expr), binary=binary)
+
+class LarchJob(object):
+    """larch text submitted to run asynchronously in a session"""
+    def __init__(self, jobid, text, session):
+        self.jobid = jobid
+        self.text = text
+        self.session = session
+        self.status = 'queued'
+        self.output = []
+        self.result = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    def write(self, text):
+        self.output.append(text)
+
+    def get_status(self):
+        return {'id': self.jobid, 'status': self.status,
+                'session': self.session.name, 'submitted': self.submitted,
+                'started': self.started, 'finished': self.finished}
+
+    def get_result(self):
+        out = self.get_status()
+        out['output'] = ''.join(self.output)
+        out['result'] = self.result
+        return out
+
+class LarchServer(ThreadingMixIn, SimpleXMLRPCServer):
+    """XML-RPC server for Larch
+
+    With workers=0 (the default), requests are handled one at a time by
+    a single interpreter.  With workers > 0, each request is handled in
+    its own thread so that polling is never blocked by a long command,
+    and larch text can be submitted as jobs that are run by a pool of
+    worker threads, either in the main session or in separate sessions
+    (each with its own interpreter) made with new_session().  All
+    commands, data requests, and jobs for a session are run in that
+    session's own thread.  wx graphics are not available with workers > 0.
+    """
+    daemon_threads = True
+
     def __init__(self, host='127.0.0.1', port=5465, with_wx=True,
-                 local_echo=True, quiet=False, **kws):
+                 local_echo=True, quiet=False, workers=0, max_sessions=8,
+                 **kws):
         self.keep_alive = True
         self.port = port
-        self.with_wx = HAS_WX and with_wx
+        self.workers = workers
+        self.max_sessions = max_sessions
+        self.with_wx = HAS_WX and with_wx and workers == 0
         self.local_echo = local_echo
         self.quiet = quiet
         self.out_buffer = []
+        self.out_lock = threading.Lock()
         SimpleXMLRPCServer.__init__(self, (host, port),
                                     logRequests=False, allow_none=True, **kws)
         self.initialized = False
+        self.init_lock = threading.Lock()
+        self.sessions = {}
+        self.session_counter = itertools.count(1)
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self.job_counter = itertools.count(1)
+        self.job_queue = Queue()
         self.register_introspection_functions()
         self.register_function(self.list_dir,      'ls')
         self.register_function(self.change_dir,    'chdir')
@@ -44,17 +220,42 @@ class LarchServer(SimpleXMLRPCServer):
         self.register_function(self.get_data,      'get_data')
         self.register_function(self.get_messages,  'get_messages')
         self.register_function(self.len_messages,  'len_messages')
+        if self.workers > 0:
+            self.register_function(self.submit,        'submit')
+            self.register_function(self.job_status,    'job_status')
+            self.register_function(self.job_result,    'job_result')
+            self.register_function(self.list_jobs,     'list_jobs')
+            self.register_function(self.new_session,   'new_session')
+            self.register_function(self.close_session, 'close_session')
+            self.register_function(self.list_sessions, 'list_sessions')
+            # let run() check keep_alive while requests are in threads
+            self.timeout = 0.5
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.run_jobs,
+                                          name='larch_worker_%i' % (i+1))
+                thread.daemon = True
+                thread.start()
+
+    def process_request(self, request, client_address):
+        "handle requests in threads only when running with workers"
+        if self.workers > 0:
+            return ThreadingMixIn.process_request(self, request,
+                                                  client_address)
+        return SimpleXMLRPCServer.process_request(self, request,
+                                                  client_address)
 
     def write(self, text):
-        self.out_buffer.append(text)
+        with self.out_lock:
+            self.out_buffer.append(text)
         if self.local_echo:
             print( text)
 
     def get_messages(self):
-        if self.local_echo:
-            print( '== clear output buffer (%i)' % len(self.out_buffer))
-        out = '\n'.join(self.out_buffer)
-        self.out_buffer = []
+        with self.out_lock:
+            out = '\n'.join(self.out_buffer)
+            if self.local_echo:
+                print( '== clear output buffer (%i)' % len(self.out_buffer))
+            self.out_buffer = []
         return out
 
     def len_messages(self):
@@ -113,11 +314,17 @@ class LarchServer(SimpleXMLRPCServer):
         return 1
 
     def initialize_larch(self):
-        self.larch  = Interpreter(writer=self)
-        self.input  = InputText(prompt='', _larch=self.larch,
-                                interactive=False)
-        self.larch.symtable.set_symbol('_sys.color_exceptions', False)
-        self.larch.run_init_scripts()
+        with self.init_lock:
+            if not self.initialized:
+                self._initialize_larch()
+
+    def _initialize_larch(self):
+        self.session = LarchSession(name='main', writer=self,
+                                    local_echo=self.local_echo,
+                                    threaded=self.workers > 0)
+        self.sessions['main'] = self.session
+        self.larch  = self.session.larch
+        self.input  = self.session.input
         self.wxapp = None
         self.wx_evtloop = None
         if self.with_wx:
@@ -143,9 +350,22 @@ class LarchServer(SimpleXMLRPCServer):
                 self.wx_evtloop.run(poll_time=5)
         return True
 
-    def get_data(self, expr):
-        "return json encoded data for a larch expression"
-        return encode4js(self.larch.eval(expr))
+    def get_session(self, session=None):
+        "return named session, or the main session"
+        if not self.initialized:
+            self.initialize_larch()
+        if session in (None, '', 'main'):
+            return self.session
+        if session not in self.sessions:
+            raise ValueError("unknown larch session '%s'" % session)
+        return self.sessions[session]
+
+    def get_data(self, expr, binary=False, session=None):
+        """return json encoded data for a larch expression
+
+        with binary=True, numpy arrays are sent as base64-encoded
+        buffers instead of lists of numbers (see utils.jsonutils)."""
+        return self.get_session(session).get_data(expr, binary=binary)
 
     def larch_exec(self, text, debug=True):
         "execute larch command"
@@ -153,32 +373,102 @@ class LarchServer(SimpleXMLRPCServer):
         if not self.initialized:
             self.initialize_larch()
         text = text.strip()
+        ret = None
         if text in ('quit', 'exit', 'EOF'):
             self.exit()
         else:
-            ret = None
-            self.input.put(text, lineno=0)
-            while len(self.input) > 0:
-                block, fname, lineno = self.input.get()
-                if len(block) == 0:
-                    continue
-                if self.local_echo:
-                    print( block)
-                ret = self.larch.eval(block, fname=fname, lineno=lineno)
-                if self.larch.error:
-                    err = self.larch.error.pop(0)
-                    fname, lineno = err.fname, err.lineno
-                    self.write("%s\n" % err.get_error()[1])
-                    for err in self.larch.error:
-                        if self.debug or ((err.fname != fname or err.lineno != lineno)
-                                     and err.lineno > 0 and lineno > 0):
-                            self.write("%s\n" % (err.get_error()[1]))
-                    self.input.clear()
-                    break
-                elif ret is not None:
-                    self.write("%s\n" % repr(ret))
+            ret, err = self.session.execute(text, self.write, debug=debug)
         return ret is None
 
+    # asynchronous jobs and sessions, with workers > 0
+    def submit(self, text, session=None):
+        """submit larch text to be run in a session (default 'main')
+        by the worker pool, returning a job id for job_status() and
+        job_result()"""
+        job = LarchJob(next(self.job_counter), text.strip(),
+                       self.get_session(session))
+        with self.jobs_lock:
+            self.jobs[job.jobid] = job
+            finished = [j for j in self.jobs.values() if j.done.is_set()]
+            if len(finished) > MAX_JOBS:
+                finished.sort(key=lambda j: j.finished)
+                for j in finished[:len(finished)-MAX_JOBS]:
+                    self.jobs.pop(j.jobid, None)
+        self.job_queue.put(job)
+        return job.jobid
+
+    def run_jobs(self):
+        "worker thread: run submitted jobs"
+        while True:
+            job = self.job_queue.get()
+            job.status = 'running'
+            job.started = time.time()
+            try:
+                ret, err = job.session.execute(job.text, job.write,
+                                               writer=job)
+                if ret is not None:
+                    job.result = repr(ret)
+                job.status = 'error' if err else 'done'
+            except:
+                job.write(traceback.format_exc())
+                job.status = 'error'
+            job.finished = time.time()
+            job.done.set()
+
+    def get_job(self, jobid):
+        with self.jobs_lock:
+            job = self.jobs.get(jobid, None)
+        if job is None:
+            raise ValueError("unknown job id '%s'" % jobid)
+        return job
+
+    def job_status(self, jobid):
+        """return status of a job: a dict with 'status' one of
+        'queued', 'running', 'done', or 'error'"""
+        return self.get_job(jobid).get_status()
+
+    def job_result(self, jobid, timeout=0):
+        """return status, output, and repr of the final value of a job,
+        waiting up to timeout seconds for it to finish"""
+        job = self.get_job(jobid)
+        if timeout > 0:
+            job.done.wait(timeout)
+        return job.get_result()
+
+    def list_jobs(self):
+        "return status of all jobs"
+        with self.jobs_lock:
+            jobs = list(self.jobs.values())
+        jobs.sort(key=lambda j: j.jobid)
+        return [j.get_status() for j in jobs]
+
+    def new_session(self):
+        """create a session with its own interpreter, returning its name
+        for submit() and get_data()"""
+        self.get_session()
+        if len(self.sessions) >= self.max_sessions:
+            raise ValueError("too many larch sessions (max=%i)" %
+                             self.max_sessions)
+        name = 'session%i' % next(self.session_counter)
+        self.sessions[name] = LarchSession(name=name, writer=self,
+                                           local_echo=self.local_echo,
+                                           threaded=True)
+        return name
+
+    def close_session(self, session):
+        """close a session made with new_session().  Jobs for the
+        session that have not started will finish with status 'error'"""
+        sess = self.get_session(session)
+        if sess is self.session:
+            raise ValueError("cannot close main larch session")
+        self.sessions.pop(session, None)
+        sess.close()
+        return True
+
+    def list_sessions(self):
+        "return names of sessions"
+        return sorted(self.sessions.keys())
+
 if __name__ == '__main__':
     s = LarchServer(host='localhost', port=4966)
     s.run()
@@ -117,8 +117,12 @@ def index_nearest(array, value, _larch=None):
     return np.abs(array-value).argmin()
 
 def realimag(arr, _larch=None):
-    "return real array of real/imag pairs from complex array"
-    return np.array([(i.real, i.imag) for i in arr]).flatten()
+    """return real array of real/imag pairs from complex array.
+    For n-d arrays, pairs are interleaved along the last axis."""
+    arr = np.asarray(arr)
+    out = np.concatenate((arr.real[..., np.newaxis],
+                          arr.imag[..., np.newaxis]), axis=-1)
+    return out.reshape(arr.shape[:-1] + (2*arr.shape[-1],))
 
 def complex_phase(arr, _larch=None):
     "return phase, modulo 2pi jumps"
@@ -1572,16 +1572,12 @@ class MapViewerFrame(wx.Frame):
         self.h5convert_nrow = nrows
         self.h5convert_done = False
         if xrm_map.folder_has_newdata():
-            irow = xrm_map.last_row + 1
-            self.h5convert_irow = irow
-            while irow < nrows:
-                t0 = time.time()
+            self.h5convert_irow = xrm_map.last_row + 1
+            for irow, rowdat in xrm_map.iter_rowdata(xrm_map.last_row + 1,
+                                                     nrows):
                 self.h5convert_irow = irow
-                rowdat = xrm_map.read_rowdata(irow)
-                t1 = time.time()
-                xrm_map.add_rowdata(rowdat)
-                t2 = time.time()
-                irow  = irow + 1
+                if rowdat is not None:
+                    xrm_map.add_rowdata(rowdat)
                 try:
                     wx.Yield()
                 except:
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 import numpy as np
+from multiprocessing import Pool, cpu_count
 from scipy.interpolate import splrep, splev, UnivariateSpline
+from scipy.optimize import leastsq
 
 from larch import Group, Parameter, Minimizer
 from larch import ValidateLarchPlugin, use_plugin_path, isgroup
@@ -13,19 +15,11 @@ from mathutils import index_of, index_nearest, realimag, remove_dups
 
 from xafsutils import ETOK, set_xafsGroup
 from xafsft import ftwindow, xftf_fast
-from pre_edge import find_e0, pre_edge
+from pre_edge import find_e0, pre_edge, preedge, preedge_stack
 
 use_plugin_path('std')
 from grouputils import parse_group_args
 
-# check for uncertainties package
-HAS_UNCERTAIN = False
-try:
-    import uncertainties
-    HAS_UNCERTAIN = True
-except ImportError:
-    pass
-
 FMT_COEF = 'c%2.2i'
 
 def spline_eval(kraw, mu, knots, coefs, order, kout):
@@ -210,39 +204,261 @@ def autobk(energy, mu=None, group=None, rbkg=1, nknots=None, e0=None,
     params.nfev = params.fit_details.nfev
     group.autobk_details = params
 
-    # uncertainties in mu0 and chi:  fairly slow!!
-    if HAS_UNCERTAIN and calc_uncertainties:
-        vbest, vstd = [], []
-        for n in fit.var_names:
-            par = getattr(params, n)
-            vbest.append(par.value)
-            vstd.append(par.stderr)
-        uvars = uncertainties.correlated_values(vbest, params.covar)
-        # uncertainty in bkg (aka mu0)
-        # note that much of this is working around
-        # limitations in the uncertainty package that make it
-        #  1. take an argument list (not array)
-        #  2. work on returned scalars (but not arrays)
-        #  3. not handle kw args and *args well (so use
-        #     of global "index" is important here)
+    # uncertainties in mu0 and chi: both are linear in the spline
+    # coefficients, so propagate the covariance with their Jacobians:
+    #    delta**2 = diag(J Cov J^T)
+    covar = getattr(params, 'covar', None)
+    if calc_uncertainties and covar is not None:
         nkx = iemax-ie0 + 1
-        def my_dsplev(*args):
-            coefs = np.array(args)
-            return splev(kraw[:nkx], [knots, coefs, order])[index]
-        fdbkg = uncertainties.wrap(my_dsplev)
-        dmu0  = [fdbkg(*uvars).std_dev() for index in range(len(bkg))]
+        # columns: d(bkg)/d(coef) for each variable, in the order of
+        # the covariance matrix
+        unit = np.eye(len(coefs))
+        icoefs = [int(name[1:]) for name in fit.var_names]
+        jac_bkg = np.array([splev(kraw[:nkx], [knots, unit[i], order])
+                            for i in icoefs]).transpose()
+        # chi is the interpolation of (mu - bkg) onto kout
+        jac_chi = -np.array([UnivariateSpline(kraw[:nkx], jac_bkg[:, i],
+                                              s=0)(kout)
+                             for i in range(len(icoefs))]).transpose()
+        dmu0 = np.sqrt((np.dot(jac_bkg, covar) * jac_bkg).sum(axis=1))
+        dchi = np.sqrt((np.dot(jac_chi, covar) * jac_chi).sum(axis=1))
         group.delta_bkg = np.zeros(len(mu))
-        group.delta_bkg[ie0:ie0+len(bkg)] = np.array(dmu0)
-
-        # uncertainty in chi (see notes above)
-        def my_dchi(*args):
-            coefs = np.array(args)
-            b,chi = spline_eval(kraw[:nkx], mu[ie0:iemax+1],
-                                knots, coefs, order, kout)
-            return chi[index]
-        fdchi = uncertainties.wrap(my_dchi)
-        dchi  = [fdchi(*uvars).std_dev() for index in range(len(kout))]
-        group.delta_chi = np.array(dchi)/edge_step
+        group.delta_bkg[ie0:ie0+len(bkg)] = dmu0
+        group.delta_chi = dchi/edge_step
+
+def _linear_operator(func, nin):
+    """return the matrix for a function that is linear in a
+    1-d array of length nin, built by applying it to unit vectors"""
+    unit = np.eye(nin)
+    return np.array([func(unit[i]) for i in range(nin)]).transpose()
+
+def _realimag_rows(cmat):
+    """real matrix whose rows hold interleaved real/imag parts of the
+    rows of cmat, matching realimag() of a complex vector"""
+    out = np.empty((2*cmat.shape[0], cmat.shape[1]))
+    out[0::2] = cmat.real
+    out[1::2] = cmat.imag
+    return out
+
+def _autobk_batch_chunk(args):
+    """fit spline coefficients for a chunk of spectra sharing one
+    autobk layout (see autobk_batch).  Returns (coefs, nfev)."""
+    mu_k, ctx = args
+    nspec = mu_k.shape[0]
+    chi0  = np.dot(mu_k, ctx['interp'].T)
+    if ctx['chi_std'] is not None:
+        chi0 = chi0 - ctx['chi_std']
+    ft0   = np.dot(chi0, ctx['ftmat'].T)
+    coefs = np.dot(ctx['init_y'], ctx['initop'].T)
+    nfev  = np.ones(nspec, dtype='int')
+    nclamp = ctx['nclamp']
+    if nclamp == 0:
+        # residual is linear in coefficients: solve all spectra at once
+        coefs = np.linalg.lstsq(ctx['ftbasis'], ft0.T, rcond=-1)[0].T
+        return coefs, nfev
+
+    hmat, gmat = ctx['chibasis'], ctx['ftbasis']
+    clo  = abs(ctx['clamp_lo'])
+    chiw = abs(ctx['clamp_hi'])*ctx['kout'][-nclamp:]**ctx['kweight']
+    cscale = nclamp / 10.0
+
+    def resid(c, chi0, ft0):
+        xchi = chi0 - np.dot(hmat, c)
+        csum = (xchi*xchi).sum() * cscale
+        return np.concatenate((ft0 - np.dot(gmat, c),
+                               clo*xchi[:nclamp]/csum,
+                               chiw*xchi[-nclamp:]/csum))
+
+    def jacob(c, chi0, ft0):
+        xchi = chi0 - np.dot(hmat, c)
+        csum = (xchi*xchi).sum() * cscale
+        dcsum = -2 * cscale * np.dot(xchi, hmat)
+        dlo = -(hmat[:nclamp]*csum + np.outer(xchi[:nclamp], dcsum))/csum**2
+        dhi = -(hmat[-nclamp:]*csum + np.outer(xchi[-nclamp:], dcsum))/csum**2
+        return np.concatenate((-gmat, clo*dlo, chiw[:, np.newaxis]*dhi))
+
+    for i in range(nspec):
+        out = leastsq(resid, coefs[i], args=(chi0[i], ft0[i]), Dfun=jacob,
+                      xtol=ctx['toler'], ftol=ctx['toler'],
+                      gtol=ctx['toler'], full_output=True)
+        coefs[i] = out[0]
+        nfev[i]  = out[2]['nfev']
+    return coefs, nfev
+
+@ValidateLarchPlugin
+def autobk_batch(energy, mu=None, group=None, rbkg=1, nknots=None, e0=None,
+                 edge_step=None, kmin=0, kmax=None, kweight=1, dk=0,
+                 win='hanning', k_std=None, chi_std=None, nfft=2048,
+                 kstep=0.05, pre_edge_kws=None, nclamp=4, clamp_lo=1,
+                 clamp_hi=1, nproc=1, _larch=None, **kws):
+    """Use Autobk algorithm to remove XAFS background for a stack
+    of spectra measured on a common energy grid.
+
+    Parameters:
+    -----------
+      energy:    1-d array of x-ray energies, in eV, or group
+      mu:        2-d array of mu(E), shape (nspectra, len(energy))
+      group:     output group (and input group for e0 and edge_step).
+      e0:        edge energy, in eV, shared by all spectra.  If None, it
+                 will be taken from group.e0 (its mean, if an array) or
+                 determined from the average spectrum.
+      edge_step: edge step: a scalar, an array of length nspectra, or
+                 None to take it from group.edge_step or determine it
+                 for each spectrum.
+      nproc:     number of processes to spread the spectra over [1].
+                 Use 0 or None to use all available CPUs.
+
+    All other parameters are as for autobk().
+
+    Notes:
+    ------
+    The k grid, FT window, and spline knot layout are built once and
+    shared by all spectra.  The spline coefficients are fit as plain
+    arrays with an analytic Jacobian; with nclamp=0 the fit is linear
+    and all spectra are solved with a single least-squares call.
+
+    Arrays written to the output group:
+        energy       energy array
+        k            k array shared by all spectra
+        bkg          2-d array of mu_0(E)
+        chie         2-d array of chi(E)
+        chi          2-d array of chi(k)
+        e0           edge energy
+        edge_step    array of edge steps
+
+    Follows the 'First Argument Group' convention.
+    """
+    msg = _larch.writer.write
+    if 'kw' in kws:
+        kweight = kws.pop('kw')
+    if len(kws) > 0:
+        msg('Unrecognized arguments for autobk_batch():\n')
+        msg('    %s\n' % (', '.join(kws.keys())))
+        return
+
+    energy, mu, group = parse_group_args(energy, members=('energy', 'mu'),
+                                         defaults=(mu,), group=group,
+                                         fcn_name='autobk_batch')
+    energy = remove_dups(energy)
+    mu = np.atleast_2d(np.asarray(mu, dtype='float64'))
+    if mu.shape[1] != len(energy) and mu.shape[0] == len(energy):
+        mu = mu.transpose()
+    nspec = mu.shape[0]
+
+    # as for autobk(), use e0 and edge_step from the group, if available
+    # (taking the mean of an array of e0 from a stacked pre_edge())
+    if e0 is None and isgroup(group, 'e0'):
+        e0 = float(np.mean(group.e0))
+    if (edge_step is None and isgroup(group, 'edge_step') and
+        np.size(group.edge_step) in (1, nspec)):
+        edge_step = group.edge_step
+
+    pre_kws = dict(nnorm=3, nvict=0, pre1=None,
+                   pre2=-50., norm1=100., norm2=None)
+    if pre_edge_kws is not None:
+        pre_kws.update(pre_edge_kws)
+    if e0 is None:
+        e0 = preedge(energy, mu.mean(axis=0), **pre_kws)['e0']
+    if edge_step is None:
+        edge_step = preedge_stack(energy, mu, e0=e0, **pre_kws)['edge_step']
+    edge_step = edge_step * np.ones(nspec)
+
+    # shared layout: k grids, FT window, knots
+    ie0 = index_nearest(energy, e0)
+    rgrid = np.pi/(kstep*nfft)
+    if rbkg < 2*rgrid: rbkg = 2*rgrid
+    irbkg = int(1.01 + rbkg/rgrid)
+
+    kraw = np.sqrt(ETOK*(energy[ie0:] - e0))
+    if kmax is None:
+        kmax = max(kraw)
+    else:
+        kmax = max(0, min(max(kraw), kmax))
+    kout  = kstep * np.arange(int(1.01+kmax/kstep), dtype='float64')
+    iemax = min(len(energy), 2+index_of(energy, e0+kmax*kmax/ETOK)) - 1
+    nkx   = iemax - ie0 + 1
+    kraw  = kraw[:nkx]
+
+    if chi_std is not None and k_std is not None:
+        chi_std = np.interp(kout, k_std, chi_std)
+    else:
+        chi_std = None
+    ftwin = kout**kweight * ftwindow(kout, xmin=kmin, xmax=kmax,
+                                     window=win, dx=dk)
+
+    nspl = max(4, min(128, 2*int(rbkg*(kmax-kmin)/np.pi) + 1))
+    spl_k, spl_e = np.zeros(nspl), np.zeros(nspl)
+    ik, i1, i2 = [np.zeros(nspl, dtype='int') for i in range(3)]
+    for i in range(nspl):
+        q  = kmin + i*(kmax-kmin)/(nspl - 1)
+        ik[i] = index_nearest(kraw, q)
+        i1[i] = min(len(kraw)-1, ik[i] + 5)
+        i2[i] = max(0, ik[i] - 5)
+        spl_k[i] = kraw[ik[i]]
+        spl_e[i] = energy[ik[i]+ie0]
+    init_y = (2*mu[:, ik+ie0] + mu[:, i1+ie0] + mu[:, i2+ie0]) / 4.0
+
+    knots, coefs, order = splrep(spl_k, np.zeros(nspl))
+    ncoefs = len(coefs)
+    def _basis(c):
+        cx = np.zeros(ncoefs)
+        cx[:nspl] = c
+        return splev(kraw, [knots, cx, order])
+
+    basis  = _linear_operator(_basis, nspl)
+    interp = _linear_operator(lambda y: UnivariateSpline(kraw, y, s=0)(kout),
+                              nkx)
+    initop = _linear_operator(lambda y: splrep(spl_k, y)[1][:nspl], nspl)
+
+    phase = np.exp(-2j*np.pi*np.outer(np.arange(irbkg),
+                                      np.arange(len(kout)))/nfft)
+    ftmat = _realimag_rows((kstep/np.sqrt(np.pi)) * phase * ftwin)
+    chibasis = np.dot(interp, basis)
+
+    ctx = dict(interp=interp, initop=initop, ftmat=ftmat,
+               chibasis=chibasis, ftbasis=np.dot(ftmat, chibasis),
+               chi_std=chi_std, kout=kout, kweight=kweight,
+               nclamp=nclamp, clamp_lo=clamp_lo, clamp_hi=clamp_hi,
+               toler=1.e-4, init_y=None)
+
+    if nproc in (0, None):
+        nproc = cpu_count()
+    nproc = max(1, min(nproc, nspec))
+    tasks = []
+    for idx in np.array_split(np.arange(nspec), nproc):
+        tctx = dict(ctx)
+        tctx['init_y'] = init_y[idx]
+        tasks.append((mu[idx, ie0:iemax+1], tctx))
+    if nproc > 1:
+        pool = Pool(nproc)
+        try:
+            results = pool.map(_autobk_batch_chunk, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_autobk_batch_chunk(t) for t in tasks]
+    coefs = np.concatenate([r[0] for r in results])
+    nfev  = np.concatenate([r[1] for r in results])
+
+    # write final results
+    bkg = np.dot(coefs, basis.T)
+    chi = np.dot(mu[:, ie0:iemax+1] - bkg, interp.T)
+    obkg = np.copy(mu)
+    obkg[:, ie0:ie0+nkx] = bkg
+    step = edge_step[:, np.newaxis]
+
+    group = set_xafsGroup(group, _larch=_larch)
+    group.energy = energy
+    group.e0   = e0
+    group.edge_step = edge_step
+    group.bkg  = obkg
+    group.chie = (mu-obkg)/step
+    group.k    = kout
+    group.chi  = chi/step
+    group.autobk_details = Group(knots_e=spl_e, knots_y=coefs,
+                                 init_knots_y=init_y, nfev=nfev)
 
 def registerLarchPlugin():
-    return ('_xafs', {'autobk': autobk})
+    return ('_xafs', {'autobk': autobk,
+                      'autobk_batch': autobk_batch})
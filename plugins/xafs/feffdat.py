@@ -18,6 +18,7 @@ from scipy.interpolate import UnivariateSpline
 from larch import (Group, Parameter, isParameter,
                    ValidateLarchPlugin,
                    param_value, use_plugin_path, isNamedClass)
+from larch.utils import OrderedDict
 
 use_plugin_path('xray')
 use_plugin_path('xafs')
@@ -26,6 +27,8 @@ from xafsutils import ETOK, set_xafsGroup
 from xraydb_plugin import atomic_mass, atomic_symbol
 
 SMALL = 1.e-6
+# number of (k, e0) evaluations of the Feff.dat tables to keep per file
+NINTERP_CACHE = 16
 
 class FeffDatFile(Group):
     def __init__(self, filename=None, _larch=None, **kws):
@@ -33,6 +36,7 @@ class FeffDatFile(Group):
         kwargs = dict(name='feff.dat: %s' % filename)
         kwargs.update(kws)
         Group.__init__(self,  **kwargs)
+        self._clear_cache()
         if filename is not None:
             self.__read(filename)
 
@@ -154,6 +158,71 @@ class FeffDatFile(Group):
         self.pha = data[1] + data[3]
         self.amp = data[2] * data[4]
         self.__rmass = None  # reduced mass of path
+        self._clear_cache()
+
+    def _clear_cache(self):
+        """clear cached splines and interpolated arrays.
+        This is done automatically when the k, pha, amp, rep, or lam
+        arrays are replaced, but should be called explicitly if those
+        arrays are altered in place.
+
+        Each call increments _version, so that results computed from
+        the previous arrays (such as cached path chi(k)) can be
+        recognized as out of date."""
+        self.__splines = None
+        self.__cached_arrays = None
+        self.__interp_cache = OrderedDict()
+        self._version = getattr(self, '_version', 0) + 1
+
+    def _interp(self, k, e0=0, interp='cubic'):
+        """interpolate Feff.dat arrays onto the e0-shifted wavenumber
+        for a k array, returning
+
+            q, pha, amp, rep, lam, pp0
+
+        where q is the e0-shifted wavenumber and pp0 = (rep + 1j/lam)**2.
+
+        The splines for pha, amp, rep, and lam are built once per file,
+        and the most recent results for each (k, e0, interp) are cached,
+        so that repeated calls during a fit do no spline construction.
+        The returned arrays are shared with the cache: do not alter them.
+        """
+        # the cache holds the arrays it was built from (not their ids,
+        # which can be reused once an array is replaced and freed)
+        arrays = (self.k, self.pha, self.amp, self.rep, self.lam)
+        cached = self.__cached_arrays
+        if cached is None or any([a is not b for a, b in zip(arrays, cached)]):
+            self._clear_cache()
+            self.__cached_arrays = arrays
+
+        k = np.asarray(k, dtype='float64')
+        key = (interp, float(e0), k.shape, k.tostring())
+        if key in self.__interp_cache:
+            return self.__interp_cache[key]
+
+        # create e0-shifted energy and k, careful to look for |e0| ~= 0.
+        en = k*k - e0*ETOK
+        if min(abs(en)) < SMALL:
+            try:
+                en[np.where(abs(en) < 2*SMALL)] = SMALL
+            except ValueError:
+                pass
+        # q is the e0-shifted wavenumber
+        q = np.sign(en)*np.sqrt(abs(en))
+
+        if interp.startswith('lin'):
+            pha, amp, rep, lam = [np.interp(q, self.k, a) for a in arrays[1:]]
+        else:
+            if self.__splines is None:
+                self.__splines = [UnivariateSpline(self.k, a, s=0)
+                                  for a in arrays[1:]]
+            pha, amp, rep, lam = [spl(q) for spl in self.__splines]
+
+        out = (q, pha, amp, rep, lam, (rep + 1j/lam)**2)
+        self.__interp_cache[key] = out
+        while len(self.__interp_cache) > NINTERP_CACHE:
+            self.__interp_cache.popitem(last=False)
+        return out
 
 
 class FeffPathGroup(Group):
@@ -323,12 +392,7 @@ class FeffPathGroup(Group):
             self._larch.writer.write('reff is too small to calculate chi(k)')
             return
         # make sure we have a k array
-        if k is None:
-            if kmax is None:
-                kmax = 30.0
-            kmax = min(max(fdat.k), kmax)
-            if kstep is None: kstep = 0.05
-            k = kstep * np.arange(int(1.01 + kmax/kstep), dtype='float64')
+        k = self._make_karray(k=k, kmax=kmax, kstep=kstep)
 
         reff = fdat.reff
         # put 'reff' into the paramGroup so that it can be used in
@@ -343,27 +407,9 @@ class FeffPathGroup(Group):
                                  deltar=deltar, sigma2=sigma2,
                                  third=third, fourth=fourth)
 
-        # create e0-shifted energy and k, careful to look for |e0| ~= 0.
-        en = k*k - e0*ETOK
-        if min(abs(en)) < SMALL:
-            try:
-                en[np.where(abs(en) < 2*SMALL)] = SMALL
-            except ValueError:
-                pass
-        # q is the e0-shifted wavenumber
-        q = np.sign(en)*np.sqrt(abs(en))
-
-        # lookup Feff.dat values (pha, amp, rep, lam)
-        if interp.startswith('lin'):
-            pha = np.interp(q, fdat.k, fdat.pha)
-            amp = np.interp(q, fdat.k, fdat.amp)
-            rep = np.interp(q, fdat.k, fdat.rep)
-            lam = np.interp(q, fdat.k, fdat.lam)
-        else:
-            pha = UnivariateSpline(fdat.k, fdat.pha, s=0)(q)
-            amp = UnivariateSpline(fdat.k, fdat.amp, s=0)(q)
-            rep = UnivariateSpline(fdat.k, fdat.rep, s=0)(q)
-            lam = UnivariateSpline(fdat.k, fdat.lam, s=0)(q)
+        # lookup Feff.dat values (pha, amp, rep, lam) at q, the
+        # e0-shifted wavenumber, and pp0 = (rep + 1j/lam)**2
+        q, pha, amp, rep, lam, pp0 = fdat._interp(k, e0=e0, interp=interp)
 
         if debug:
             self.debug_k   = q
@@ -372,23 +418,183 @@ class FeffPathGroup(Group):
             self.debug_rep = rep
             self.debug_lam = lam
 
-        # p = complex wavenumber, and its square:
-        pp   = (rep + 1j/lam)**2 + 1j * ei * ETOK
-        p    = np.sqrt(pp)
-
-        # the xafs equation:
-        cchi = np.exp(-2*reff*p.imag - 2*pp*(sigma2 - pp*fourth/3) +
-                      1j*(2*q*reff + pha +
-                          2*p*(deltar - 2*sigma2/reff - 2*pp*third/3) ))
-
-        cchi = degen * s02 * amp * cchi / (q*(reff + deltar)**2)
-        cchi[0] = 2*cchi[1] - cchi[2]
+        cchi, p = _xafs_chi(q, pha, amp, pp0, reff, degen, s02, ei,
+                            deltar, sigma2, third, fourth)
         # outputs:
         self.k = k
         self.p = p
         self.chi = cchi.imag
         self.chi_imag = -cchi.real
 
+    def _make_karray(self, k=None, kmax=None, kstep=None):
+        "return k array to use for chi(k), building a uniform one if needed"
+        if k is None:
+            if kmax is None:
+                kmax = 30.0
+            kmax = min(max(self._feffdat.k), kmax)
+            if kstep is None: kstep = 0.05
+            k = kstep * np.arange(int(1.01 + kmax/kstep), dtype='float64')
+        return k
+
+def _xafs_chi(q, pha, amp, pp0, reff, degen, s02, ei, deltar,
+              sigma2, third, fourth):
+    """evaluate the XAFS equation, returning complex chi and the complex
+    wavenumber p.
+
+    q, pha, amp, pp0 are from FeffDatFile._interp(), and can either be
+    1-D arrays for a single path or (npath, nk) arrays for a stack of
+    paths, in which case reff and the path parameters should be
+    (npath, 1) arrays so that they broadcast along k.
+    """
+    # p = complex wavenumber, and its square:
+    pp   = pp0 + 1j * ei * ETOK
+    p    = np.sqrt(pp)
+
+    # the xafs equation:
+    cchi = np.exp(-2*reff*p.imag - 2*pp*(sigma2 - pp*fourth/3) +
+                  1j*(2*q*reff + pha +
+                      2*p*(deltar - 2*sigma2/reff - 2*pp*third/3) ))
+
+    cchi = degen * s02 * amp * cchi / (q*(reff + deltar)**2)
+    cchi[..., 0] = 2*cchi[..., 1] - cchi[..., 2]
+    return cchi, p
+
+def _xafs_dchi(q, pha, amp, pp0, reff, degen, s02, ei, deltar,
+               sigma2, third, fourth):
+    """derivatives of complex chi from _xafs_chi() with respect to
+    degen, s02, ei, deltar, sigma2, third, fourth (that is, all path
+    parameters except e0, which changes the Feff.dat interpolation).
+
+    Arguments are as for _xafs_chi().  Returns a list of 7 arrays, each
+    with the shape of q.
+    """
+    pp   = pp0 + 1j * ei * ETOK
+    p    = np.sqrt(pp)
+    rtot = reff + deltar
+    cchi_unit = amp * np.exp(-2*reff*p.imag - 2*pp*(sigma2 - pp*fourth/3) +
+                             1j*(2*q*reff + pha +
+                                 2*p*(deltar - 2*sigma2/reff -
+                                      2*pp*third/3))) / (q*rtot**2)
+    cchi = degen * s02 * cchi_unit
+
+    # ei changes p and pp: p.imag is not analytic, but ei is real
+    dpp = 1j*ETOK * np.ones_like(pp)
+    dp  = dpp / (2*p)
+    dx_ei = (-2*reff*dp.imag - 2*dpp*sigma2 + 4*pp*dpp*fourth/3 +
+             1j*(2*dp*(deltar - 2*sigma2/reff) -
+                 4*third*(dp*pp + p*dpp)/3))
+    out = [s02 * cchi_unit,
+           degen * cchi_unit,
+           cchi * dx_ei,
+           cchi * (2j*p - 2/rtot),
+           cchi * (-2*pp - 4j*p/reff),
+           cchi * (-4j*p*pp/3),
+           cchi * (2*pp*pp/3)]
+    for dchi in out:
+        dchi[..., 0] = 2*dchi[..., 1] - dchi[..., 2]
+    return out
+
+def _gather_paths(paths, k):
+    """gather path parameters and interpolated Feff.dat arrays for a
+    list of paths, returning
+
+        pars, reff, q, pha, amp, pp0
+
+    with pars a (8, npath, 1) array of path parameter values (in the
+    order of FeffPathGroup._pathparams()), reff a (npath, 1) array, and
+    q, pha, amp, pp0 (npath, nk) arrays, ready for _xafs_chi().
+    """
+    npath = len(paths)
+    pars = np.array([path._pathparams() for path in paths], dtype='float64')
+    pars = pars.reshape((npath, 8, 1)).swapaxes(0, 1)
+    reff = np.array([path._feffdat.reff for path in paths])
+    reff = reff.reshape((npath, 1))
+    e0 = pars[2]
+    arrays = [path._feffdat._interp(k, e0=e0[i, 0])
+              for i, path in enumerate(paths)]
+    q, pha, amp, rep, lam, pp0 = [np.array(a) for a in zip(*arrays)]
+    return pars, reff, q, pha, amp, pp0
+
+def _calc_paths_chi(paths, k, gathered):
+    """evaluate chi(k) for a list of paths from the output of
+    _gather_paths(), returning the sum of chi(k) for all paths and
+    a list of cache entries holding the complex chi(k) for each path,
+    to be passed to _store_paths_chi().
+
+    This does not use the larch interpreter or modify the paths, and
+    so can be run in a thread other than the one that gathered the
+    paths (and will store the results).
+
+    The complex chi(k) for each path is cached with its Feff.dat data
+    (and its _version), path parameters and k grid, and only
+    re-calculated for paths where these change.
+    """
+    pars, reff, q, pha, amp, pp0 = gathered
+    kstr = k.tostring()
+    cached, redo = [], []
+    for i, path in enumerate(paths):
+        fdat = path._feffdat
+        key = (fdat._version, kstr, pars[:, i, 0].tostring())
+        cache = getattr(path, '_chi_cache', None)
+        if cache is None or cache[0] is not fdat or cache[1] != key:
+            cache = (fdat, key, None, None)
+            redo.append(i)
+        cached.append(cache)
+    if len(redo) > 0:
+        (degen, s02, e0, ei, deltar, sigma2,
+         third, fourth) = pars[:, redo]
+        cchi, p = _xafs_chi(q[redo], pha[redo], amp[redo], pp0[redo],
+                            reff[redo], degen, s02, ei, deltar, sigma2,
+                            third, fourth)
+        for j, i in enumerate(redo):
+            cached[i] = (cached[i][0], cached[i][1], p[j], cchi[j])
+    chi = np.zeros(len(k), dtype='float64')
+    for fdat, key, p, cchi in cached:
+        chi += cchi.imag
+    return chi, cached
+
+def _store_paths_chi(paths, k, cached):
+    """write k, p, chi, and chi_imag and the cache entry from
+    _calc_paths_chi() to each path"""
+    for path, cache in zip(paths, cached):
+        fdat, key, p, cchi = cache
+        path._chi_cache = cache
+        path.k = k
+        path.p = p
+        path.chi = cchi.imag
+        path.chi_imag = -cchi.real
+
+def _paths_chi(paths, k, gathered):
+    """evaluate chi(k) for a list of paths from the output of
+    _gather_paths(), writing k, p, chi, and chi_imag to each path,
+    and returning the sum of chi(k) for all paths."""
+    chi, cached = _calc_paths_chi(paths, k, gathered)
+    _store_paths_chi(paths, k, cached)
+    return chi
+
+def _ff2chi_deriv(paths, k, de0=1.e-3):
+    """derivatives of chi(k) for a list of paths with respect to
+    their path parameters.
+
+    Returns a (npath, 8, nk) array, with the path parameters in the
+    order of FeffPathGroup._pathparams().  Derivatives with respect to
+    e0 use a central difference of step de0 (in eV), re-using the
+    cached Feff.dat splines.  All others are analytic.
+    """
+    pars, reff, q, pha, amp, pp0 = _gather_paths(paths, k)
+    (degen, s02, e0, ei, deltar, sigma2, third, fourth) = pars
+    dchi = _xafs_dchi(q, pha, amp, pp0, reff, degen, s02, ei,
+                      deltar, sigma2, third, fourth)
+    chi_e0 = []
+    for step in (de0, -de0):
+        arrays = [path._feffdat._interp(k, e0=e0[i, 0] + step)
+                  for i, path in enumerate(paths)]
+        q, pha, amp, rep, lam, pp0 = [np.array(a) for a in zip(*arrays)]
+        chi_e0.append(_xafs_chi(q, pha, amp, pp0, reff, degen, s02, ei,
+                                deltar, sigma2, third, fourth)[0])
+    dchi.insert(2, (chi_e0[0] - chi_e0[1])/(2*de0))
+    return np.array(dchi).imag.swapaxes(0, 1)
+
 @ValidateLarchPlugin
 def _path2chi(path, paramgroup=None, _larch=None, **kws):
     """calculate chi(k) for a Feff Path,
@@ -443,15 +649,23 @@ def _ff2chi(pathlist, group=None, paramgroup=None, _larch=None,
     if (paramgroup is not None and _larch is not None and
          _larch.symtable.isgroup(paramgroup)):
         _larch.symtable._sys.paramGroup = paramgroup
+    paths = []
     for path in pathlist:
         if not isNamedClass(path, FeffPathGroup):
             msg('%s is not a valid Feff Path' % path)
             return
-        path._calc_chi(k=k, kstep=kstep, kmax=kmax)
-    k = pathlist[0].k[:]
-    out = np.zeros_like(k)
-    for path in pathlist:
-        out += path.chi
+        if path._feffdat.reff < 0.05:
+            msg('reff is too small to calculate chi(k) for %s' % path)
+            continue
+        paths.append(path)
+    k = pathlist[0]._make_karray(k=k, kstep=kstep, kmax=kmax)
+    if len(paths) == 0:
+        msg('no valid paths for ff2chi')
+        return
+
+    # gather path parameters and Feff.dat arrays for all paths, then
+    # evaluate the XAFS equation for all paths at once, as (npath, nk)
+    out = _paths_chi(paths, k, _gather_paths(paths, k))
 
     if group is None:
         group = Group()
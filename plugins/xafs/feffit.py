@@ -2,8 +2,10 @@
 """
    feffit sums Feff paths to match xafs data
 """
+import time
 from collections import Iterable
 from copy import copy
+from multiprocessing.pool import ThreadPool
 import numpy as np
 from numpy import array, arange, interp, pi, zeros, sqrt, concatenate
 
@@ -21,11 +23,20 @@ from mathutils import index_of, realimag, complex_phase
 # from minimizer import Minimizer
 from xafsft import xftf_fast, xftr_fast, ftwindow, set_xafsGroup
 
-from feffdat import FeffPathGroup, _ff2chi
+from feffdat import (FeffPathGroup, _ff2chi, _ff2chi_deriv,
+                     _gather_paths, _calc_paths_chi,
+                     _store_paths_chi)
 
 # use larch's uncertainties package
 from larch.fitting import correlated_values, eval_stderr
 
+TRANSFORM_ATTRS = ('kmin', 'kmax', 'kweight', 'dk', 'dk2', 'window',
+                   'nfft', 'kstep', 'rmin', 'rmax', 'dr', 'dr2',
+                   'rwindow', 'fitspace')
+
+PATH_ATTRS = ('degen', 's02', 'e0', 'ei', 'deltar', 'sigma2',
+              'third', 'fourth')
+
 class TransformGroup(Group):
     """A Group of transform parameters.
     The apply() method will return the result of applying the transform,
@@ -33,9 +44,9 @@ class TransformGroup(Group):
     and assumes that once created (not None), these do not need to be
     recalculated....
 
-    That is: don't simply change the parameters and expect different results.
-    If you do change parameters, reset kwin / rwin to None to cause them to be
-    recalculated.
+    The windows (and k-weighted windows) are cached by the transform
+    parameters they depend on, so that changing the parameters will give
+    the new windows.
     """
     def __init__(self, kmin=0, kmax=20, kweight=2, dk=4, dk2=None,
                  window='kaiser', nfft=2048, kstep=0.05,
@@ -68,6 +79,7 @@ class TransformGroup(Group):
 
         self.kwin = None
         self.rwin = None
+        self._ftcache = {}
         self.make_karrays()
 
     def __repr__(self):
@@ -102,6 +114,37 @@ class TransformGroup(Group):
         self.k_ = self.kstep * arange(self.nfft, dtype='float64')
         self.r_ = self.rstep * arange(self.nfft, dtype='float64')
 
+    def _kweighted_window(self, kweight):
+        """return window * k**kweight on the k_ grid, cached by
+        (nfft, kstep, window, kmin, kmax, dk, dk2, kweight), and set
+        self.kwin to the current k window"""
+        wkey = ('kwin', self.nfft, self.kstep, self.window,
+                self.kmin, self.kmax, self.dk, self.dk2)
+        key = wkey + (kweight,)
+        if key not in self._ftcache:
+            if len(self._ftcache) > 32:
+                self._ftcache = {}
+            if wkey not in self._ftcache:
+                self._ftcache[wkey] = ftwindow(self.k_, xmin=self.kmin,
+                                               xmax=self.kmax, dx=self.dk,
+                                               dx2=self.dk2,
+                                               window=self.window)
+            self._ftcache[key] = self._ftcache[wkey] * self.k_**kweight
+        self.kwin = self._ftcache[wkey]
+        return self._ftcache[key]
+
+    def _rwindow(self):
+        """return R window on the r_ grid, cached by
+        (nfft, kstep, rwindow, rmin, rmax, dr, dr2), and set self.rwin"""
+        key = ('rwin', self.nfft, self.kstep, self.rwindow,
+               self.rmin, self.rmax, self.dr, self.dr2)
+        if key not in self._ftcache:
+            self._ftcache[key] = ftwindow(self.r_, xmin=self.rmin,
+                                          xmax=self.rmax, dx=self.dr,
+                                          dx2=self.dr2, window=self.rwindow)
+        self.rwin = self._ftcache[key]
+        return self.rwin
+
     def _xafsft(self, chi, group=None, rmax_out=10, **kws):
         "returns "
         for key, val in kws:
@@ -133,25 +176,21 @@ class TransformGroup(Group):
 
     def fftf(self, chi, kweight=None):
         """ forward FT -- meant to be used internally.
-        chi must be on self.k_ grid"""
+        chi must be on self.k_ grid, and can be a 2-d array of
+        many chi(k), each along the last axis."""
         self.make_karrays()
-        if self.kwin is None:
-            self.kwin = ftwindow(self.k_, xmin=self.kmin, xmax=self.kmax,
-                                 dx=self.dk, dx2=self.dk2, window=self.window)
         if kweight is None:
             kweight = self.get_kweight()
-        cx = chi * self.kwin[:len(chi)] * self.k_[:len(chi)]**kweight
+        npts = np.shape(chi)[-1]
+        cx = chi * self._kweighted_window(kweight)[:npts]
         return xftf_fast(cx, kstep=self.kstep, nfft=self.nfft)
 
     def fftr(self, chir):
-        " reverse FT -- meant to be used internally"
+        """ reverse FT -- meant to be used internally.
+        chir can be a 2-d array of many chi(R), each along the last axis."""
         self.make_karrays()
-        if self.rwin is None:
-            self.rwin = ftwindow(self.r_, xmin=self.rmin, xmax=self.rmax,
-                                 dx=self.dr, dx2=self.dr2, window=self.rwindow)
-
-        cx = chir * self.rwin[:len(chir)]
-        # print( 'FFTR"   ', chir[:30], self.rwin[:30])
+        npts = np.shape(chir)[-1]
+        cx = chir * self._rwindow()[:npts]
         return xftr_fast(cx, kstep=self.kstep, nfft=self.nfft)
 
 class FeffitDataSet(Group):
@@ -170,6 +209,7 @@ class FeffitDataSet(Group):
         self.model.k = None
         self.__chi = None
         self.__prepared = False
+        self.reset_timing()
 
     def __repr__(self):
         return '<FeffitDataSet Group: %s>' % self.__name__
@@ -201,8 +241,26 @@ class FeffitDataSet(Group):
         else:
             self.estimate_noise(chi=self.__chi, rmin=15.0, rmax=30.0)
         self.__prepared = True
+        self._prepared_key = self._prepare_key()
         # print( 'feffit dataset prepare_fit ', dir(self.data), self.n_idp, self.epsilon_k)
 
+    def _prepare_key(self):
+        """key for the data and transform settings used by prepare_fit()"""
+        trans = self.transform
+        tkey = tuple([repr(getattr(trans, attr, None))
+                      for attr in TRANSFORM_ATTRS])
+        eps_k = getattr(self.data, 'epsilon_k', None)
+        if isinstance(eps_k, np.ndarray):
+            eps_k = eps_k.tostring()
+        return (tkey, np.asarray(self.data.k).tostring(),
+                np.asarray(self.data.chi).tostring(), repr(eps_k))
+
+    def is_prepared(self):
+        """whether prepare_fit() has been run with the current data and
+        transform settings"""
+        return (self.__prepared and
+                getattr(self, '_prepared_key', None) == self._prepare_key())
+
     def estimate_noise(self, chi=None, rmin=15.0, rmax=30.0, all_kweights=True):
         """estimage noise in a chi spectrum from its high r components"""
         trans = self.transform
@@ -269,29 +327,82 @@ class FeffitDataSet(Group):
         if not self.__prepared:
             self.prepare_fit()
 
+        t0 = time.time()
         _ff2chi(self.pathlist, k=self.model.k,
                 _larch=self._larch, group=self.model)
 
+        diff  = (self.__chi - self.model.chi)
+        if data_only:  # for extracting transformed data separately from residual
+            diff  = self.__chi
+        out = self._transform(diff)
+        if not data_only:
+            self.nresid += 1
+            self.resid_time += time.time() - t0
+        return out
+
+    def reset_timing(self):
+        "reset counters of residual calls and time spent in them"
+        self.nresid = 0
+        self.resid_time = 0.0
+
+    def _gather_model(self, paramgroup=None):
+        """first stage of the residual, gathering path parameters and
+        Feff.dat arrays.  This evaluates constraints with the larch
+        interpreter, so must be run in the main thread."""
+        if (paramgroup is not None and
+            self._larch.symtable.isgroup(paramgroup)):
+            self._larch.symtable._sys.paramGroup = paramgroup
+        if not self.__prepared:
+            self.prepare_fit()
+        t0 = time.time()
+        paths = [p for p in self.pathlist if p.reff >= 0.05]
+        out = (paths, _gather_paths(paths, self.model.k))
+        self.resid_time += time.time() - t0
+        return out
+
+    def _model_residual(self, gathered):
+        """second stage of the residual, from the output of
+        _gather_model(): sum chi(k) for the paths and apply the
+        transform.  This uses only numpy and does not modify the
+        dataset or its paths, so can be run in a thread.  Returns
+        the residual and the model for _store_model()."""
+        t0 = time.time()
+        paths, arrays = gathered
+        chi, cached = _calc_paths_chi(paths, self.model.k, arrays)
+        out = self._transform(self.__chi - chi)
+        return out, (paths, chi, cached, time.time() - t0)
+
+    def _store_model(self, model):
+        """write model chi(k) and path chi(k) from _model_residual()
+        to the dataset and its paths, in the thread running the fit"""
+        paths, chi, cached, dt = model
+        _store_paths_chi(paths, self.model.k, cached)
+        self.model.chi = chi
+        self.nresid += 1
+        self.resid_time += dt
+
+    def _transform(self, diff):
+        """apply the fit transform to a chi(k) difference array, scaling
+        by the uncertainties.  This is linear in diff, which can be a 2-d
+        array of many chi(k), each along the last axis."""
         eps_k = self.epsilon_k
         if isinstance(eps_k, np.ndarray):
             eps_k[np.where(eps_k<1.e-12)[0]] = 1.e-12
         else:
             eps_k = max(1.e-12, eps_k)
 
-        diff  = (self.__chi - self.model.chi)
-        if data_only:  # for extracting transformed data separately from residual
-            diff  = self.__chi
         trans = self.transform
-        k     = trans.k_[:len(diff)]
+        k     = trans.k_[:np.shape(diff)[-1]]
 
         all_kweights = isinstance(trans.kweight, Iterable)
         if trans.fitspace == 'k':
             iqmin = max(0, int(0.01 + trans.kmin/trans.kstep))
             iqmax = min(trans.nfft/2,  int(0.01 + trans.kmax/trans.kstep))
             if all_kweights:
-                return np.concatenate([((diff/eps_k)*k**kw)[iqmin:iqmax] for kw in trans.kweight])
+                return np.concatenate([((diff/eps_k)*k**kw)[..., iqmin:iqmax]
+                                       for kw in trans.kweight], axis=-1)
             else:
-                return ((diff/eps_k) * k**trans.kweight)[iqmin:iqmax]
+                return ((diff/eps_k) * k**trans.kweight)[..., iqmin:iqmax]
         else:
             out = []
             if all_kweights:
@@ -305,14 +416,34 @@ class FeffitDataSet(Group):
                 irmax = min(trans.nfft/2,  int(0.01 + trans.rmax/trans.rstep))
                 for i, chir_ in enumerate(chir):
                     chir_ = chir_ / (eps_r[i])
-                    out.append(realimag(chir_[irmin:irmax]))
+                    out.append(realimag(chir_[..., irmin:irmax]))
             else:
                 chiq = [trans.fftr(c)/eps for c, eps in zip(chir, eps_r)]
                 iqmin = max(0, int(0.01 + trans.kmin/trans.kstep))
                 iqmax = min(trans.nfft/2,  int(0.01 + trans.kmax/trans.kstep))
                 for chiq_ in chiq:
-                    out.append( realimag(chiq_[iqmin:iqmax])[::2])
-            return np.concatenate(out)
+                    out.append(chiq_.real[..., iqmin:iqmax])
+            return np.concatenate(out, axis=-1)
+
+    def _jacobian(self, dpars):
+        """return the Jacobian of the residual for this data set.
+
+        dpars is a (npath, 8, nvar) array of the derivatives of the path
+        parameters for each path in self.pathlist with respect to the
+        fit variables.  Derivatives of chi(k) with respect to the path
+        parameters are computed from the XAFS equation, and mapped
+        through the (linear) fit transform.
+        """
+        if not self.__prepared:
+            self.prepare_fit()
+        # paths with tiny reff are skipped by _ff2chi
+        use = [i for i, p in enumerate(self.pathlist) if p.reff >= 0.05]
+        paths = [self.pathlist[i] for i in use]
+        dchi = _ff2chi_deriv(paths, self.model.k)
+        dpars = dpars[use]
+        # dmodel[i] = d(model chi)/d(variable i)
+        dmodel = np.einsum('pjk,pjv->vk', dchi, dpars)
+        return -self._transform(dmodel).transpose()
 
     def save_ffts(self, rmax_out=10, path_outputs=True):
         "save fft outputs"
@@ -370,7 +501,8 @@ def feffit_transform(_larch=None, **kws):
     return TransformGroup(_larch=_larch, **kws)
 
 @ValidateLarchPlugin
-def feffit(params, datasets, _larch=None, rmax_out=10, path_outputs=True, **kws):
+def feffit(params, datasets, _larch=None, rmax_out=10, path_outputs=True,
+           jacobian=False, nthreads=1, **kws):
     """execute a Feffit fit: a fit of feff paths to a list of datasets
 
     Parameters:
@@ -379,6 +511,10 @@ def feffit(params, datasets, _larch=None, rmax_out=10, path_outputs=True, **kws)
       datasets:     Feffit Dataset group or list of Feffit Dataset group.
       rmax_out:     maximum R value to calculate output arrays.
       path_output:  Flag to set whether all Path outputs should be written.
+      jacobian:     Flag to use derivatives of chi(k) from the XAFS equation
+                    instead of finite differences of the residual [False].
+      nthreads:     number of threads to use to calculate the residuals
+                    for a list of datasets [1].
 
     Returns:
     ---------
@@ -399,11 +535,56 @@ def feffit(params, datasets, _larch=None, rmax_out=10, path_outputs=True, **kws)
         chir_pha     phase of chi(R).
         chir_re      real part of chi(R).
         chir_im      imaginary part of chi(R).
+
+     Each dataset also holds the number of residual calls made in the
+     fit (nresid) and the time spent in them (resid_time).
     """
 
     def _resid(params, datasets=None, _larch=None, **kwargs):
         """ this is the residual function"""
-        return concatenate([d._residual() for d in datasets])
+        if pool is None:
+            return concatenate([d._residual() for d in datasets])
+        # path parameters are evaluated with the interpreter, in this
+        # thread.  Summing paths and FTs are done in the thread pool.
+        # Results are written to the datasets and paths here, as
+        # datasets may share paths.
+        work = [(d, d._gather_model()) for d in datasets]
+        out = []
+        for dset, (resid, model) in zip(datasets, pool.map(_model_resid, work)):
+            dset._store_model(model)
+            out.append(resid)
+        return concatenate(out)
+
+    def _model_resid(args):
+        dset, gathered = args
+        return dset._model_residual(gathered)
+
+    def _jacob(params, datasets=None, _larch=None, **kwargs):
+        """Jacobian of the residual function: derivatives of the path
+        parameters with respect to the variables are found by finite
+        differences of the (cheap) constraint expressions, and combined
+        with derivatives of chi(k) for each path."""
+        paths, index = [], {}
+        for ds in datasets:
+            for p in ds.pathlist:
+                if id(p) not in index:
+                    index[id(p)] = len(paths)
+                    paths.append(p)
+        dpars = zeros((len(paths), 8, fit.nvarys))
+        for ivar, name in enumerate(fit.var_names):
+            par = getattr(params, name)
+            val0 = par._val
+            step = 1.e-6 * max(abs(val0), 1.e-3)
+            ppars = []
+            for val in (val0 + step, val0 - step):
+                par._val = val
+                fit.constraints.update([name])
+                ppars.append(array([p._pathparams() for p in paths]))
+            par._val = val0
+            fit.constraints.update([name])
+            dpars[:, :, ivar] = (ppars[0] - ppars[1])/(2*step)
+        return concatenate([d._jacobian(dpars[[index[id(p)] for p in d.pathlist]])
+                            for d in datasets])
 
     if isNamedClass(datasets, FeffitDataSet):
         datasets = [datasets]
@@ -411,11 +592,25 @@ def feffit(params, datasets, _larch=None, rmax_out=10, path_outputs=True, **kws)
         if not isNamedClass(ds, FeffitDataSet):
             print( "feffit needs a list of FeffitDataSets")
             return
+    for ds in datasets:
+        ds.reset_timing()
+    pool = None
+    if nthreads > 1 and len(datasets) > 1:
+        pool = ThreadPool(min(nthreads, len(datasets)))
+
     fitkws = dict(datasets=datasets)
-    fit = Minimizer(_resid, params, fcn_kws=fitkws,
+    jacfcn = None
+    if jacobian:
+        jacfcn = _jacob
+    fit = Minimizer(_resid, params, fcn_kws=fitkws, jacfcn=jacfcn,
                     scale_covar=True,  _larch=_larch, **kws)
 
-    fit.leastsq()
+    try:
+        fit.leastsq()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
     dat = concatenate([d._residual(data_only=True) for d in datasets])
     params.rfactor = (params.fit_details.fvec**2).sum() / (dat**2).sum()
 
@@ -488,6 +683,123 @@ def feffit(params, datasets, _larch=None, rmax_out=10, path_outputs=True, **kws)
     return Group(name='feffit fit results', fit=fit, params=params,
                  datasets=datasets)
 
+class FeffitSession(Group):
+    """A Feffit fit session, for repeated fits of nearly the same model.
+
+    This holds a parameter group and a list of Feffit datasets, and
+    keeps between fits:
+       - the prepared datasets (interpolated data chi(k), noise
+         estimates), re-preparing only those whose data or transform
+         have changed.
+       - the best-fit values of the variables, used as starting values
+         for the next fit (warm start).
+       - the covariance matrix and fit results group of the last fit.
+
+    If nothing about the model (parameter values, bounds, expressions,
+    paths, data, or transforms) has changed since the last fit, fit()
+    returns the last result without re-fitting.  During a fit, chi(k)
+    is recalculated only for paths whose parameters have changed.
+    """
+    def __init__(self, params=None, datasets=None, _larch=None, **kws):
+        Group.__init__(self)
+        self._larch = _larch
+        self.params = params
+        if isNamedClass(datasets, FeffitDataSet):
+            datasets = [datasets]
+        self.datasets = datasets
+        self.fit_kws = kws
+        self.reset()
+
+    def __repr__(self):
+        return '<FeffitSession Group: %s>' % self.__name__
+
+    def reset(self):
+        "forget best-fit values, covariance, and results of previous fits"
+        self.best_values = {}
+        self.covar = None
+        self.covar_vars = None
+        self.result = None
+        self.nfits = 0
+        self._model_key = None
+
+    def _param_key(self, par):
+        if isParameter(par):
+            return (par.expr, par.vary, par.min, par.max, par.value)
+        return repr(par)
+
+    def _get_model_key(self):
+        """key for the current state of the model"""
+        pars = []
+        for name in dir(self.params):
+            par = getattr(self.params, name)
+            if isParameter(par):
+                pars.append((name, self._param_key(par)))
+        dsets = []
+        for ds in self.datasets:
+            paths = tuple([(id(p), tuple([self._param_key(getattr(p, a, None))
+                                          for a in PATH_ATTRS]))
+                           for p in ds.pathlist])
+            dsets.append((id(ds), ds._prepare_key(), paths))
+        return (tuple(pars), tuple(dsets))
+
+    def fit(self, warm_start=True, **kws):
+        """run (or re-run) the fit, returning the fit results group.
+
+        Parameters:
+        ------------
+          warm_start: Flag to start from the best-fit values of the
+                      previous fit, for variables of the same name [True].
+          other keyword arguments are passed to feffit(), and override
+          those given when creating the session.
+        """
+        fit_kws = dict(self.fit_kws)
+        fit_kws.update(kws)
+        if (self.result is not None and not kws and
+            self._get_model_key() == self._model_key):
+            return self.result
+
+        for ds in self.datasets:
+            if not ds.is_prepared():
+                ds.prepare_fit()
+        if warm_start:
+            for name, val in self.best_values.items():
+                par = getattr(self.params, name, None)
+                if isParameter(par) and par.vary:
+                    par.value = val
+
+        result = feffit(self.params, self.datasets, _larch=self._larch,
+                        **fit_kws)
+        if result is None:
+            return
+        self.nfits += 1
+        self.result = result
+        self.best_values = {}
+        for name in result.fit.var_names:
+            self.best_values[name] = getattr(self.params, name).value
+        self.covar = getattr(self.params, 'covar', None)
+        self.covar_vars = getattr(self.params, 'covar_vars', None)
+        self._model_key = self._get_model_key()
+        return result
+
+@ValidateLarchPlugin
+def feffit_session(params, datasets, _larch=None, **kws):
+    """create a Feffit session, for repeated fits of a model
+
+     Parameters:
+     ------------
+      params:    group containing parameters for fit
+      datasets:  Feffit Dataset group or list of Feffit Dataset group.
+      other keyword arguments are passed to feffit() for each fit.
+
+     Returns:
+     ----------
+      a Feffit session group.  Use its fit() method to run a fit,
+      which warm-starts from the results of the previous fit.
+
+    """
+    return FeffitSession(params=params, datasets=datasets,
+                         _larch=_larch, **kws)
+
 @ValidateLarchPlugin
 def feffit_report(result, min_correl=0.1, with_paths=True,
                   _larch=None):
@@ -566,6 +878,9 @@ def feffit_report(result, min_correl=0.1, with_paths=True,
         out.append('   epsilon_k          = %s'  % eps_k)
         out.append('   epsilon_r          = %s'  % eps_r)
         out.append('   n_independent      = %.3f'  % (ds.n_idp))
+        if getattr(ds, 'nresid', 0) > 0:
+            out.append('   residual calls     = %i (%.3f sec)' % (ds.nresid,
+                                                              ds.resid_time))
 
         #
     out.append(' ')
@@ -631,4 +946,5 @@ def registerLarchPlugin():
     return ('_xafs', {'feffit': feffit,
                       'feffit_dataset': feffit_dataset,
                       'feffit_transform': feffit_transform,
+                      'feffit_session': feffit_session,
                       'feffit_report': feffit_report})
@@ -48,6 +48,12 @@ def find_e0(energy, mu=None, group=None, _larch=None):
                                          fcn_name='find_e0')
 
     energy = remove_dups(energy)
+    if np.ndim(mu) == 2:
+        e0 = energy[_find_ie0_stack(energy, mu)]
+        if group is not None:
+            group = set_xafsGroup(group, _larch=_larch)
+            group.e0 = e0
+        return e0
     dmu = np.gradient(mu)/np.gradient(energy)
     # find points of high derivative
     high_deriv_pts = np.where(dmu >  max(dmu)*0.05)[0]
@@ -64,6 +70,35 @@ def find_e0(energy, mu=None, group=None, _larch=None):
         group.e0 = e0
     return e0
 
+def _gradient_rows(mu):
+    """np.gradient() along the last axis of a 2-D array"""
+    dmu = np.empty(mu.shape, dtype='float64')
+    dmu[:, 1:-1] = (mu[:, 2:] - mu[:, :-2])/2.0
+    dmu[:, 0]  = mu[:, 1] - mu[:, 0]
+    dmu[:, -1] = mu[:, -1] - mu[:, -2]
+    return dmu
+
+def _find_ie0_stack(energy, mu):
+    """index of e0 for each row of a (nspectra, npts) mu array,
+    using the same test as find_e0(): the point of maximum positive
+    derivative for which both neighbors also have a derivative above
+    5% of the maximum.
+    """
+    mu = np.atleast_2d(mu)
+    dmu = _gradient_rows(mu)/np.gradient(energy)
+    high = dmu > 0.05*dmu.max(axis=1)[:, np.newaxis]
+    valid = np.zeros(high.shape, dtype=bool)
+    valid[:, 1:-1] = high[:, 1:-1] & high[:, :-2] & high[:, 2:]
+    valid &= (dmu > 0)
+    return np.where(valid, dmu, 0).argmax(axis=1)
+
+def _index_nearest_stack(energy, values):
+    """index_nearest() for an array of values on a sorted energy array"""
+    values = np.asarray(values)
+    i = np.clip(np.searchsorted(energy, values), 1, len(energy)-1)
+    lower = (values - energy[i-1]) <= (energy[i] - values)
+    return i - lower.astype(int)
+
 def flat_resid(pars):
     c0, c1, c2 =  pars.c0.value,  pars.c1.value,  pars.c2.value
     return  (pars.mu - (c0 + pars.en * (c1 + pars.en * c2)))
@@ -175,6 +210,133 @@ def preedge(energy, mu, e0=None, step=None,
 
     return out
 
+def preedge_stack(energy, mu, e0=None, step=None,
+                  nnorm=3, nvict=0, pre1=None, pre2=-50,
+                  norm1=100, norm2=None, make_flat=False):
+    """pre edge subtraction, normalization for a stack of XAFS spectra
+    sharing one energy array (straight python)
+
+    This does the same steps as preedge(), but for a 2-D mu array of
+    shape (nspectra, npts).  Spectra are grouped by the energy index
+    of their E0, and the pre-edge line, post-edge polynomial (and
+    optionally the flattening quadratic) for each group are found with
+    a single least-squares solve over all spectra in the group.
+
+    Arguments
+    ----------
+    energy:  array of x-ray energies, in eV
+    mu:      2-D array of mu(E), shape (nspectra, npts)
+    e0:      edge energy, in eV: a scalar, an array of length nspectra,
+             or None to determine it for each spectrum.
+    step:    edge jump: a scalar, an array, or None to determine it.
+    make_flat: whether to also calculate flattened spectra.
+
+    other arguments are as for preedge()
+
+    Returns
+    -------
+      dictionary with elements
+          e0          array of energy origins in eV
+          edge_step   array of edge steps
+          norm        normalized mu(E), shape (nspectra, npts)
+          flat        flattened mu(E), if make_flat is True
+          pre_edge    determined pre-edge curves
+          post_edge   determined post-edge, normalization curves
+          precoefs    pre-edge (slope, offset) for each spectrum
+          norm_coefs  post-edge polynomial coefficients, (nspectra, nnorm+1)
+          pre1, pre2, norm1, norm2  arrays of the fit ranges used for
+                      each spectrum, relative to its E0
+
+    Notes
+    -----
+      the pre-edge fit ignores energy points that are NaN for any
+      spectrum in a group.
+
+      the flattening quadratic is an exact linear least-squares fit.
+      pre_edge() for a single spectrum fits it with Minimizer, which
+      stops within its tolerance, so that flat for one spectrum may
+      differ from this by ~1.e-2.
+    """
+    energy = remove_dups(energy)
+    mu = np.atleast_2d(np.asarray(mu, dtype='float64'))
+    nspec, npts = mu.shape
+    nnorm = max(min(nnorm, MAX_NNORM), 1)
+
+    ie0 = _find_ie0_stack(energy, mu)
+    if e0 is not None:
+        e0 = e0 * np.ones(nspec)
+        inrange = (e0 >= energy[0]) & (e0 <= energy[-1])
+        ie0 = np.where(inrange, _index_nearest_stack(energy, e0), ie0)
+
+    omu = mu*energy**nvict
+    epow = np.array([energy**(n-nvict) for n in range(nnorm+1)])
+    pre_edge  = np.empty(mu.shape, dtype='float64')
+    post_edge = np.empty(mu.shape, dtype='float64')
+    precoefs  = np.empty((nspec, 2), dtype='float64')
+    norm_coefs = np.empty((nspec, nnorm+1), dtype='float64')
+    flat = None
+    if make_flat:
+        flat = np.empty(mu.shape, dtype='float64')
+    edge_step = np.empty(nspec, dtype='float64')
+    ranges = np.empty((4, nspec), dtype='float64')
+
+    for ie in np.unique(ie0):
+        rows = np.where(ie0 == ie)[0]
+        e0val = energy[ie]
+        pre1_, pre2_, norm1_, norm2_ = pre1, pre2, norm1, norm2
+        if pre1_ is None:  pre1_  = min(energy) - e0val
+        if norm2_ is None: norm2_ = max(energy) - e0val
+        if norm2_ < 0:     norm2_ = max(energy) - e0val - norm2_
+        pre1_  = max(pre1_,  (min(energy) - e0val))
+        norm2_ = min(norm2_, (max(energy) - e0val))
+        if pre1_ > pre2_:
+            pre1_, pre2_ = pre2_, pre1_
+        if norm1_ > norm2_:
+            norm1_, norm2_ = norm2_, norm1_
+        ranges[:, rows] = np.array([pre1_, pre2_, norm1_, norm2_])[:, None]
+
+        p1 = index_of(energy, pre1_+e0val)
+        p2 = index_nearest(energy, pre2_+e0val)
+        if p2-p1 < 2:
+            p2 = min(len(energy), p1 + 2)
+        ex, mx = energy[p1:p2], omu[rows, p1:p2].T
+        good = np.isfinite(mx).all(axis=1)
+        coefs = polyfit(ex[good], mx[good], 1)
+        precoefs[rows] = coefs.T
+        pre_edge[rows] = np.outer(coefs[0], energy) + coefs[1][:, np.newaxis]
+        pre_edge[rows] *= energy**(-nvict)
+
+        n1 = index_of(energy, norm1_+e0val)
+        n2 = index_nearest(energy, norm2_+e0val)
+        if n2-n1 < 2:
+            n2 = min(len(energy), n1 + 2)
+        coefs = polyfit(energy[n1:n2], omu[rows, n1:n2].T, nnorm)[::-1]
+        norm_coefs[rows] = coefs.T
+        post_edge[rows] = np.dot(coefs.T, epow)
+        edge_step[rows] = post_edge[rows, ie] - pre_edge[rows, ie]
+        if step is not None:
+            edge_step[rows] = (step * np.ones(nspec))[rows]
+
+        if make_flat:
+            norm = (mu[rows] - pre_edge[rows])/edge_step[rows, np.newaxis]
+            flat[rows] = norm
+            if n2-n1 > 4:
+                coefs = polyfit(energy[n1:n2], norm[:, n1:n2].T, 2)
+                diff = np.dot(coefs.T, np.array([energy**2, energy,
+                                                 np.ones(npts)]))
+                diff -= diff[:, ie:ie+1]
+                flat[rows, ie:] -= diff[:, ie:]
+
+    norm = (mu - pre_edge)/edge_step[:, np.newaxis]
+    out = {'e0': energy[ie0], 'edge_step': edge_step, 'norm': norm,
+           'pre_edge': pre_edge, 'post_edge': post_edge,
+           'norm_coefs': norm_coefs, 'nvict': nvict,
+           'nnorm': nnorm, 'pre1': ranges[0], 'pre2': ranges[1],
+           'norm1': ranges[2], 'norm2': ranges[3], 'precoefs': precoefs}
+    if make_flat:
+        out['flat'] = flat
+    return out
+
 @ValidateLarchPlugin
 def pre_edge(energy, mu=None, group=None, e0=None, step=None,
              nnorm=3, nvict=0, pre1=None, pre2=-50,
@@ -231,10 +393,38 @@ def pre_edge(energy, mu=None, group=None, e0=None, step=None,
      2 If the first argument is a Group, it must contain 'energy' and 'mu'.
        If it exists, group.e0 will be used as e0.
        See First Argrument Group in Documentation
+
+     3 mu can be a 2-D array of shape (nspectra, npts) sharing one energy
+       array.  In that case, preedge_stack() is used and e0, edge_step,
+       pre_slope, pre_offset, pre1, pre2, norm1, norm2 are arrays of
+       length nspectra, while norm, flat, pre_edge, post_edge, and dmude
+       have the shape of mu.  flat uses an exact least-squares quadratic,
+       and may differ by ~1.e-2 from flat for a single spectrum.
     """
     energy, mu, group = parse_group_args(energy, members=('energy', 'mu'),
                                          defaults=(mu,), group=group,
                                          fcn_name='pre_edge')
+    if np.ndim(mu) == 2:
+        energy = remove_dups(energy)
+        pre_dat = preedge_stack(energy, mu, e0=e0, step=step, nnorm=nnorm,
+                                nvict=nvict, pre1=pre1, pre2=pre2,
+                                norm1=norm1, norm2=norm2, make_flat=make_flat)
+        group = set_xafsGroup(group, _larch=_larch)
+        group.e0 = pre_dat['e0']
+        group.norm = pre_dat['norm']
+        group.flat = pre_dat.get('flat', pre_dat['norm'])
+        group.dmude = _gradient_rows(np.asarray(mu))/np.gradient(energy)
+        for attr in ('nvict', 'nnorm', 'norm1', 'norm2', 'pre1', 'pre2',
+                     'edge_step', 'pre_edge', 'post_edge'):
+            setattr(group, attr, pre_dat[attr])
+        group.pre_slope  = pre_dat['precoefs'][:, 0]
+        group.pre_offset = pre_dat['precoefs'][:, 1]
+        for i in range(MAX_NNORM):
+            if hasattr(group, 'norm_c%i' % i):
+                delattr(group, 'norm_c%i' % i)
+        for i, c in enumerate(pre_dat['norm_coefs'].T):
+            setattr(group, 'norm_c%i' % i, c)
+        return
     pre_dat = preedge(energy, mu, e0=e0, step=step, nnorm=nnorm,
                       nvict=nvict, pre1=pre1, pre2=pre2, norm1=norm1,
                       norm2=norm2)
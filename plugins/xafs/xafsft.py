@@ -2,6 +2,7 @@
 """
   XAFS Fourier transforms
 """
+import threading
 import numpy as np
 from numpy import (pi, arange, zeros, ones, sin, cos,
                    exp, log, sqrt, where, interp, linspace)
@@ -24,6 +25,25 @@ from grouputils import parse_group_args
 MODNAME = '_xafs'
 VALID_WINDOWS = ['han', 'fha', 'gau', 'kai', 'par', 'wel', 'sin', 'bes']
 
+# zero-padded work arrays for xftf_fast / xftr_fast, one set per thread
+_ftbuffers = threading.local()
+MAX_FTBUFFERS = 8
+
+def _ftbuffer(shape, npts):
+    """return a complex work array of the given shape, zero past npts
+    along the last axis.  Arrays are re-used between calls in the same
+    thread, and only the points last written need to be cleared."""
+    cache = getattr(_ftbuffers, 'cache', None)
+    if cache is None or len(cache) > MAX_FTBUFFERS:
+        cache = _ftbuffers.cache = {}
+    buff, nlast = cache.get(shape, (None, 0))
+    if buff is None:
+        buff = zeros(shape, dtype='complex128')
+    elif nlast > npts:
+        buff[..., npts:nlast] = 0
+    cache[shape] = (buff, npts)
+    return buff
+
 def ftwindow(x, xmin=None, xmax=None, dx=1, dx2=None,
              window='hanning', _larch=None, **kws):
     """
@@ -303,18 +323,21 @@ def xftf_fast(chi, nfft=2048, kstep=0.05, _larch=None, **kws):
 
     Parameters:
     ------------
-      chi:      1-d array of chi to be transformed
+      chi:      1-d array of chi to be transformed, or 2-d array
+                of many chi, each along the last axis.
       nfft:     value to use for N_fft (2048).
       kstep:    value to use for delta_k (0.05).
 
     Returns:
     --------
-      complex 1-d array chi(R)
+      complex 1-d array chi(R), or 2-d array for 2-d input.
 
     """
-    cchi = zeros(nfft, dtype='complex128')
-    cchi[0:len(chi)] = chi
-    return (kstep / sqrt(pi)) * fft(cchi)[:nfft/2]
+    chi = np.asarray(chi)
+    npts = chi.shape[-1]
+    cchi = _ftbuffer(chi.shape[:-1] + (nfft,), npts)
+    cchi[..., :npts] = chi
+    return (kstep / sqrt(pi)) * fft(cchi, axis=-1)[..., :nfft/2]
 
 def xftr_fast(chir, nfft=2048, kstep=0.05, _larch=None, **kws):
     """
@@ -327,19 +350,22 @@ def xftr_fast(chir, nfft=2048, kstep=0.05, _larch=None, **kws):
 
     Parameters:
     -------------
-      chir:     1-d array of chi(R) to be transformed
+      chir:     1-d array of chi(R) to be transformed, or 2-d array
+                of many chi(R), each along the last axis.
       nfft:     value to use for N_fft (2048).
       kstep:    value to use for delta_k (0.05).
 
     Returns:
     ----------
-      complex 1-d array for chi(q).
+      complex 1-d array for chi(q), or 2-d array for 2-d input.
 
     This is useful for repeated FTs, as inside loops.
     """
-    cchi = zeros(nfft, dtype='complex128')
-    cchi[0:len(chir)] = chir
-    return  (4*sqrt(pi)/kstep) * ifft(cchi)[:nfft/2]
+    chir = np.asarray(chir)
+    npts = chir.shape[-1]
+    cchi = _ftbuffer(chir.shape[:-1] + (nfft,), npts)
+    cchi[..., :npts] = chir
+    return  (4*sqrt(pi)/kstep) * ifft(cchi, axis=-1)[..., :nfft/2]
 
 
 def registerLarchPlugin():
@@ -474,6 +474,10 @@ def xray_delta_beta(material, density, energy, photo_only=False, _larch=None):
         beta  = beta_photo * scale
     return delta, beta, lamb_cm/(4*pi*beta)
 
+# xraydb is opened by get_xraydb() when first needed, so that this
+# plugin can be imported on first use rather than at startup
+LARCH_LAZY_INIT = True
+
 def initializeLarchPlugin(_larch=None):
     """initialize xraydb"""
     if _larch is not None:
@@ -141,6 +141,11 @@ Example:
 ...>ocr_cor[j] = counts_cor[j].sum()/lt
 >>pyplot.plot(x,ocr)
 >>pyplot.plot(x,ocr_cor)
+
+# or, for all points and detectors at once, with counts as (npts, ndet, nchan)
+# and rt, lt as (npts, ndet):
+>>factors = deadtime_factors(rt, lt, counts.sum(axis=2), tau=get_taus('xspress3'))
+>>counts_cor = correct_counts(counts, factors)
 """
 
 ##############################################################################
@@ -149,8 +154,13 @@ import numpy as np
 import scipy
 from scipy.optimize import leastsq
 from scipy.stats import linregress
+from scipy.special import lambertw
 
 E_INV = np.exp(-1)
+TINY_TIME = 1.e-12
+
+# tables of deadtime tau values (in seconds) for each detector element
+TAU_TABLES = {'xspress3': [109.e-9, 91.e-9, 99.e-9, 98.e-9]}
 
 ##############################################################################
 def correction_factor(rt, lt, icr=None, ocr=None):
@@ -235,6 +245,113 @@ def calc_icr(ocr, tau):
         icr = None
     return icr
 
+##############################################################################
+# Array-based deadtime engine: ocr, icr, counts, and times are arrays of
+# shape (npix, ndet) -- or anything that broadcasts with one tau per
+# detector -- so that a whole map or scan is corrected at once.
+
+def get_taus(name, ndet=None):
+    """array of tau values for detector elements, from TAU_TABLES.
+
+    name may also be a sequence of tau values.  With ndet given, the
+    table is repeated as needed to give ndet values.
+    """
+    taus = name
+    if isinstance(name, str):
+        if name not in TAU_TABLES:
+            raise ValueError("no deadtime tau table for '%s'" % name)
+        taus = TAU_TABLES[name]
+    taus = np.atleast_1d(np.asarray(taus, dtype='f8'))
+    if ndet is not None:
+        taus = np.resize(taus, ndet)
+    return taus
+
+def icr_newton(ocr, tau, maxiter=100, tol=1.e-8, icr_max=None):
+    """solve ocr = icr*exp(-icr*tau) for icr by Newton's method,
+    stepping up from icr = ocr toward the lower root.
+
+    Iteration stops when all relative steps are below tol (tol=0 runs
+    all maxiter steps).  icr_max, if given, caps icr at each step.
+    """
+    ocr = np.asarray(ocr, dtype='f8')
+    tau = np.asarray(tau, dtype='f8')
+    icr = 1.0*ocr
+    for i in range(maxiter):
+        delta = (icr - ocr*np.exp(icr*tau))/(icr*tau - 1)
+        delta = np.where(delta < 0, 0.0, delta)
+        icr = icr + delta
+        if icr_max is not None:
+            icr = np.minimum(icr, icr_max)
+        if tol > 0 and np.all(delta <= tol*np.abs(icr)):
+            break
+    return icr
+
+def icr_estimate(ocr, tau, method='lambertw', maxiter=100, tol=1.e-8):
+    """true input count rate from output count rate and deadtime tau,
+    inverting ocr = icr*exp(-icr*tau) on its lower branch.
+
+    Parameters:
+    -----------
+    * ocr    = array of output count rates, as (npix, ndet)
+    * tau    = deadtime (1/count rate units), scalar or one per detector
+    * method = 'lambertw' for the closed form icr = -W(-ocr*tau)/tau,
+               or 'newton' for iteration with maxiter and tol
+
+    Output count rates above the maximum, 1/(e*tau), give icr = 1/tau.
+    Where tau <= 0, icr = ocr.
+    """
+    ocr = np.asarray(ocr, dtype='f8')
+    tau = np.asarray(tau, dtype='f8')
+    ocr, tau = np.broadcast_arrays(ocr, tau)
+    icr = 1.0*ocr
+    use = tau > 0
+    if not use.any():
+        return icr
+    otau = np.where(use, ocr*tau, 0.0)
+    over = use & (otau >= E_INV)
+    calc = use & ~over
+    if method == 'lambertw':
+        icr[calc] = -lambertw(-otau[calc], 0).real/tau[calc]
+    elif method == 'newton':
+        icr[calc] = icr_newton(ocr[calc], tau[calc], maxiter=maxiter,
+                               tol=tol, icr_max=1.0/tau[calc])
+    else:
+        raise ValueError("unknown icr method '%s'" % method)
+    icr[over] = 1.0/tau[over]
+    return icr
+
+def deadtime_factors(realtime, livetime, outcounts, inpcounts=None,
+                     tau=None, time_units=1.0, method='lambertw'):
+    """deadtime correction factors, (icr/ocr)*(rt/lt), for arrays of
+    real time, live time and output counts, as (npix, ndet).
+
+    If inpcounts is not given, it is estimated from the output count
+    rate with tau (in seconds, scalar or one per detector), with times
+    in units of time_units seconds.  If neither is given, only the live
+    time correction is made.  Factors are computed without loops, and
+    are safe for zero counts or times.
+    """
+    outcounts = np.asarray(outcounts, dtype='f8')
+    livetime  = np.asarray(livetime, dtype='f8')
+    if inpcounts is None:
+        inpcounts = outcounts
+        if tau is not None:
+            ltime = np.maximum(livetime*time_units, TINY_TIME)
+            icr = icr_estimate(outcounts/ltime, tau, method=method)
+            inpcounts = icr*ltime
+    denom = outcounts*livetime
+    denom[np.where(denom < 1)] = 1.0
+    return inpcounts*realtime/denom
+
+def correct_counts(counts, factors):
+    """apply deadtime correction factors of shape (npix, ndet) to
+    counts of shape (npix, ndet) or spectra of (npix, ndet, nchan)"""
+    factors = np.asarray(factors)
+    if np.ndim(counts) > factors.ndim:
+        factors = factors.reshape(factors.shape +
+                                  (1,)*(np.ndim(counts) - factors.ndim))
+    return counts * factors
+
 ##############################################################################
 def fit_deadtime(mon, ocr, offset=True):
     """
@@ -117,15 +117,17 @@ HUGE = 1.E20
 MAX_TANGENT=2
 
 def compress_array(array, compress):
-   """Compresses an 1-D array by the integer factor "compress".
+   """Compresses an array by the integer factor "compress" along
+   its last axis.
    near equivalent of IDL's 'rebin'....
    """
-   if len(array) % compress != 0:
+   nchans = array.shape[-1]
+   if nchans % compress != 0:
       print( 'Warning compress must be integer divisor of array length')
       return None
 
-   temp = np.resize(array, (len(array)/compress, compress))
-   return np.sum(temp, 1)/compress
+   temp = np.reshape(array, array.shape[:-1] + (nchans/compress, compress))
+   return np.sum(temp, -1)/compress
 
 def expand_array(array, expand, sample=0):
    """Expands an 1-D array by the integer factor "expand".
@@ -149,6 +151,111 @@ def expand_array(array, expand, sample=0):
        temp[-i]=array[-1]
    return temp
 
+def _tangent_slopes(scratch):
+   """slopes of tangents at each channel but the last, for each
+   spectrum in the 2-D scratch array, as in XRFBackground.calc.
+
+   As in the original channel-by-channel loop, the slope at channel 0
+   of integer spectra uses integer division.
+   """
+   nspec, nchans = scratch.shape
+   chan  = np.arange(nchans-1)
+   chan0 = np.maximum(chan - MAX_TANGENT, 0)
+   chan1 = np.minimum(chan + MAX_TANGENT, nchans-1)
+   denom = np.maximum(chan, 1).astype(np.float)
+   tan_slope = 0.0
+   for off in range(-MAX_TANGENT, MAX_TANGENT+1):
+      j = chan + off
+      use = (j >= chan0) & (j <= chan1)
+      term = (scratch[:, :-1] - scratch[:, np.clip(j, 0, nchans-1)]) / denom
+      tan_slope = tan_slope + np.where(use, term, 0.0)
+   tan_slope = tan_slope / (chan1 - chan0)
+   if nchans > 1 and np.issubdtype(scratch.dtype, np.integer):
+      diff = scratch[:, :1] - scratch[:, :chan1[0]+1]
+      tan_slope[:, 0] = diff.sum(axis=1) // (chan1[0] - chan0[0])
+   return tan_slope
+
+def _bgr_envelope(scratch, max_index, power_funct, tangent=False,
+                  nbytes=2**23):
+   """envelope of concave-down power functions from below, for each
+   spectrum in the 2-D scratch array, giving the same result as
+   sliding the function across each channel as in XRFBackground.calc.
+
+   max_index is an array of half-widths of the function for each
+   spectrum, and power_funct is the uncompressed power function, of
+   length 2*nchans+1.  As in that loop, a spectrum with max_index < 0
+   (no function narrower than its maximum counts) gets the background
+   of channel c from the window at channel c-1 alone, so that it equals
+   the spectrum except for channel 0, which is -HUGE.  (The loop raised
+   an exception for a spectrum with only negative counts, which is
+   treated the same way here.)  Windows around each channel are strided views
+   of the spectra padded with +inf, and the maximum over functions
+   at each channel is taken over a skewed view of the amplitudes, so
+   each block of channels and spectra is handled without Python loops.
+   Temporary arrays stay under about nbytes.
+   """
+   as_strided = np.lib.stride_tricks.as_strided
+   nspec, nchans = scratch.shape
+   bckgnd = np.zeros((nspec, nchans)) + (np.arange(nchans, dtype=np.float) - HUGE)
+   mmax = max(0, max(max_index))
+   width = 2*mmax + 1
+   offsets = np.arange(width) - mmax
+
+   # power function for each spectrum, +inf outside its own width
+   pfunc = np.zeros((nspec, width)) + power_funct[nchans - 1 + offsets]
+   pfunc[abs(offsets)[None, :] > np.maximum(max_index, 0)[:, None]] = np.inf
+
+   spad = np.zeros((nspec, nchans + 2*width)) + np.inf
+   spad[:, width:width+nchans] = scratch
+   if tangent:
+      tan_slope = _tangent_slopes(scratch)
+   nblock = max(1, int(nbytes / (8*width)))
+   sblock = max(1, nblock // max(1, nchans-1))
+   cblock = max(1, min(nchans-1, nblock))
+   for s0 in range(0, nspec, sblock):
+      s1 = min(nspec, s0+sblock)
+      nb = s1 - s0
+      mind = np.maximum(max_index[s0:s1], 0)[:, None]
+      pf = pfunc[s0:s1, None, :]
+      for c0 in range(0, nchans-1, cblock):
+         c1 = min(nchans-1, c0+cblock)
+         cb = c1 - c0
+         lin_offset = scratch[s0:s1, c0:c1, None].astype(np.float)
+         if tangent:
+            chan  = np.arange(c0, c1)
+            chan0 = np.maximum(chan - mind, 0)
+            chan1 = np.maximum(np.minimum(chan + mind, nchans-1), chan0)
+            nc    = chan1 - chan0 + 1
+            pos   = ((chan[:, None] + offsets - chan0[:, :, None]).astype(np.float)
+                     - (nc/2)[:, :, None])
+            lin_offset = lin_offset + pos * tan_slope[s0:s1, c0:c1, None]
+
+         # maximum height of the function centered on each channel
+         sp = spad[s0:s1, width+c0-mmax:]
+         window = as_strided(sp, shape=(nb, cb, width),
+                             strides=(sp.strides[0], sp.strides[1], sp.strides[1]))
+         height = (window - lin_offset + pf).min(axis=2)
+
+         # function amplitudes at each channel, stored with rows of -inf
+         # before and after, so that amps[:, r, d] is for channel
+         # c0 - mmax + r from the function centered on channel c0 + r - d
+         test = np.zeros((nb, cb + 2*width, width)) - np.inf
+         test[:, width:width+cb, :] = height[:, :, None] + lin_offset - pf
+         t0 = test[:, width:, :]
+         amps = as_strided(t0, shape=(nb, cb+width-1, width),
+                           strides=(t0.strides[0], t0.strides[1],
+                                    t0.strides[2] - t0.strides[1]))
+         jlo, jhi = max(0, c0-mmax), min(nchans, c1+mmax)
+         r0 = jlo - (c0 - mmax)
+         amps = amps[:, r0:r0+jhi-jlo, :].max(axis=2)
+         bckgnd[s0:s1, jlo:jhi] = np.maximum(bckgnd[s0:s1, jlo:jhi], amps)
+
+   narrow = np.where(max_index < 0)[0]
+   if len(narrow) > 0:
+      bckgnd[narrow, :] = np.arange(nchans, dtype=np.float) - HUGE
+      bckgnd[narrow, 1:] = scratch[narrow, 1:]
+   return bckgnd
+
 class XRFBackground:
     """
     Class defining a spectrum background
@@ -182,7 +289,8 @@ class XRFBackground:
 
         Parameters:
         -----------
-        * data is the spectrum
+        * data is the spectrum, or a 2-D array of spectra, one per row,
+          for which bgr will also be 2-D
         * slope is the slope of conversion channels to energy
         """
 
@@ -194,9 +302,11 @@ class XRFBackground:
         tangent  = self.tangent
         compress = self.compress
 
-        nchans   = len(data)
-        self.bgr = np.zeros(nchans, dtype=np.int)
-        scratch  = data[:]
+        scratch  = np.asarray(data)
+        ndim     = scratch.ndim
+        scratch  = np.atleast_2d(scratch)
+        nchans   = scratch.shape[1]
+        self.bgr = np.zeros(scratch.shape, dtype=np.int)
 
         # Compress scratch spectrum
         if compress > 1:
@@ -208,63 +318,31 @@ class XRFBackground:
                 slope = slope * compress
                 nchans = nchans / compress
 
-        # Copy scratch spectrum to background spectrum
-        bckgnd = scratch[:]
-
         # Find maximum counts in input spectrum. This information is used to
         # limit the size of the function lookup table
-        max_counts = max(scratch)
-
-        # Fit functions which come up from below
-        bckgnd = np.arange(nchans, dtype=np.float) - HUGE
+        max_counts = scratch.max(axis=1)
 
         denom = max(TINY, (width / (2. * slope)**exponent))
 
         indices     = np.arange(nchans*2+1, dtype=np.float) - nchans
         power_funct = indices**exponent  * (REFERENCE_AMPL / denom)
-        power_funct = np.compress((power_funct <= max_counts), power_funct)
-        max_index   = len(power_funct)/2 - 1
-        # print( "NCHANS: ", nchans, denom, min(indices), max(indices), max_index)
-        for chan in range(nchans-1):
-            tan_slope = 0.
-            if tangent:
-                # Find slope of tangent to spectrum at this channel
-                chan0  = max((chan - MAX_TANGENT), 0)
-                chan1  = min((chan + MAX_TANGENT), (nchans-1))
-                denom  = chan - np.arange(chan1 - chan0 + 1, dtype=np.float)
-                # is this correct?
-                denom   = max(max(denom), 1)
-                tan_slope = (scratch[chan] - scratch[chan0:chan1+1]) / denom
-                tan_slope = np.sum(tan_slope) / (chan1 - chan0)
-
-            chan0 = max((chan - max_index), 0)
-            chan1 = min((chan + max_index), (nchans-1))
-            chan1 = max(chan1, chan0)
-            nc    = chan1 - chan0 + 1
-            lin_offset = scratch[chan] + (np.arange(float(nc)) - nc/2) * tan_slope
+        nfunct      = (power_funct[None, :] <= max_counts[:, None]).sum(axis=1)
+        max_index   = nfunct/2 - 1
 
-            # Find the maximum height of a function centered on this channel
-            # such that it is never higher than the counts in any channel
-            f      = chan0 - chan + max_index
-            l      = chan1 - chan + max_index
-            test   = scratch[chan0:chan1+1] - lin_offset + power_funct[f:l+1]
-            height = min(test)
-
-            # We now have the function height. Set the background to the
-            # height of the maximum function amplitude at each channel
-
-            test = height + lin_offset - power_funct[f:l+1]
-            sub  = bckgnd[chan0:chan1+1]
-            bckgnd[chan0:chan1+1] = np.maximum(sub, test)
+        # Fit functions which come up from below
+        bckgnd = _bgr_envelope(scratch, max_index, power_funct,
+                               tangent=tangent)
 
         # Expand spectrum
         if compress > 1:
-            bckgnd = expand_array(bckgnd, compress)
+            bckgnd = np.array([expand_array(b, compress) for b in bckgnd])
 
         # Bgr should be positive integers??
         bgr = bckgnd.astype(int)
         idx = np.where(bgr <= 0)
         bgr[idx] = 0
+        if ndim == 1:
+            bgr = bgr[0]
         self.bgr = bgr
 
 @ValidateLarchPlugin
@@ -280,7 +358,8 @@ def xrf_background(energy, counts=None, group=None, width=4,
     ---------
     energy     array of energies OR an MCA group.  If an MCA group,
                it will be used to give ``counts`` and ``mca`` arguments
-    counts     array of XRF counts (or MCA.counts)
+    counts     array of XRF counts (or MCA.counts), or a 2-D array
+               with one spectrum per row, giving a 2-D bgr
     group      group for outputs
 
     width      full width (in keV) of the concave down polynomials
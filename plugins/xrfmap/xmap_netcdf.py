@@ -64,9 +64,109 @@ class xMAPData(object):
 
 CLOCKTICK = 0.320  # xmap clocktick = 320 ns
 
-def read_xmap_netcdf(fname, npixels=None, verbose=False):
-    # Reads a netCDF file created with the DXP xMAP driver
-    # with the netCDF plugin buffers
+def _is_little(dtype):
+    return dtype.byteorder == '<' or (dtype.byteorder == '=' and
+                                      sys.byteorder == 'little')
+
+def _words_to_long(words):
+    """convert pairs of 16-bit words (low word first) along the last
+    axis to 32-bit ints"""
+    lo = words[..., 0].astype(np.int64) & 0xFFFF
+    hi = words[..., 1].astype(np.int64)
+    return (lo + (hi << 16)).astype(np.int32)
+
+def _pixel_dtype(word, mapmode, nchans, blocksize):
+    """structured dtype for one pixel block of an xMAP buffer.
+    Longs are int32 fields for little-endian words, or else pairs
+    of words to be combined with _words_to_long()"""
+    wsize = word.itemsize
+    if _is_little(word):
+        ltype, lshape = np.dtype('<i4'), ()
+    else:
+        ltype, lshape = word, (2,)
+    if mapmode == 1:  # mapping, full spectra
+        dtype, shape, offset = word, (4, nchans), 256
+    else:             # ROI mode
+        dtype, shape, offset = ltype, (4, nchans) + lshape, 64
+    return np.dtype({'names': ['times', 'data'],
+                     'formats': [(ltype, (4, 4) + lshape), (dtype, shape)],
+                     'offsets': [32*wsize, offset*wsize],
+                     'itemsize': blocksize*wsize})
+
+def decode_xmap_buffers(array_data):
+    """decode array_data from xMAP mapping mode, shaped
+    (narrays, nmodules, buffersize), into an xMAPData.
+
+    The buffers are viewed with a structured dtype, so that times and
+    spectra are strided views into array_data.  Full spectra are not
+    copied if there is a single buffer (one array and one module) that
+    is full.
+    """
+    array_data = np.ascontiguousarray(array_data)
+    if array_data.ndim == 1:
+        array_data = array_data.reshape((1, 1, array_data.shape[0]))
+    elif array_data.ndim == 2:
+        array_data = array_data.reshape((1,) + array_data.shape)
+    narrays, nmodules, buffersize = array_data.shape
+    word = array_data.dtype
+
+    head = array_data[0, 0]
+    modpixs   = max(124, int(head[8]))
+    blocksize = (buffersize-256)//modpixs
+    mapmode   = int(head[256+3])
+    if mapmode == 1:  # mapping, full spectra
+        nchans = int(head[20])
+    elif mapmode == 2:  # ROI mode:  nchans = number of ROIS !!
+        nchans = int(max(head[264:268]))
+    else:
+        raise ValueError('unsupported xMAP mapping mode %i' % mapmode)
+
+    pixtype = _pixel_dtype(word, mapmode, nchans, blocksize)
+    buftype = np.dtype({'names': ['pixels'],
+                        'formats': [(pixtype, (modpixs,))],
+                        'offsets': [256*word.itemsize],
+                        'itemsize': buffersize*word.itemsize})
+    pixels = array_data.view(buftype)[..., 0]['pixels']
+    times  = pixels['times']
+    counts = pixels['data']
+    if not _is_little(word):
+        times = _words_to_long(times)
+        if mapmode == 2:
+            counts = _words_to_long(counts)
+
+    # arrange as (narrays, npix, nmodules, ...), and keep only the
+    # pixels in use, as given by buffer headers for module 0
+    times  = times.swapaxes(1, 2)
+    counts = counts.swapaxes(1, 2)
+    npix = array_data[:, 0, 8].astype(int)
+    if (npix == modpixs).all():
+        npix_total = narrays*modpixs
+        times  = times.reshape((npix_total, 4*nmodules, 4))
+        counts = counts.reshape((npix_total, 4*nmodules, nchans))
+    else:
+        iarr, ipix = np.nonzero(np.arange(modpixs) < npix[:, None])
+        npix_total = len(iarr)
+        times  = times[iarr, ipix].reshape((npix_total, 4*nmodules, 4))
+        counts = counts[iarr, ipix].reshape((npix_total, 4*nmodules, nchans))
+
+    xmapdat = xMAPData(0, nmodules, 0)
+    xmapdat.firstPixel   = int(_words_to_long(head[9:11]))
+    xmapdat.numPixels    = npix_total
+    xmapdat.counts       = counts
+    xmapdat.realTime     = CLOCKTICK * times[:, :, 0]
+    xmapdat.liveTime     = CLOCKTICK * times[:, :, 1]
+    xmapdat.inputCounts  = times[:, :, 2]
+    xmapdat.outputCounts = times[:, :, 3]
+    return xmapdat
+
+def read_xmap_netcdf(fname, npixels=None, verbose=False, mmap=False):
+    """read a netCDF file created with the DXP xMAP driver
+    with the netCDF plugin buffers
+
+    By default, the file is read in a single pass and byte-swapped in
+    place.  With mmap=True, the file is memory-mapped, and the decoded
+    arrays are copied from the mapping before the file is closed.
+    """
     if verbose:
         print( ' reading ', fname)
     t0 = time.time()
@@ -74,12 +174,12 @@ def read_xmap_netcdf(fname, npixels=None, verbose=False):
     read_ok = False
     fh = None
     try:
-        fh = netcdf_open(fname,'r')
+        fh = netcdf_open(fname, 'r', mmap=mmap)
         read_ok = True
     except:
         time.sleep(0.010)
         try:
-            fh = netcdf_open(fname,'r')
+            fh = netcdf_open(fname, 'r', mmap=mmap)
             read_ok = True
         except:
             pass
@@ -88,78 +188,25 @@ def read_xmap_netcdf(fname, npixels=None, verbose=False):
         if fh is not None:
             fh.close()
         return None
-    
-    array_data = fh.variables['array_data']
-    t1 = time.time()
-
-    # array_data will normally be 3d:
-    #  shape = (narrays, nmodules, buffersize)
-    # but nmodules and narrays could be 1, so that
-    # array_data could be 1d or 2d.
-    #
-    # here we force the data to be 3d
-    shape = array_data.shape
-    if len(shape) == 1:
-        array_data.shape = (1, 1, shape[0])
-    elif len(shape) == 2:
-        array_data.shape = (1, shape[0], shape[1])
 
-    narrays, nmodules, buffersize = array_data.shape
-    modpixs    = max(124, array_data[0, 0, 8])
-    npix_total = 0
-    # real / live times are returned in microseconds.
-    for array in range(narrays):
-        for module in range(nmodules):
-            d   = array_data[array,module, :]
-            bh  = xMAPBufferHeader(d)
-            #if verbose and array==0:
-            dat = d[256:].reshape(modpixs, (d.size-256)/modpixs )
-
-            npix = bh.numPixels
-            if module == 0:
-                npix_total += npix
-                if array == 0:
-                    # first time through, (array,module)=(0,0) we
-                    # read mapping mode, set up how to slice the
-                    # data, and build data arrays in xmapdat
-                    mapmode = dat[0, 3]
-                    if mapmode == 1:  # mapping, full spectra
-                        nchans = d[20]
-                        data_slice = slice(256, 8448)
-                    elif mapmode == 2:  # ROI mode
-                        # Note:  nchans = number of ROIS !!
-                        nchans     = max(d[264:268])
-                        data_slice = slice(64, 64+8*nchans)
-                    xmapdat = xMAPData(narrays*modpixs, nmodules, nchans)
-                    xmapdat.firstPixel = bh.startingPixel
-
-            # acquistion times and i/o counts data are stored
-            # as longs in locations 32:64
-            t_times = aslong(dat[:npix, 32:64]).reshape(npix, 4, 4)
-            p1 = npix_total - npix
-            p2 = npix_total
-            xmapdat.realTime[p1:p2, :]     = t_times[:, :, 0]
-            xmapdat.liveTime[p1:p2, :]     = t_times[:, :, 1]
-            xmapdat.inputCounts[p1:p2, :]  = t_times[:, :, 2]
-            xmapdat.outputCounts[p1:p2, :] = t_times[:, :, 3]
-
-            # the data, extracted as per data_slice and mapmode
-            t_data = dat[:npix, data_slice]
-            if mapmode == 2:
-                t_data = aslong(t_data)
-            xmapdat.counts[p1:p2, :, :] = t_data.reshape(npix, 4, nchans)
+    array_data = fh.variables['array_data'].data
+    if (not mmap and array_data.flags.writeable and
+        not array_data.dtype.isnative):
+        array_data = array_data.byteswap(True)
+        array_data = array_data.view(array_data.dtype.newbyteorder())
+    t1 = time.time()
 
+    xmapdat = decode_xmap_buffers(array_data)
+    if mmap:
+        for attr in ('counts', 'realTime', 'liveTime',
+                     'inputCounts', 'outputCounts'):
+            setattr(xmapdat, attr, np.array(getattr(xmapdat, attr)))
+    del array_data
     t2 = time.time()
-    xmapdat.numPixels = npix_total
-    xmapdat.counts    = xmapdat.counts[:npix_total]
-    xmapdat.realTime = CLOCKTICK * xmapdat.realTime[:npix_total]
-    xmapdat.liveTime = CLOCKTICK * xmapdat.liveTime[:npix_total]
-    xmapdat.inputCounts  = xmapdat.inputCounts[:npix_total]
-    xmapdat.outputCounts = xmapdat.outputCounts[:npix_total]
     if verbose:
         print('   time to read file    = %5.1f ms' % ((t1-t0)*1000))
         print('   time to extract data = %5.1f ms' % ((t2-t1)*1000))
-        print('   read %i pixels ' %  npix_total)
+        print('   read %i pixels ' %  xmapdat.numPixels)
         print('   data shape:    ' ,  xmapdat.counts.shape)
     fh.close()
     return xmapdat
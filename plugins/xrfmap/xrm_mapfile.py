@@ -2,12 +2,14 @@ import sys
 import os
 import socket
 import time
+import threading
 import h5py
 import numpy as np
 import scipy.stats as stats
 import json
 import larch
 from larch import use_plugin_path
+from larch.utils import OrderedDict
 from larch.utils.debugtime import debugtime
 
 use_plugin_path('io')
@@ -17,15 +19,41 @@ use_plugin_path('xrfmap')
 from fileutils import nativepath, new_filename
 from mca import MCA
 from roi import ROI
+from deadtime import deadtime_factors, correct_counts
 
 from configfile import FastMapConfig
 from xmap_netcdf import read_xmap_netcdf
-from xsp3_hdf5 import read_xsp3_hdf5
+from xsp3_hdf5 import read_xsp3_hdf5, pixel_blocks
 from asciifiles import (readASCII, readMasterFile, readROIFile,
                         readEnvironFile, parseEnviron)
 
 NINIT = 32
+NREAD_THREADS = 4  # threads for reading rows of raw data
+NAREA_CACHE = 2048 # number of cached spectra sums for chunks of map areas
 COMPRESSION_LEVEL = 4 # compression level
+
+# HDF5 storage profiles for the XRF spectra ('counts') of each detector:
+#   chunks:      'default' for (1, nx, nchan-block) chunks, 'row' for one
+#                row per chunk, 'spectrum' for chunks of full spectra for
+#                small tiles of pixels, or an explicit tuple.
+#   compression: 'gzip' (with compression_opts as level), 'lzf', or None
+#   shuffle:     whether to use the HDF5 shuffle filter
+#   dtype:       initial data type for counts
+#   promote:     whether to promote dtype to int32 when counts overflow it,
+#                otherwise counts are clipped to the largest value.
+STORAGE_PROFILES = {
+    'default':  {'chunks': 'default', 'compression': 'gzip',
+                 'compression_opts': COMPRESSION_LEVEL, 'shuffle': False,
+                 'dtype': 'int16', 'promote': True},
+    'row':      {'chunks': 'row', 'compression': 'lzf',
+                 'compression_opts': None, 'shuffle': True,
+                 'dtype': 'int16', 'promote': True},
+    'spectrum': {'chunks': 'spectrum', 'compression': 'lzf',
+                 'compression_opts': None, 'shuffle': True,
+                 'dtype': 'int16', 'promote': True},
+    'none':     {'chunks': 'row', 'compression': None,
+                 'compression_opts': None, 'shuffle': False,
+                 'dtype': 'int16', 'promote': True}}
 DEFAULT_ROOTNAME = 'xrfmap'
 
 class GSEXRM_FileStatus:
@@ -153,6 +181,66 @@ def create_xrfmap(h5root, root=None, dimension=2,
         conf.create_group(name)
     h5root.flush()
 
+def channel_csum(counts, step=1, dtype=np.int32):
+    """cumulative sum of counts over channels (the last axis), taken
+    every step channels, with element j being the sum of channels
+    below j*step.  The last axis of the output has nchan/step+1 elements.
+    """
+    nchan = counts.shape[-1]
+    out = np.zeros(counts.shape[:-1] + (nchan//step + 1,), dtype=dtype)
+    csum = np.cumsum(counts, axis=-1, dtype=dtype)
+    out[..., 1:] = csum[..., step-1::step][..., :nchan//step]
+    return out
+
+def get_storage_profile(storage=None):
+    """return HDF5 storage profile for XRF spectra, given the name of
+    a profile in STORAGE_PROFILES, a dict of settings to change from
+    the 'default' profile, or None for the 'default' profile"""
+    profile = dict(STORAGE_PROFILES['default'])
+    if storage is None:
+        return profile
+    if isinstance(storage, dict):
+        profile.update(storage)
+        return profile
+    if storage not in STORAGE_PROFILES:
+        raise GSEXRM_Exception("unknown storage profile '%s'" % storage)
+    profile.update(STORAGE_PROFILES[storage])
+    return profile
+
+def counts_dataset_kws(profile, npts, nchan, chunks=None, maxbytes=2**22):
+    """keyword arguments for h5py create_dataset() for a counts array
+    of shape (nrow, npts, nchan), using a storage profile.
+
+    chunks, if given, overrides the profile chunks.  Chunks hold no more
+    than about maxbytes.
+    """
+    dtype = np.dtype(profile.get('dtype', 'int16'))
+    if chunks is None:
+        chunks = profile.get('chunks', 'default')
+    if chunks == 'default':
+        nxx = min(npts-1, 2**int(np.log2(npts)))
+        nxm = 1024
+        if nxx > 256:
+            nxm = min(1024, int(65536*1.0/ nxx))
+        chunks = (1, max(1, nxx), min(nchan, nxm))
+    elif chunks == 'row':
+        nx = max(1, min(npts, int(maxbytes/(nchan*dtype.itemsize))))
+        chunks = (1, nx, nchan)
+    elif chunks == 'spectrum':
+        npix = max(1, int(2**18/(nchan*dtype.itemsize)))
+        nx = max(1, min(npts, 2**int(np.log2(npix)/2.0 + 1)))
+        chunks = (max(1, npix//nx), nx, nchan)
+    chunks = tuple([max(1, min(c, n)) for c, n in
+                    zip(chunks, (chunks[0], npts, nchan))])
+    kws = {'dtype': dtype, 'chunks': chunks,
+           'maxshape': (None, npts, nchan),
+           'compression': profile.get('compression', None),
+           'shuffle': profile.get('shuffle', False)}
+    if kws['compression'] == 'gzip':
+        kws['compression_opts'] = profile.get('compression_opts',
+                                              COMPRESSION_LEVEL)
+    return kws
+
 class GSEXRM_Exception(Exception):
     """GSEXRM Exception: General Errors"""
     def __init__(self, msg):
@@ -169,6 +257,11 @@ class GSEXRM_NotOwner(Exception):
     def __str__(self):
         return self.msg
 
+class _ReadError(object):
+    "exception info for a row that could not be read"
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
 class GSEXRM_MapRow:
     """
     read one row worth of data:
@@ -180,8 +273,10 @@ class GSEXRM_MapRow:
 
         self.nrows_expected = nrows_expected
         xrf_reader = read_xmap_netcdf
+        reader_kws = {}
         if xmapfile.startswith('xsp'):
             xrf_reader = read_xsp3_hdf5
+            reader_kws['lazy'] = True
         # print 'MapRow: ', xrf_reader, xmapfile, self.nrows_expected
 
         self.npts = npts
@@ -203,7 +298,8 @@ class GSEXRM_MapRow:
         while atime < 0 and time.time()-t0 < 10:
             try:
                 atime = os.stat(xmfile).st_ctime
-                xmapdat = xrf_reader(xmfile, npixels=self.nrows_expected, verbose=False)
+                xmapdat = xrf_reader(xmfile, npixels=self.nrows_expected,
+                                     verbose=False, **reader_kws)
             except (IOError, IndexError):
                 time.sleep(0.010)
 
@@ -221,9 +317,9 @@ class GSEXRM_MapRow:
         self.livetime  = (xmapdat.liveTime[:]).astype('int')
         self.realtime  = (xmapdat.realTime[:]).astype('int')
 
-        dt_denom = xmapdat.outputCounts*xmapdat.liveTime
-        dt_denom[np.where(dt_denom < 1)] = 1.0
-        self.dtfactor  = xmapdat.inputCounts*xmapdat.realTime/dt_denom
+        self.dtfactor  = deadtime_factors(xmapdat.realTime, xmapdat.liveTime,
+                                          xmapdat.outputCounts,
+                                          inpcounts=xmapdat.inputCounts)
 
         gnpts, ngather  = gdata.shape
         snpts, nscalers = sdata.shape
@@ -241,8 +337,13 @@ class GSEXRM_MapRow:
             snpts = self.npts
         self.sisdata = sdata[:self.npts]
 
+        # read spectra for the pixels of this row in their native dtype.
+        # All of them are held, as they are written to the map file.
+        self.counts = self.counts[:self.npts]
+        if reader_kws.get('lazy', False):
+            xmapdat.close()
+
         if xnpts > self.npts:
-            self.counts  = self.counts[:self.npts]
             self.realtime = self.realtime[:self.npts]
             self.livetime = self.livetime[:self.npts]
             self.dtfactor = self.dtfactor[:self.npts]
@@ -268,15 +369,12 @@ class GSEXRM_MapRow:
         self.posvals.append(self.realtime.sum(axis=1).astype('float32') / nmca)
         self.posvals.append(self.livetime.sum(axis=1).astype('float32') / nmca)
 
-        total = None
-        for imca in range(nmca):
-            dtcorr = self.dtfactor[:, imca].astype('float32')
-            cor   = dtcorr.reshape((dtcorr.shape[0], 1))
-            if total is None:
-                total = self.counts[:, imca, :] * cor
-            else:
-                total = total + self.counts[:, imca, :] * cor
-        self.total = total.astype('int16')
+        # sum of corrected spectra, over blocks of pixels
+        dtfactor = self.dtfactor.astype('float32')
+        self.total = np.zeros((len(self.counts), nchan), dtype='int32')
+        for p0, p1 in pixel_blocks(self.counts):
+            total = correct_counts(self.counts[p0:p1], dtfactor[p0:p1])
+            self.total[p0:p1] = total.sum(axis=1).astype('int32')
         self.dtfactor = self.dtfactor.astype('float32')
         self.dtfactor = self.dtfactor.transpose()
         self.inpcounts= self.inpcounts.transpose()
@@ -285,6 +383,41 @@ class GSEXRM_MapRow:
         self.realtime = self.realtime.transpose()
         self.counts   = self.counts.swapaxes(0, 1)
         
+class GSEXRM_ROIIndex(object):
+    """ROI channel limits for all ROIs and detectors, arranged so that
+    the counts in every ROI for a set of spectra can be found from one
+    cumulative sum over channels.
+
+    limits is an array of shape (nrois, nmca, 2) of (left, right)
+    channels for each ROI and detector, as in 'config/rois/limits'.
+    As with slice(left, right), the right channel is not included.
+    """
+    def __init__(self, limits):
+        limits = np.asarray(limits, dtype=int)
+        if limits.size == 0:
+            limits = limits.reshape((0, 0, 2))
+        self.nrois, self.nmca = limits.shape[:2]
+        self.left  = limits[:, :, 0].transpose()
+        self.right = limits[:, :, 1].transpose()
+        self.imca  = np.arange(self.nmca)[:, np.newaxis]
+
+    def sums(self, counts):
+        """return counts in all ROIs for an array of counts of shape
+        (nmca, npts, nchan), as an array of shape (nmca, nrois, npts)"""
+        nmca, npts, nchan = counts.shape
+        if self.nrois == 0:
+            return np.zeros((nmca, 0, npts), dtype=np.int64)
+        dtype = np.int32
+        if counts.dtype.kind == 'f':
+            dtype = np.float64
+        elif counts.dtype.itemsize > 2:
+            dtype = np.int64
+        csum = np.zeros((nmca, npts, nchan+1), dtype=dtype)
+        np.cumsum(counts, axis=2, out=csum[:, :, 1:])
+        left  = np.clip(self.left, 0, nchan)
+        right = np.clip(self.right, left, nchan)
+        return csum[self.imca, :, right] - csum[self.imca, :, left]
+
 class GSEXRM_Detector(object):
     """Detector class, representing 1 detector element (real or virtual)
     has the following properties (many of these as runtime-calculated properties)
@@ -429,11 +562,12 @@ class GSEXRM_MapFile(object):
     MasterFile = 'Master.dat'
 
     def __init__(self, filename=None, folder=None, root=None,
-                 chunksize=None):
+                 chunksize=None, storage=None):
         self.filename = filename
         self.folder   = folder
         self.root     = root
         self.chunksize=chunksize
+        self.storage  = get_storage_profile(storage)
         self.status   = GSEXRM_FileStatus.err_notfound
         self.dimension = None
         self.ndet       = None
@@ -444,11 +578,13 @@ class GSEXRM_MapFile(object):
         self.last_row = -1
         self.rowdata = []
         self.npts = None
-        self.roi_slices = None
+        self.roi_index = None
         self.pixeltime = None
         self.dt = debugtime()
         self.masterfile = None
         self.masterfile_mtime = -1
+        self.rows_per_sec = None
+        self._area_cache = OrderedDict()
 
         # initialize from filename or folder
         if self.filename is not None:
@@ -557,6 +693,9 @@ class GSEXRM_MapFile(object):
         if self.folder is None:
             self.folder = self.xrfmap.attrs['Map_Folder']
         self.last_row = int(self.xrfmap.attrs['Last_Row'])
+        if 'Storage' in self.xrfmap.attrs:
+            self.storage = get_storage_profile(
+                json.loads(self.xrfmap.attrs['Storage']))
 
         try:
             self.dimension = self.xrfmap['config/scan/dimension'].value
@@ -610,12 +749,10 @@ class GSEXRM_MapFile(object):
         self.ndet = len(calib['slope'])
         self.xrfmap.attrs['N_Detectors'] = self.ndet
         roi_desc, roi_addr, roi_lim = [], [], []
-        roi_slices = []
         for iroi, label, lims in roidat:
             roi_desc.append(label)
             roi_addr.append("%smca%%i.R%i" % (config['xrf']['prefix'], iroi))
             roi_lim.append([lims[i] for i in range(self.ndet)])
-            roi_slices.append([slice(lims[i][0], lims[i][1]) for i in range(self.ndet)])
         roi_lim = np.array(roi_lim)
 
         self.add_data(group['rois'], 'name',     roi_desc)
@@ -630,7 +767,7 @@ class GSEXRM_MapFile(object):
 
         self.roi_desc = roi_desc
         self.roi_addr = roi_addr
-        self.roi_slices = roi_slices
+        self.roi_index = GSEXRM_ROIIndex(roi_lim)
         self.calib = calib
         # add env data
         envdat = readEnvironFile(os.path.join(self.folder, self.EnvFile))
@@ -668,8 +805,15 @@ class GSEXRM_MapFile(object):
         self.add_rowdata(row)
         self.status = GSEXRM_FileStatus.hasdata
 
-    def process(self, maxrow=None, force=False, callback=None, verbose=True):
-        "look for more data from raw folder, process if needed"
+    def process(self, maxrow=None, force=False, callback=None, verbose=True,
+                nworkers=None):
+        """look for more data from raw folder, process if needed
+
+        Rows are read from the raw folder by nworkers threads (default
+        NREAD_THREADS), and written to the HDF5 file in order, from this
+        thread.  The rate of processing in rows/sec is saved as
+        self.rows_per_sec.
+        """
         # print('PROCESS  ', maxrow, force, self.filename, self.dimension, len(self.rowdata))
         if not self.check_hostid():
             raise GSEXRM_NotOwner(self.filename)
@@ -683,22 +827,24 @@ class GSEXRM_MapFile(object):
         if maxrow is not None:
             nrows = min(nrows, maxrow)
         if force or self.folder_has_newdata():
-            irow = self.last_row + 1
-            while irow < nrows:
-                # self.dt.add('=>PROCESS %i' % irow)
+            t0 = time.time()
+            nadded = 0
+            for irow, row in self.iter_rowdata(self.last_row + 1, nrows,
+                                               nworkers=nworkers):
                 if hasattr(callback, '__call__'):
                     callback(row=irow, maxrow=nrows,
                              filename=self.filename, status='reading')
-                row = self.read_rowdata(irow)
-                # self.dt.add('  == read row data')
                 if row is not None:
                     self.add_rowdata(row, verbose=verbose)
-                # self.dt.add('  == added row data')
+                    nadded += 1
                 if hasattr(callback, '__call__'):
                     callback(row=irow, maxrow=nrows,
                              filename=self.filename, status='complete')
-                irow  = irow + 1
-            # self.dt.show()
+            if nadded > 0:
+                self.rows_per_sec = nadded/max(1.e-6, time.time()-t0)
+                if verbose:
+                    print("Processed %i rows, %.2f rows/sec" %
+                          (nadded, self.rows_per_sec))
         self.resize_arrays(self.last_row+1)
         self.h5root.flush()
         if self.pixeltime is None:
@@ -721,10 +867,14 @@ class GSEXRM_MapFile(object):
         if self.dimension is None or irow > len(self.rowdata):
             self.read_master()
 
-        if self.folder is None or irow >= len(self.rowdata):
+        return self._read_row(self.rowdata, irow)
+
+    def _read_row(self, rowdata, irow):
+        "read row irow, for a list of rows from the Master file"
+        if self.folder is None or irow >= len(rowdata):
             return
 
-        yval, xmapf, sisf, xpsf, etime = self.rowdata[irow]
+        yval, xmapf, sisf, xpsf, etime = rowdata[irow]
         reverse = (irow % 2 != 0)
         return GSEXRM_MapRow(yval, xmapf, xpsf, sisf, irow=irow,
                              xrftype=self.xrfdet_type,
@@ -733,6 +883,76 @@ class GSEXRM_MapFile(object):
                              dimension=self.dimension, npts=self.npts,
                              folder=self.folder, reverse=reverse)
 
+    def iter_rowdata(self, irow, nrows, nworkers=None, maxpending=None):
+        """generate (irow, row) for rows irow through nrows-1, in order,
+        with rows read from the Map Folder by nworkers threads.
+
+        Readers stay no more than maxpending rows (default 2*nworkers)
+        ahead of the last row generated, so that a slow consumer (say,
+        writing to HDF5) limits the number of rows held in memory.
+        With nworkers < 2, rows are read in this thread.
+        """
+        if nworkers is None:
+            nworkers = NREAD_THREADS
+        if nworkers < 2 or nrows - irow < 2:
+            while irow < nrows:
+                yield irow, self.read_rowdata(irow)
+                irow += 1
+            return
+        if maxpending is None:
+            maxpending = 2*nworkers
+        # readers use a fixed copy of the rows in the Master file
+        if self.dimension is None or nrows > len(self.rowdata):
+            self.read_master()
+        rowdata = tuple(self.rowdata)
+
+        cond = threading.Condition()
+        state = {'next_read': irow, 'next_out': irow, 'stop': False}
+        results = {}
+
+        def reader():
+            while True:
+                with cond:
+                    while (not state['stop'] and
+                           state['next_read'] < nrows and
+                           state['next_read'] >= state['next_out'] + maxpending):
+                        cond.wait()
+                    if state['stop'] or state['next_read'] >= nrows:
+                        return
+                    jrow = state['next_read']
+                    state['next_read'] += 1
+                try:
+                    row = self._read_row(rowdata, jrow)
+                except Exception:
+                    row = _ReadError(sys.exc_info())
+                with cond:
+                    results[jrow] = row
+                    cond.notify_all()
+
+        threads = [threading.Thread(target=reader)
+                   for i in range(min(nworkers, nrows-irow))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            while irow < nrows:
+                with cond:
+                    while irow not in results:
+                        cond.wait()
+                    row = results.pop(irow)
+                    state['next_out'] = irow + 1
+                    cond.notify_all()
+                if isinstance(row, _ReadError):
+                    raise row.exc_info[0], row.exc_info[1], row.exc_info[2]
+                yield irow, row
+                irow += 1
+        finally:
+            with cond:
+                state['stop'] = True
+                cond.notify_all()
+            for thread in threads:
+                thread.join()
+
     def add_rowdata(self, row, verbose=True):
         """adds a row worth of real data"""
         if not self.check_hostid():
@@ -759,11 +979,16 @@ class GSEXRM_MapFile(object):
             grp['livetime'][thisrow, :]  = row.livetime[imca, :]
             grp['inpcounts'][thisrow, :] = row.inpcounts[imca, :]
             grp['outcounts'][thisrow, :] = row.outcounts[imca, :]
-            grp['counts'][thisrow, :, :] = row.counts[imca, :, :]
+            grp['counts'][thisrow, :, :] = self._fit_counts(grp, row.counts[imca, :, :])
+            if 'counts_csum' in grp:
+                self._add_csum_row(grp, thisrow, row.counts[imca, :, :])
 
         # self.dt.add('add_rowdata for mcas')
         # here, we add the total dead-time-corrected data to detsum.
-        self.xrfmap['detsum']['counts'][thisrow, :] = row.total[:]
+        self.xrfmap['detsum']['counts'][thisrow, :] = \
+                         self._fit_counts(self.xrfmap['detsum'], row.total)
+        if 'counts_csum' in self.xrfmap['detsum']:
+            self._add_csum_row(self.xrfmap['detsum'], thisrow, row.total)
         # self.dt.add('add_rowdata for detsum')
 
         pos    = self.xrfmap['positions/pos']
@@ -779,47 +1004,71 @@ class GSEXRM_MapFile(object):
         sum_raw = roimap['sum_raw']
         sum_cor = roimap['sum_cor']
 
-        detraw = list(row.sisdata[:npts].transpose())
+        sisraw = np.asarray(row.sisdata[:npts])
 
         if verbose:
             pform = "Add row %4i, yval=%s, npts=%i, xrffile=%s"
             print(pform % (thisrow+1, row.yvalue, npts, row.xmapfile))
 
-        detcor = detraw[:]
-        sumraw = detraw[:]
-        sumcor = detraw[:]
-
         # self.dt.add('add_rowdata b4 roi')
-        if self.roi_slices is None:
+        if self.roi_index is None:
             lims = self.xrfmap['config/rois/limits'].value
-            nrois, nmca, nx = lims.shape
-            self.roi_slices = []
-            for iroi in range(nrois):
-                x = [slice(lims[iroi, i, 0],
-                           lims[iroi, i, 1]) for i in range(nmca)]
-                self.roi_slices.append(x)
-
-        for slices in self.roi_slices:
-            iraw = [row.counts[i, :, slices[i]].sum(axis=1)
-                    for i in range(nmca)]
-            icor = [row.counts[i, :, slices[i]].sum(axis=1)*row.dtfactor[i, :]
-                    for i in range(nmca)]
-            detraw.extend(iraw)
-            detcor.extend(icor)
-            sumraw.append(np.array(iraw).sum(axis=0))
-            sumcor.append(np.array(icor).sum(axis=0))
+            self.roi_index = GSEXRM_ROIIndex(lims)
+
+        # ROI sums for all ROIs and mcas, shape (nmca, nroi, npts)
+        iraw = self.roi_index.sums(row.counts)
+        icor = iraw * row.dtfactor[:, np.newaxis, :]
+        # columns are scalers, then (roi1, mca1), (roi1, mca2), ...
+        nmca, nroi = iraw.shape[:2]
+        detraw = iraw.transpose(2, 1, 0).reshape((npts, nroi*nmca))
+        detcor = icor.transpose(2, 1, 0).reshape((npts, nroi*nmca))
 
         # self.dt.add('add_rowdata after roi')
-        det_raw[thisrow, :, :] = np.array(detraw).transpose()
-        det_cor[thisrow, :, :] = np.array(detcor).transpose()
-        sum_raw[thisrow, :, :] = np.array(sumraw).transpose()
-        sum_cor[thisrow, :, :] = np.array(sumcor).transpose()
+        det_raw[thisrow, :, :] = np.hstack((sisraw, detraw))
+        det_cor[thisrow, :, :] = np.hstack((sisraw, detcor))
+        sum_raw[thisrow, :, :] = np.hstack((sisraw, iraw.sum(axis=0).T))
+        sum_cor[thisrow, :, :] = np.hstack((sisraw, icor.sum(axis=0).T))
+
+        # cached area spectra for chunks including this row are invalid
+        for key in list(self._area_cache.keys()):
+            if key[2] <= thisrow < key[3]:
+                self._area_cache.pop(key)
 
         # self.dt.add('add_rowdata end')
         self.last_row = thisrow
         self.xrfmap.attrs['Last_Row'] = thisrow
         self.h5root.flush()
 
+    def _fit_counts(self, grp, counts):
+        """return counts to be written to grp['counts'], first promoting
+        the data type of that dataset if needed to hold these counts"""
+        dset = grp['counts']
+        if dset.dtype.kind not in 'iu':
+            return counts
+        dmax = np.iinfo(dset.dtype).max
+        if counts.max() <= dmax:
+            return counts
+        if self.storage.get('promote', True) and dset.dtype.itemsize < 4:
+            self._promote_counts(grp, np.int32)
+            return counts
+        return np.minimum(counts, dmax)
+
+    def _promote_counts(self, grp, dtype):
+        """change the data type of grp['counts'], keeping its layout"""
+        old = grp['counts']
+        kws = {'chunks': old.chunks, 'maxshape': old.maxshape,
+               'compression': old.compression, 'shuffle': old.shuffle}
+        if old.compression == 'gzip':
+            kws['compression_opts'] = old.compression_opts
+        if 'counts_tmp' in grp:
+            del grp['counts_tmp']
+        new = grp.create_dataset('counts_tmp', old.shape, dtype, **kws)
+        for r0, r1 in self._row_blocks(old):
+            new[r0:r1] = old[r0:r1]
+        del grp['counts']
+        grp.move('counts_tmp', 'counts')
+        self._area_cache.clear()
+
     def build_schema(self, row):
         """build schema for detector and scan data"""
         if not self.check_hostid():
@@ -830,12 +1079,10 @@ class GSEXRM_MapFile(object):
         npts = self.npts
         nmca, xnpts, nchan = row.counts.shape
 
-        if self.chunksize is None:
-            nxx = min(xnpts-1, 2**int(np.log2(xnpts)))
-            nxm = 1024
-            if nxx > 256:
-                nxm = min(1024, int(65536*1.0/ nxx))
-            self.chunksize = (1, nxx, nxm)
+        counts_kws = counts_dataset_kws(self.storage, npts, nchan,
+                                        chunks=self.chunksize)
+        self.chunksize = counts_kws['chunks']
+        self.xrfmap.attrs['Storage'] = json.dumps(self.storage)
         en_index = np.arange(nchan)
 
         xrfmap = self.xrfmap
@@ -861,10 +1108,7 @@ class GSEXRM_MapFile(object):
             self.add_data(dgrp, 'roi_address', [s % (imca+1) for s in roi_addrs])
             self.add_data(dgrp, 'roi_limits',  roi_limits[:,imca,:])
 
-            dgrp.create_dataset('counts', (NINIT, npts, nchan), np.int16,
-                                compression=COMPRESSION_LEVEL,
-                                chunks=self.chunksize,
-                                maxshape=(None, npts, nchan))
+            dgrp.create_dataset('counts', (NINIT, npts, nchan), **counts_kws)
             for name, dtype in (('realtime', np.int),  ('livetime', np.int),
                                 ('dtfactor', np.float32),
                                 ('inpcounts', np.float32),
@@ -883,10 +1127,7 @@ class GSEXRM_MapFile(object):
         self.add_data(dgrp, 'roi_name',    roi_names)
         self.add_data(dgrp, 'roi_address', [s % 1 for s in roi_addrs])
         self.add_data(dgrp, 'roi_limits',  roi_limits[: ,0, :])
-        dgrp.create_dataset('counts', (NINIT, npts, nchan), np.int16,
-                            compression=COMPRESSION_LEVEL,
-                            chunks=self.chunksize,
-                            maxshape=(None, npts, nchan))
+        dgrp.create_dataset('counts', (NINIT, npts, nchan), **counts_kws)
         # roi map data
         scan = xrfmap['roimap']
         det_addr = [i.strip() for i in row.sishead[-2][1:].split('|')]
@@ -972,6 +1213,11 @@ class GSEXRM_MapFile(object):
         for g in virtmca_groups:
             g['counts'].resize((nrow, npts, nchan))
 
+        for g in realmca_groups + virtmca_groups:
+            if 'counts_csum' in g:
+                old, npts, ncsum = g['counts_csum'].shape
+                g['counts_csum'].resize((nrow, npts, ncsum))
+
         g = self.xrfmap['positions/pos']
         old, npts, nx = g.shape
         g.resize((nrow, npts, nx))
@@ -1237,55 +1483,89 @@ class GSEXRM_MapFile(object):
             raise GSEXRM_Exception("Could not find area '%s'" % areaname)
 
         mapdat = self._det_group(det)
-        ix, iy, nmca = mapdat['counts'].shape
-
         npix = len(np.where(area)[0])
         if npix < 1:
             return None
         sy, sx = [slice(min(_a), max(_a)+1) for _a in np.where(area)]
         xmin, xmax, ymin, ymax = sx.start, sx.stop, sy.start, sy.stop
-        nx, ny = (xmax-xmin), (ymax-ymin)
-        NCHUNKSIZE = 16384 # 8192
-        use_chunks = nx*ny > NCHUNKSIZE
-        step = int((nx*ny)/NCHUNKSIZE)
-
-        if not use_chunks:
-            try:
-                if hasattr(callback , '__call__'):
-                    callback(1, 1, nx*ny)
-                counts = self.get_counts_rect(ymin, ymax, xmin, xmax,
-                                           mapdat=mapdat, det=det, area=area,
-                                           dtcorrect=dtcorrect)
-            except MemoryError:
-                use_chunks = True
-        if use_chunks:
-            counts = np.zeros(nmca)
-            if nx > ny:
-                for i in range(step+1):
-                    x1 = xmin + int(i*nx/step)
-                    x2 = min(xmax, xmin + int((i+1)*nx/step))
-                    if x1 >= x2: break
-                    if hasattr(callback , '__call__'):
-                        callback(i, step, (x2-x1)*ny)
-                    counts += self.get_counts_rect(ymin, ymax, x1, x2, mapdat=mapdat,
-                                                det=det, area=area,
-                                                dtcorrect=dtcorrect)
-            else:
-                for i in range(step+1):
-                    y1 = ymin + int(i*ny/step)
-                    y2 = min(ymax, ymin + int((i+1)*ny/step))
-                    if y1 >= y2: break
-                    if hasattr(callback , '__call__'):
-                        callback(i, step, nx*(y2-y1))
-                    counts += self.get_counts_rect(y1, y2, xmin, xmax, mapdat=mapdat,
-                                                det=det, area=area,
-                                                dtcorrect=dtcorrect)
-
+        counts = self.get_counts_area(area, det=det, dtcorrect=dtcorrect,
+                                      callback=callback)
         ltime, rtime = self.get_livereal_rect(ymin, ymax, xmin, xmax, det=det,
                                               dtcorrect=dtcorrect, area=area)
         return self._getmca(mapdat, counts, areaname, npixels=npix,
                             real_time=rtime, live_time=ltime)
 
+    def get_counts_area(self, area, det=None, dtcorrect=True, callback=None):
+        """return counts summed over the pixels in an area mask
+
+        Parameters
+        ---------
+        area :       ndarray of bool, with the shape of the map
+        det :        optional, None or int         index of detector
+        dtcorrect :  optional, bool [True]         dead-time correct data
+        callback :   optional, function called after each band of chunks
+                     is read, as callback(iband, nbands, npixels)
+
+        Returns
+        -------
+        ndarray for XRF counts in area
+
+        Notes
+        -----
+        The counts are read in the HDF5 chunk layout, and only for
+        chunks that include part of the area.  The summed spectra for
+        each chunk and its part of the area are cached, so that
+        repeated or overlapping areas are mostly summed from the cache.
+        """
+        mapdat = self._det_group(det)
+        counts = mapdat['counts']
+        nrow, npts, nchan = counts.shape
+        area = np.asarray(area, dtype=bool)[:nrow, :npts]
+        dtcorrect = dtcorrect and det in range(1, self.ndet+1)
+        ychunk, xchunk = 1, npts
+        if counts.chunks is not None:
+            ychunk, xchunk = counts.chunks[:2]
+
+        out = np.zeros(nchan)
+        yarea, xarea = np.where(area)
+        if len(yarea) < 1:
+            return out
+        ybands = range(yarea.min()//ychunk, yarea.max()//ychunk + 1)
+        xtiles = range(xarea.min()//xchunk, xarea.max()//xchunk + 1)
+        cache = self._area_cache
+        for iband, iy in enumerate(ybands):
+            y1, y2 = iy*ychunk, min(nrow, (iy+1)*ychunk)
+            needed = []
+            for ix in xtiles:
+                x1, x2 = ix*xchunk, min(npts, (ix+1)*xchunk)
+                mask = area[y1:y2, x1:x2]
+                if not mask.any():
+                    continue
+                mkey = 'all'
+                if not mask.all():
+                    mkey = np.packbits(mask).tostring()
+                key = (mapdat.name, dtcorrect, y1, y2, x1, x2, mkey)
+                if key in cache:
+                    out += cache[key]
+                    cache[key] = cache.pop(key)
+                else:
+                    needed.append((key, x1, x2, mask))
+            if len(needed) > 0:
+                xlo, xhi = needed[0][1], needed[-1][2]
+                band = counts[y1:y2, xlo:xhi, :]
+                if dtcorrect:
+                    dtfact = mapdat['dtfactor'][y1:y2, xlo:xhi]
+                    band = band * dtfact[:, :, np.newaxis]
+                for key, x1, x2, mask in needed:
+                    csum = band[:, x1-xlo:x2-xlo, :][mask].sum(axis=0)
+                    out += csum
+                    cache[key] = csum
+                while len(cache) > NAREA_CACHE:
+                    cache.popitem(last=False)
+            if hasattr(callback , '__call__'):
+                callback(iband, len(ybands), area[y1:y2].sum())
+        return out
+
     def get_mca_rect(self, ymin, ymax, xmin, xmax, det=None, dtcorrect=True):
         """return mca counts for a map rectangle, optionally
 
@@ -1548,12 +1828,116 @@ class GSEXRM_MapFile(object):
             return self.xrfmap[dat][:, :, imap]
 
     def get_map_erange(self, det=None, dtcorrect=True,
-                       emin=None, emax=None, by_energy=True):
-        """extract map for an ROI set here, by energy range:
+                       emin=None, emax=None, by_energy=True,
+                       no_hotcols=True):
+        """extract map for an ROI set here, by energy range
+
+        Parameters
+        ---------
+        det  :       optional, None or int [None]  index for detector
+        dtcorrect :  optional, bool [True]         dead-time correct data
+        emin :       optional, low energy (or channel) [lowest energy]
+        emax :       optional, high energy (or channel) [highest energy]
+        by_energy :  optional, bool [True]  emin and emax are energies,
+                     in the units of get_energy().  Otherwise, they are
+                     channel indices, with emax not included.
+        no_hotcols   optional, bool [True]         suprress hot columns
 
-        not implemented
+        Returns
+        -------
+        ndarray for map of counts in energy range
+
+        Notes
+        -----
+        With det=None, the dead-time corrected sum of detectors is used.
+        If add_erange_index() has been run for the detector, the map is
+        the difference of two planes of the cumulative sum over channels,
+        with the energy range rounded to the channel step of that index.
+        Otherwise, the counts for the channels in the range are summed.
         """
-        pass
+        mapdat = self._det_group(det)
+        counts = mapdat['counts']
+        nchan = counts.shape[2]
+        ilo, ihi = 0, nchan
+        if by_energy:
+            energy = mapdat['energy'].value
+            if emin is not None:
+                ilo = int(np.abs(energy - emin).argmin())
+            if emax is not None:
+                ihi = int(np.abs(energy - emax).argmin()) + 1
+        else:
+            if emin is not None:
+                ilo = int(emin)
+            if emax is not None:
+                ihi = int(emax)
+        ilo = max(0, min(nchan, ilo))
+        ihi = max(ilo, min(nchan, ihi))
+
+        if 'counts_csum' in mapdat:
+            csum = mapdat['counts_csum']
+            step = int(csum.attrs['step'])
+            j1 = min(csum.shape[2]-1, int(round(ilo*1.0/step)))
+            j2 = min(csum.shape[2]-1, int(round(ihi*1.0/step)))
+            out = csum[:, :, j2] - csum[:, :, j1]
+        else:
+            out = np.zeros(counts.shape[:2])
+            for r0, r1 in self._row_blocks(counts, nchan=ihi-ilo):
+                out[r0:r1] = counts[r0:r1, :, ilo:ihi].sum(axis=2)
+
+        if dtcorrect and det in range(1, self.ndet+1):
+            out = out * mapdat['dtfactor'].value
+        if no_hotcols:
+            return out[:, 1:-1]
+        return out
+
+    def add_erange_index(self, det=None, step=1, overwrite=False):
+        """add an index of cumulative sums of counts over channels for a
+        detector, for fast maps of any energy range with get_map_erange()
+
+        Parameters
+        ---------
+        det  :       optional, None or int [None]  index for detector,
+                     with None meaning the sum of detectors.
+        step :       optional, int [1]  channel step for the index.  Energy
+                     ranges will be rounded to this many channels.
+        overwrite :  optional, bool [False] replace an existing index
+
+        The index is saved as 'counts_csum' in the detector group, with
+        shape (nrow, npts, nchan/step + 1), and element [:, :, j] holding
+        the sum of counts for channels below j*step.  It is kept up to
+        date as rows are added to the map.
+        """
+        if not self.check_hostid():
+            raise GSEXRM_NotOwner(self.filename)
+        mapdat = self._det_group(det)
+        if 'counts_csum' in mapdat:
+            if not overwrite:
+                return
+            del mapdat['counts_csum']
+        counts = mapdat['counts']
+        nrow, npts, nchan = counts.shape
+        step = max(1, int(step))
+        dtype = np.int32
+        if counts.dtype.itemsize > 2:
+            dtype = np.int64
+        ncsum = nchan//step + 1
+        csum = mapdat.create_dataset('counts_csum', (nrow, npts, ncsum),
+                                     dtype, compression=COMPRESSION_LEVEL,
+                                     chunks=(1, npts, min(ncsum, 256)),
+                                     maxshape=(None, npts, ncsum))
+        csum.attrs['step'] = step
+        for r0, r1 in self._row_blocks(counts):
+            csum[r0:r1] = channel_csum(counts[r0:r1], step, dtype)
+        self.h5root.flush()
+
+    def _add_csum_row(self, mapdat, irow, counts):
+        "add a row of counts to a detector's cumulative sum index"
+        csum = mapdat['counts_csum']
+        if irow >= csum.shape[0]:
+            old, npts, ncsum = csum.shape
+            csum.resize((irow+1, npts, ncsum))
+        csum[irow, :, :] = channel_csum(counts, int(csum.attrs['step']),
+                                        csum.dtype)
 
     def get_rgbmap(self, rroi, groi, broi, det=None, no_hotcols=True,
                    dtcorrect=True, scale_each=True, scales=None):
@@ -1607,6 +1991,21 @@ class GSEXRM_MapFile(object):
         These settings will be propogated through the
         ROI maps and all detectors.
 
+        Parameters
+        ---------
+        name :       str    ROI name
+        high :       int    high channel index (not included in ROI)
+        low :        int    low channel index
+        address :    optional, str ['']  address for ROI, which can
+                     include '%i' for the detector number
+        det :        optional, int [1]  index of detector for which
+                     the channels are given.  Limits for the other
+                     detectors will be at the same energies.
+        overwrite :  optional, bool [False]  overwrite an existing ROI
+
+        The ROI maps are calculated from the stored spectra for each
+        detector, reading blocks of rows and only the channels in the
+        ROI, so that the full spectra are never held in memory.
         """
         # data structures affected:
         #   config/rois/address
@@ -1626,25 +2025,216 @@ class GSEXRM_MapFile(object):
         #   detsum/roi_address      for I = 1, N_detectors (xrfmap attribute)
         #   detsum/roi_name         for I = 1, N_detectors (xrfmap attribute)
         #   detsum/roi_limits       for I = 1, N_detectors (xrfmap attribute)
+        if not self.check_hostid():
+            raise GSEXRM_NotOwner(self.filename)
 
         roi_names = [i.lower().strip() for i in self.xrfmap['config/rois/name']]
-        if name.lower().strip() in roi_name:
+        if name.lower().strip() in roi_names:
             if overwrite:
                 self.del_roi(name)
             else:
                 print("An ROI named '%s' exists, use overwrite=True to overwrite" % name)
                 return
-        #
+        if self.ndet is None:
+            self.ndet = self.xrfmap.attrs['N_Detectors']
+        if low > high:
+            low, high = high, low
+
+        # channel limits for each detector, at the same energies
+        energy = self._det_group(det)['energy'].value
+        nchan = len(energy)
+        elo = energy[max(0, min(nchan-1, low))]
+        ehi = energy[max(0, min(nchan-1, high))]
+        limits = []
+        for imca in range(self.ndet):
+            en = self.xrfmap['det%i/energy' % (imca+1)].value
+            limits.append((int(np.abs(en-elo).argmin()),
+                           int(np.abs(en-ehi).argmin())))
+            if imca+1 == det:
+                limits[-1] = (low, high)
+        limits = np.array(limits)
+
+        # calculate new ROI maps, with shape (nrow, npts, nmca)
+        shape = self.xrfmap['det1/counts'].shape
+        roiraw = np.zeros((shape[0], shape[1], self.ndet), dtype=np.int64)
+        roicor = np.zeros((shape[0], shape[1], self.ndet), dtype=np.float32)
+        for imca in range(self.ndet):
+            dgrp = self.xrfmap['det%i' % (imca+1)]
+            counts, dtfactor = dgrp['counts'], dgrp['dtfactor']
+            left, right = limits[imca]
+            for r0, r1 in self._row_blocks(counts, nchan=right-left):
+                raw = counts[r0:r1, :, left:right].sum(axis=2)
+                roiraw[r0:r1, :, imca] = raw
+                roicor[r0:r1, :, imca] = raw * dtfactor[r0:r1, :]
+
+        # config
+        conf = self.xrfmap['config/rois']
+        conf_lims = conf['limits'].value
+        if conf_lims.size == 0:
+            conf_lims = conf_lims.reshape((0, self.ndet, 2))
+        self._replace_data(conf, 'name', list(conf['name']) + [name])
+        self._replace_data(conf, 'address', list(conf['address']) + [address])
+        self._replace_data(conf, 'limits',
+                           np.concatenate((conf_lims, limits[np.newaxis])))
+
+        # detectors
+        def det_address(imca):
+            if '%i' in address:
+                return address % imca
+            return address
+        for imca in range(self.ndet+1):
+            if imca == 0:
+                dgrp, lims = self.xrfmap['detsum'], limits[0]
+            else:
+                dgrp, lims = self.xrfmap['det%i' % imca], limits[imca-1]
+            rname, raddr = self._roi_dsetnames(dgrp)
+            dlims = dgrp['roi_limits'].value.reshape((-1, 2))
+            self._replace_data(dgrp, rname, list(dgrp[rname]) + [name])
+            self._replace_data(dgrp, raddr, list(dgrp[raddr]) +
+                               [det_address(max(1, imca))])
+            self._replace_data(dgrp, 'roi_limits',
+                               np.concatenate((dlims, lims[np.newaxis])))
+
+        # roi maps
+        roimap = self.xrfmap['roimap']
+        ndet_cols = roimap['det_raw'].shape[2]
+        nsum_cols = roimap['sum_raw'].shape[2]
+        self._replace_data(roimap, 'det_name', list(roimap['det_name']) +
+                           ["%s (mca%i)" % (name, i+1) for i in range(self.ndet)])
+        self._replace_data(roimap, 'det_address', list(roimap['det_address']) +
+                           [det_address(i+1) for i in range(self.ndet)])
+        self._replace_data(roimap, 'sum_name', list(roimap['sum_name']) + [name])
+
+        sum_list = roimap['sum_list'].value
+        newsum = np.arange(ndet_cols, ndet_cols+self.ndet)
+        width = max(sum_list.shape[1], self.ndet)
+        sums = -np.ones((sum_list.shape[0]+1, width), dtype=sum_list.dtype)
+        sums[:-1, :sum_list.shape[1]] = sum_list
+        sums[-1, :self.ndet] = newsum
+        self._replace_data(roimap, 'sum_list', sums)
+
+        self._rewrite_roimap('det_raw', range(ndet_cols), roiraw)
+        self._rewrite_roimap('det_cor', range(ndet_cols), roicor)
+        self._rewrite_roimap('sum_raw', range(nsum_cols),
+                             roiraw.sum(axis=2)[:, :, np.newaxis])
+        self._rewrite_roimap('sum_cor', range(nsum_cols),
+                             roicor.sum(axis=2)[:, :, np.newaxis])
+        self.roi_index = None
+        self.h5root.flush()
 
     def del_roi(self, name):
-        """ delete an ROI"""
+        """ delete an ROI, removing it from the ROI maps and all detectors"""
+        if not self.check_hostid():
+            raise GSEXRM_NotOwner(self.filename)
+
         roi_names = [i.lower().strip() for i in self.xrfmap['config/rois/name']]
-        if name.lower().strip() not in roi_name:
+        if name.lower().strip() not in roi_names:
             print("No ROI named '%s' found to delete" % name)
             return
-        iroi = roi_name.index(name.lower().strip())
-        roi_names = [i in self.xrfmap['config/rois/name']]
-        roi_names.pop(iroi)
+        iroi = roi_names.index(name.lower().strip())
+
+        def drop(values, index):
+            return [v for i, v in enumerate(values) if i != index]
+
+        conf = self.xrfmap['config/rois']
+        self._replace_data(conf, 'name', drop(conf['name'], iroi))
+        self._replace_data(conf, 'address', drop(conf['address'], iroi))
+        self._replace_data(conf, 'limits', np.delete(conf['limits'].value,
+                                                     iroi, axis=0))
+        for gname in sorted(self.xrfmap.keys()):
+            dgrp = self.xrfmap[gname]
+            if dgrp.attrs.get('type', '') not in ('mca detector', 'virtual mca'):
+                continue
+            rname, raddr = self._roi_dsetnames(dgrp)
+            jroi = [i.lower().strip() for i in dgrp[rname]].index(roi_names[iroi])
+            self._replace_data(dgrp, rname, drop(dgrp[rname], jroi))
+            self._replace_data(dgrp, raddr, drop(dgrp[raddr], jroi))
+            self._replace_data(dgrp, 'roi_limits',
+                               np.delete(dgrp['roi_limits'].value, jroi, axis=0))
+
+        # roi maps: remove columns for this ROI, and renumber sum_list
+        roimap = self.xrfmap['roimap']
+        det_names = list(roimap['det_name'])
+        sum_names = list(roimap['sum_name'])
+        prefix = '%s (mca' % roi_names[iroi]
+        ddrop = [i for i, n in enumerate(det_names)
+                 if n.lower().strip().startswith(prefix)]
+        dkeep = [i for i in range(len(det_names)) if i not in ddrop]
+        isum = [n.lower().strip() for n in sum_names].index(roi_names[iroi])
+        skeep = [i for i in range(len(sum_names)) if i != isum]
+
+        sum_list = np.delete(roimap['sum_list'].value, isum, axis=0)
+        newindex = -np.ones(len(det_names)+1, dtype=int)
+        newindex[dkeep] = np.arange(len(dkeep))
+        sum_list = newindex[sum_list]
+
+        self._replace_data(roimap, 'det_name', [det_names[i] for i in dkeep])
+        self._replace_data(roimap, 'det_address',
+                           [roimap['det_address'][i] for i in dkeep])
+        self._replace_data(roimap, 'sum_name', [sum_names[i] for i in skeep])
+        self._replace_data(roimap, 'sum_list', sum_list)
+        self._rewrite_roimap('det_raw', dkeep)
+        self._rewrite_roimap('det_cor', dkeep)
+        self._rewrite_roimap('sum_raw', skeep)
+        self._rewrite_roimap('sum_cor', skeep)
+        self.roi_index = None
+        self.h5root.flush()
+
+    def _roi_dsetnames(self, dgrp):
+        """names of ROI name and address datasets for a detector group"""
+        # some '1.3.0' files were built with 'roi_names', some with 'roi_name'
+        rname, raddr = 'roi_name', 'roi_address'
+        if rname not in dgrp:
+            rname, raddr = 'roi_names', 'roi_addrs'
+        return rname, raddr
+
+    def _replace_data(self, group, name, data, **kws):
+        """replace an hdf5 dataset, keeping its attributes"""
+        attrs = None
+        if name in group:
+            attrs = dict(group[name].attrs)
+            del group[name]
+        return self.add_data(group, name, data, attrs=attrs, **kws)
+
+    def _row_blocks(self, dset, nchan=None, nbytes=2**24):
+        """(start, stop) for blocks of rows of a (nrow, npts, nchan)
+        dataset, aligned with its chunks and reading about nbytes"""
+        nrow, npts = dset.shape[:2]
+        if nchan is None:
+            nchan = dset.shape[2]
+        step = 1
+        if dset.chunks is not None:
+            step = dset.chunks[0]
+        rowbytes = max(1, npts*max(1, nchan)*dset.dtype.itemsize)
+        step = step * max(1, int(nbytes/(rowbytes*step)))
+        return [(r0, min(nrow, r0+step)) for r0 in range(0, nrow, step)]
+
+    def _rewrite_roimap(self, name, keep, extra=None):
+        """rewrite roimap/name, keeping the columns in keep and
+        appending columns from extra, an array of (nrow, npts, nextra)"""
+        roimap = self.xrfmap['roimap']
+        old = roimap[name]
+        nrow, npts, ncol = old.shape
+        keep = list(keep)
+        ncol = len(keep)
+        if extra is not None:
+            ncol += extra.shape[2]
+        tmpname = '%s_tmp' % name
+        if tmpname in roimap:
+            del roimap[tmpname]
+        new = roimap.create_dataset(tmpname, (nrow, npts, ncol), old.dtype,
+                                    compression=COMPRESSION_LEVEL,
+                                    chunks=(2, npts, ncol),
+                                    maxshape=(None, npts, ncol))
+        for key, val in old.attrs.items():
+            new.attrs[key] = val
+        for r0, r1 in self._row_blocks(old):
+            dat = old[r0:r1][:, :, keep]
+            if extra is not None:
+                dat = np.concatenate((dat, extra[r0:r1]), axis=2)
+            new[r0:r1] = dat
+        del roimap[name]
+        roimap.move(tmpname, name)
 
 def read_xrfmap(filename, root=None):
     """read GSE XRM FastMap data from HDF5 file or raw map folder"""
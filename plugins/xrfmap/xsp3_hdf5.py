@@ -10,25 +10,25 @@ import sys
 import os
 
 from larch import Group, ValidateLarchPlugin, use_plugin_path
+use_plugin_path('xrf')
+from deadtime import TAU_TABLES, icr_newton
 
 # Default tau values for xspress3
 
-XSPRESS3_TAUS = [109.e-9, 91.e-9, 99.e-9, 98.e-9]
+XSPRESS3_TAUS = list(TAU_TABLES['xspress3'])
 
 def estimate_icr(ocr, tau, niter=3):
-    "estimate icr from ocr and tau"
+    """estimate icr from ocr and tau, with a fixed number of
+    Newton steps from the deadtime engine
+
+    ocr and tau may be arrays that broadcast together, as for
+    ocr of shape (npix, ndet) and one tau per detector.
+    """
+    tau = np.asarray(tau, dtype='f8')
     maxicr = 1.0/tau
     maxocr = 1/(tau*np.exp(1.0))
-    ocr[np.where(ocr>2*maxocr)[0]] = 2*maxocr
-    icr = 1.0*ocr
-    for c in range(niter):
-        delta = (icr - ocr*np.exp(icr*tau))/(icr*tau - 1)
-        delta[np.where(delta < 0)[0]] = 0.0
-        icr = icr + delta
-        icr[np.where(icr>5*maxicr)[0]] = 5*maxicr
-    #endfor
-    return icr
-#enddef
+    ocr = np.minimum(ocr, 2*maxocr)
+    return icr_newton(ocr, tau, maxiter=niter, tol=0, icr_max=5*maxicr)
 
 
 class XSP3Data(object):
@@ -40,11 +40,88 @@ class XSP3Data(object):
         self.outputCounts = np.zeros((npix, ndet), dtype='f8')
         self.inputCounts  = np.zeros((npix, ndet), dtype='f8')
         # self.counts       = np.zeros((npix, ndet, nchan), dtype='f4')
+        self._h5file = None
+
+    def close(self):
+        "close HDF5 file held open for lazy counts"
+        if self._h5file is not None:
+            self._h5file.close()
+        self._h5file = None
+
+class XSP3Counts(object):
+    """lazy view of xspress3 detector/data, shape (npix, ndet, nchan).
+
+    Slices are read from the HDF5 dataset on demand, in its native
+    dtype.  Pixels beyond those in the dataset read as zeros.  Each axis
+    may be indexed by an integer, a slice (including negative steps) or
+    an index array, with index arrays applied to each axis separately.
+    """
+    def __init__(self, dset, npix=None):
+        self.dset = dset
+        ndpix, ndet, nchan = dset.shape
+        if npix is None:
+            npix = ndpix
+        self.ndpix = min(ndpix, npix)
+        self.shape = (npix, ndet, nchan)
+        self.dtype = dset.dtype
+        self.ndim = 3
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        out = self[:]
+        if dtype is not None:
+            out = out.astype(dtype)
+        return out
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        ells = [i for i, k in enumerate(key) if k is Ellipsis]
+        if len(ells) > 0:
+            i = ells[0]
+            key = key[:i] + (slice(None),)*(4-len(key)) + key[i+1:]
+        if len(key) > 3:
+            raise IndexError('too many indices for XSP3Counts')
+        key = key + (slice(None),)*(3-len(key))
+        index = [np.arange(n)[k] for n, k in zip(self.shape, key)]
+        pix, det, chan = [np.atleast_1d(i) for i in index]
+        out = np.zeros((len(pix), len(det), len(chan)), dtype=self.dtype)
+        real = np.where(pix < self.ndpix)[0]
+        if len(real) > 0 and len(det) > 0 and len(chan) > 0:
+            # read the covering block with positive steps, then select
+            sel = (pix[real], det, chan)
+            lims = [(i.min(), i.max()+1) for i in sel]
+            block = self.dset[tuple([slice(lo, hi) for lo, hi in lims])]
+            for axis, (i, (lo, hi)) in enumerate(zip(sel, lims)):
+                block = np.take(block, i - lo, axis=axis)
+            out[real] = block
+        # drop axes indexed by integers
+        return out[tuple([0 if np.ndim(i) == 0 else slice(None)
+                          for i in index])]
+
+def pixel_blocks(counts, nbytes=2**24):
+    """(start, stop) for blocks of pixels of counts, aligned with HDF5
+    chunks for datasets and reading about nbytes"""
+    npix, ndet, nchan = counts.shape
+    step = 1
+    dset = getattr(counts, 'dset', counts)
+    if getattr(dset, 'chunks', None) is not None:
+        step = dset.chunks[0]
+    pixbytes = max(1, ndet*nchan*counts.dtype.itemsize)
+    step = step * max(1, int(nbytes/(pixbytes*step)))
+    return [(p0, min(npix, p0+step)) for p0 in range(0, npix, step)]
 
 def read_xsp3_hdf5(fname, npixels=None, verbose=False,
-                   kludge_dtc=False, _larch=None):
-    # Reads a HDF5 file created with the DXP xMAP driver
-    # with the netCDF plugin buffers
+                   kludge_dtc=False, lazy=False, _larch=None):
+    """Reads a HDF5 file created with the xspress3 driver.
+
+    with lazy=True, counts is an XSP3Counts that reads slices on demand,
+    and the file stays open until close() is called on the result.
+    Output counts are summed over blocks of pixels, so that memory use
+    is bounded for long rows.
+    """
     npixels = None
     clocktick = 12.5e-3
     t0 = time.time()
@@ -65,33 +142,35 @@ def read_xsp3_hdf5(fname, npixels=None, verbose=False,
     out = XSP3Data(npixels, ndet, nchan)
     out.numPixels = npixels
     t1 = time.time()
-    if ndpix < npix:
-        out.counts = np.zeros((npix, ndet, nchan), dtype='f8')
-        out.counts[:ndpix, :, :]  = counts[:]
+    out.counts = XSP3Counts(counts, npix)
+    if lazy:
+        out._h5file = h5file
     else:
-        out.counts = counts[:]
+        out.counts = out.counts[:]
 
     if kludge_dtc:
         dtc_taus = XSPRESS3_TAUS
         if _larch is not None and _larch.symtable.has_symbol('_sys.gsecars.xspress3_taus'):
             dtc_taus = _larch.symtable._sys.gsecars.xspress3_taus
-        
-    for i in range(ndet):
-        rtime = clocktick * ndattr['CHAN%iSCA0' % (i+1)].value 
-        rtime[np.where(rtime<0.1)] = 0.1
-        out.realTime[:, i] = rtime
-        out.liveTime[:, i] = rtime
-        ocounts = out.counts[:, i, 1:-1].sum(axis=1)
-        ocounts[np.where(ocounts<0.1)] = 0.1
-        out.outputCounts[:, i] = ocounts
-        out.inputCounts[:, i]  = ocounts
-        if kludge_dtc:
-            ocr = ocounts/(rtime*1.e-6)
-            icr = estimate_icr(ocr, dtc_taus[i], niter=3)
-            out.inputCounts[:, i]  = icr * (rtime*1.e-6)
-            
-
-    h5file.close()
+
+    rtime = clocktick * np.array([ndattr['CHAN%iSCA0' % (i+1)].value
+                                  for i in range(ndet)]).transpose()
+    rtime[np.where(rtime<0.1)] = 0.1
+    out.realTime[:] = rtime
+    out.liveTime[:] = rtime
+    for p0, p1 in pixel_blocks(out.counts):
+        out.outputCounts[p0:p1] = out.counts[p0:p1, :, 1:-1].sum(axis=2)
+    out.outputCounts[np.where(out.outputCounts<0.1)] = 0.1
+    out.inputCounts[:] = out.outputCounts
+    if kludge_dtc:
+        taus = np.array(dtc_taus[:ndet])
+        for p0, p1 in pixel_blocks(out.counts):
+            rt = rtime[p0:p1]*1.e-6
+            ocr = out.outputCounts[p0:p1]/rt
+            out.inputCounts[p0:p1] = rt * estimate_icr(ocr, taus, niter=3)
+
+    if not lazy:
+        h5file.close()
     t2 = time.time()
     if verbose:
         print('   time to read file    = %5.1f ms' % ((t1-t0)*1000))
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+""" Larch Tests:
+  autobk uncertainties in bkg and chi, compared to propagating them
+  with the uncertainties package
+"""
+import unittest
+import numpy as np
+from scipy.interpolate import splrep, splev, UnivariateSpline
+
+from utils import TestCase
+from larch.fitting.uncertainties import correlated_values, wrap
+
+import larch
+larch.use_plugin_path('xafs')
+larch.use_plugin_path('math')
+from xafsutils import ETOK
+from mathutils import index_of, index_nearest
+from autobk import spline_eval
+
+class TestAutobkUncertainties(TestCase):
+    '''delta_bkg and delta_chi from autobk'''
+    def setUp(self):
+        TestCase.setUp(self)
+        self.trytext("""
+d = read_ascii('../examples/xafsdata/cu.xmu', labels='energy mu i0')
+autobk(d, rbkg=1.0, kweight=2, calc_uncertainties=True)
+""")
+        self.NoExceptionRaised()
+        self.dat = self.session.get_symbol('d')
+
+    def spline(self):
+        "the spline setup of autobk(), rebuilt from its outputs"
+        dat = self.dat
+        details = dat.autobk_details
+        energy, e0, kout = dat.energy, dat.e0, dat.k
+        ie0 = index_nearest(energy, e0)
+        kraw = np.sqrt(ETOK*(energy[ie0:] - e0))
+        kmax = max(kraw)
+        iemax = min(len(energy), 2+index_of(energy, e0+kmax*kmax/ETOK)) - 1
+        spl_k = np.sqrt(ETOK*(details.knots_e - e0))
+        knots, coefs, order = splrep(spl_k, details.init_knots_y)
+        coefs = [getattr(details, 'c%2.2i' % i).value
+                 for i in range(len(coefs))]
+        return (ie0, iemax-ie0+1, kraw, kout, knots, np.array(coefs), order)
+
+    def test_uncertainties(self):
+        dat = self.dat
+        details = dat.autobk_details
+        ie0, nkx, kraw, kout, knots, coefs, order = self.spline()
+        mu = dat.mu[ie0:ie0+nkx]
+        bkg, chi = spline_eval(kraw[:nkx], mu, knots, coefs, order, kout)
+        self.assertTrue(np.allclose(bkg, dat.bkg[ie0:ie0+nkx]))
+        self.assertTrue(np.allclose(chi/dat.edge_step, dat.chi))
+
+        # as autobk() did with the uncertainties package
+        names = details.covar_vars
+        icoefs = [int(name[1:]) for name in names]
+        uvars = correlated_values([coefs[i] for i in icoefs], details.covar)
+        def with_coefs(args):
+            out = 1.0*coefs
+            out[icoefs] = args
+            return out
+        def my_dsplev(*args):
+            return splev(kraw[:nkx], [knots, with_coefs(args), order])[index]
+        def my_dchi(*args):
+            return spline_eval(kraw[:nkx], mu, knots, with_coefs(args),
+                               order, kout)[1][index]
+        fdbkg = wrap(my_dsplev)
+        fdchi = wrap(my_dchi)
+        self.assertEqual(dat.delta_bkg.shape, dat.mu.shape)
+        self.assertTrue(np.all(dat.delta_bkg[:ie0] == 0))
+        for index in range(0, nkx, 7):
+            dbkg = fdbkg(*uvars).std_dev()
+            self.assertTrue(abs(dat.delta_bkg[ie0+index] - dbkg) <
+                            1.e-5*dbkg + 1.e-12, index)
+        self.assertEqual(dat.delta_chi.shape, dat.k.shape)
+        for index in range(0, len(kout), 11):
+            dchi = fdchi(*uvars).std_dev()/dat.edge_step
+            self.assertTrue(abs(dat.delta_chi[index] - dchi) <
+                            1.e-5*dchi + 1.e-12, index)
+
+if __name__ == '__main__':  # pragma: no cover
+    for suite in (TestAutobkUncertainties,):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+""" Larch Tests:
+  autobk_batch for stacks of spectra
+"""
+import unittest
+import numpy as np
+
+from utils import TestCase
+
+SETUP = """
+d = read_ascii('../examples/xafsdata/cu.xmu', labels='energy mu i0')
+g = group(energy=d.energy, mu=array([d.mu, d.mu*1.1, d.mu*0.9+0.01]))
+"""
+
+class TestAutobkBatch(TestCase):
+    '''autobk_batch'''
+    def test_group_e0_edge_step(self):
+        "e0 and edge_step are taken from the group, as for autobk()"
+        self.trytext(SETUP)
+        self.trytext("""
+g.e0 = 8990.0
+g.edge_step = array([1.0, 1.1, 0.9])
+autobk_batch(g, rbkg=1.0, kweight=2)
+""")
+        self.NoExceptionRaised()
+        self.isValue('g.e0', 8990.0)
+        self.isTrue("allclose(g.edge_step, [1.0, 1.1, 0.9])")
+        self.isTrue("g.chi.shape == (3, len(g.k))")
+
+    def test_find_e0_edge_step(self):
+        self.trytext(SETUP)
+        self.trytext("autobk_batch(g, rbkg=1.0, kweight=2)")
+        self.NoExceptionRaised()
+        self.isTrue("g.e0 > 8950 and g.e0 < 9000")
+        self.isTrue("allclose(g.edge_step[1]/g.edge_step[0], 1.1)")
+        self.isTrue("max(abs(g.chi[0] - g.chi[1])) < 0.01")
+
+    def test_bad_argument(self):
+        self.trytext(SETUP)
+        out, err = self.trytext("autobk_batch(g, rbkg=1.0, foo=1)")
+        self.assertTrue('Unrecognized arguments for autobk_batch():\n' in out)
+        self.isFalse("hasattr(g, 'chi')")
+
+if __name__ == '__main__':  # pragma: no cover
+    for suite in (TestAutobkBatch,):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=2).run(suite)
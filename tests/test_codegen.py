@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+""" Larch Tests:
+  compiled procedures and loops give the same results as the interpreter
+"""
+import unittest
+import re
+import numpy as np
+from StringIO import StringIO
+
+from utils import LarchSession
+
+LOOPS = """
+total = 0
+for i in range(10):
+    if i == 7:
+        break
+    elif i % 2 == 0:
+        continue
+    endif
+    total += i*i
+else:
+    total = -1
+endfor
+n = 0
+while n < 5:
+    n = n + 1
+else:
+    n = n * 10
+endwhile
+pairs = []
+for a, b in zip([1, 2, 3], 'xyz'):
+    pairs.append((b, a))
+endfor
+x = linspace(0, 1, 11)
+y = zeros(11)
+for i, xi in enumerate(x):
+    y[i] = sqrt(xi) + x[:i+1].sum()
+    y[i:] = y[i:] + 1
+endfor
+g = group(a=1)
+for k in range(3):
+    g.a = g.a * 2
+    sq = [j*j for j in range(k+3) if j != 1]
+    print(k, g.a, -k, sq)
+endfor
+"""
+
+PROCEDURES = """
+def smooth(y, n=3):
+    out = y*1.0
+    for i in range(n, len(y)-n):
+        out[i] = y[i-n:i+n+1].mean()
+    endfor
+    return out
+enddef
+
+def find_edge(x, y):
+    dy = diff(y)/diff(x)
+    imax = 0
+    for i in range(len(dy)):
+        if dy[i] > dy[imax]:
+            imax = i
+        endif
+    endfor
+    return x[imax], dy[imax]
+enddef
+
+def fact(n):
+    if n <= 1:
+        return 1
+    endif
+    return n*fact(n-1)
+enddef
+
+def counts(*args, **kws):
+    return len(args), sorted(kws.keys())
+enddef
+
+def noreturn(a):
+    a.val = 1
+enddef
+
+x = linspace(0, 10, 101)
+y = arctan(x - 4.3) + sin(3*x)/20.
+ys = smooth(y, n=2)
+edge = find_edge(x, ys)
+f10 = fact(10)
+nargs = counts(1, 2, a=3, b=4)
+g = group()
+r = noreturn(g)
+"""
+
+FALLBACK = """
+def with_try(x):
+    try:
+        return 1.0/x
+    except ZeroDivisionError:
+        return -1
+    endtry
+enddef
+
+def with_import():
+    import os
+    return 1
+enddef
+
+def with_chained(x):
+    return 0 < x < 10
+enddef
+
+def with_def():
+    def inner(a):
+        return a + 1
+    enddef
+    return inner(1)
+enddef
+
+def with_del(g):
+    g.b = 2
+    del g.a
+    return 3
+enddef
+
+def with_assert(x):
+    assert x > 0
+    return x
+enddef
+
+g = group(a=1)
+out = [with_try(2), with_try(0), with_import(), with_chained(3),
+       with_chained(30), with_def(), with_del(g), with_assert(4)]
+total = 0
+for i in range(6):
+    if 1 < i < 4:
+        total = total + i
+    endif
+endfor
+"""
+
+ERRORS = ["""
+def f(x):
+    a = 1
+    b = x[5]
+    return a + b
+enddef
+out = f([1, 2])
+""", """
+def f(x):
+    return x.missing
+enddef
+def g(x):
+    return f(x)*2
+enddef
+out = g(group())
+""", """
+total = 0
+for i in range(5):
+    total = total + 10/(3-i)
+endfor
+""", """
+n = 0
+while n < 3:
+    n = n + undefined_name
+endwhile
+""", """
+def f(x):
+    return sqrt(x) + undefined_name
+enddef
+out = [1]
+for i in range(3):
+    out.append(f(i))
+endfor
+"""]
+
+class TestCompiledCode(unittest.TestCase):
+    '''compiled code gives the same results as tree-walking'''
+    def run_script(self, text, compile_code):
+        session = LarchSession()
+        session.symtable._sys.config.compile_code = compile_code
+        session._larch.writer = StringIO()
+        compiler = session._larch.compiler
+        execute = compiler.execute
+        session.ncompiled = 0
+        def counted(*args, **kws):
+            session.ncompiled += 1
+            return execute(*args, **kws)
+        compiler.execute = counted
+        session.run(text)
+        return session
+
+    def compare(self, text, names):
+        "run text in both modes, compare symbols, output, and errors"
+        plain = self.run_script(text, False)
+        comp = self.run_script(text, True)
+        self.assertEqual(plain.ncompiled, 0)
+        for name in names:
+            val1 = plain.get_symbol(name)
+            val2 = comp.get_symbol(name)
+            if isinstance(val1, np.ndarray):
+                self.assertTrue(np.all(val1 == val2), name)
+            else:
+                self.assertEqual(val1, val2, name)
+        self.assertEqual(plain._larch.writer.getvalue(),
+                         comp._larch.writer.getvalue())
+        # the first error is the same, and compiled code stops there,
+        # while the interpreter may go on to record errors from using None
+        errors = []
+        for session in (plain, comp):
+            errors.append([(err.exc, err.lineno,
+                            re.sub('0x[0-9a-f]+', '0x',
+                                   err.get_error()[1].split('\n')[1]))
+                           for err in session.get_errors()])
+        self.assertEqual(errors[0][:1], errors[1][:1])
+        self.assertEqual(len(errors[1]), min(1, len(errors[0])))
+        return plain, comp
+
+    def test_loops(self):
+        plain, comp = self.compare(LOOPS, ('total', 'n', 'pairs', 'x', 'y',
+                                           'sq', 'g.a', 'k', 'i', 'xi', 'j'))
+        self.assertEqual(len(plain.get_errors()), 0)
+        self.assertEqual(comp.ncompiled, 5)
+
+    def test_procedures(self):
+        plain, comp = self.compare(PROCEDURES, ('ys', 'edge', 'f10',
+                                                'nargs', 'g.val', 'r'))
+        self.assertEqual(len(plain.get_errors()), 0)
+        for name in ('smooth', 'find_edge', 'fact', 'counts', 'noreturn'):
+            self.assertTrue(comp.get_symbol(name)._compiled, name)
+        self.assertTrue(comp.ncompiled > 0)
+
+    def test_fallback(self):
+        plain, comp = self.compare(FALLBACK, ('out', 'g.b', 'total'))
+        self.assertEqual(len(plain.get_errors()), 0)
+        for name in ('with_try', 'with_import', 'with_chained', 'with_def',
+                     'with_del', 'with_assert'):
+            self.assertFalse(comp.get_symbol(name)._compiled, name)
+        # only inner() of with_def() is compiled
+        self.assertEqual(comp.ncompiled, 1)
+
+    def test_errors(self):
+        for text in ERRORS:
+            plain, comp = self.compare(text, ())
+            self.assertTrue(len(plain.get_errors()) > 0, text)
+            self.assertTrue(comp.ncompiled > 0, text)
+
+    def test_error_values(self):
+        # symbols set before an error are the same in both modes
+        plain, comp = self.compare(ERRORS[2], ('total', 'i'))
+        self.assertEqual(comp.get_symbol('i'), 3)
+        # the interpreter appends None from the failed call, while
+        # compiled code stops at the call
+        plain, comp = self.compare(ERRORS[4], ('i',))
+        self.assertEqual(comp.get_symbol('out'), [1])
+
+if __name__ == '__main__':  # pragma: no cover
+    for suite in (TestCompiledCode,):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=2).run(suite)
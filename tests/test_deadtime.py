@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+""" Larch Tests:
+  array-based deadtime corrections, compared to the per-detector code
+  they replace
+"""
+import unittest
+import numpy as np
+from numpy.testing import assert_allclose
+
+import larch
+larch.use_plugin_path('xrf')
+larch.use_plugin_path('xrfmap')
+from deadtime import (TAU_TABLES, E_INV, get_taus, icr_newton, icr_estimate,
+                      deadtime_factors, correct_counts, calc_icr)
+from xsp3_hdf5 import XSPRESS3_TAUS, estimate_icr
+
+NPIX, NDET, NCHAN = 20, 4, 64
+
+def old_estimate_icr(ocr, tau, niter=3):
+    "estimate_icr() from xsp3_hdf5, before the deadtime engine"
+    tau = np.asarray(tau, dtype='f8')
+    maxicr = 1.0/tau
+    maxocr = 1/(tau*np.exp(1.0))
+    ocr = np.minimum(ocr, 2*maxocr)
+    icr = 1.0*ocr
+    for c in range(niter):
+        delta = (icr - ocr*np.exp(icr*tau))/(icr*tau - 1)
+        delta = np.where(delta < 0, 0.0, delta)
+        icr = np.minimum(icr + delta, 5*maxicr)
+    return icr
+
+def old_maprow_dtfactor(realtime, livetime, outcounts, inpcounts):
+    "GSEXRM_MapRow dtfactor, before the deadtime engine"
+    dt_denom = outcounts*livetime
+    dt_denom[np.where(dt_denom < 1)] = 1.0
+    return inpcounts*realtime/dt_denom
+
+def old_maprow_total(counts, dtfactor):
+    "GSEXRM_MapRow summed spectra, before the deadtime engine"
+    total = None
+    for imca in range(counts.shape[1]):
+        dtcorr = dtfactor[:, imca].astype('float32')
+        cor   = dtcorr.reshape((dtcorr.shape[0], 1))
+        if total is None:
+            total = counts[:, imca, :] * cor
+        else:
+            total = total + counts[:, imca, :] * cor
+    return total.astype('int32')
+
+class TestDeadtime(unittest.TestCase):
+    '''deadtime engine'''
+    def setUp(self):
+        np.random.seed(11)
+        self.taus = get_taus('xspress3')
+        # output count rates up to just below the maximum, 1/(e*tau)
+        frac = np.random.uniform(0.0, 0.99, size=(NPIX, NDET))
+        self.ocr = frac*E_INV/self.taus
+
+    def test_get_taus(self):
+        assert_allclose(self.taus, TAU_TABLES['xspress3'])
+        self.assertEqual(XSPRESS3_TAUS, TAU_TABLES['xspress3'])
+        self.assertFalse(XSPRESS3_TAUS is TAU_TABLES['xspress3'])
+        assert_allclose(get_taus('xspress3', ndet=6),
+                        TAU_TABLES['xspress3'] + TAU_TABLES['xspress3'][:2])
+        assert_allclose(get_taus([1.e-7, 2.e-7], ndet=3), [1.e-7, 2.e-7, 1.e-7])
+        assert_allclose(get_taus(5.e-8), [5.e-8])
+        self.assertRaises(ValueError, get_taus, 'nodetector')
+
+    def test_lambertw_newton(self):
+        icr_w = icr_estimate(self.ocr, self.taus, method='lambertw')
+        icr_n = icr_estimate(self.ocr, self.taus, method='newton')
+        self.assertEqual(icr_w.shape, (NPIX, NDET))
+        assert_allclose(icr_w, icr_n, rtol=1.e-6)
+        # both solve ocr = icr*exp(-icr*tau) on the lower branch
+        assert_allclose(icr_w*np.exp(-icr_w*self.taus), self.ocr, rtol=1.e-10)
+        self.assertTrue((icr_w >= self.ocr).all())
+        self.assertTrue((icr_w*self.taus <= 1 + 1.e-9).all())
+        self.assertRaises(ValueError, icr_estimate, self.ocr, self.taus,
+                          method='other')
+
+    def test_calc_icr(self):
+        "agrees with the scalar Newton solver, to its tolerance"
+        icr = icr_estimate(self.ocr[:5, 0], self.taus[0])
+        for ocr, val in zip(self.ocr[:5, 0], icr):
+            self.assertTrue(abs(calc_icr(ocr, self.taus[0]) - val) < 0.1)
+
+    def test_saturation(self):
+        tau = self.taus
+        ocr = np.array([E_INV/tau, 2*E_INV/tau, 10/tau])
+        for method in ('lambertw', 'newton'):
+            icr = icr_estimate(ocr, tau, method=method)
+            assert_allclose(icr, np.ones((3, 1))/tau, err_msg=method)
+        # just below the maximum, still on the lower branch
+        icr = icr_estimate(0.999999*E_INV/tau, tau)
+        self.assertTrue((icr < 1.0/tau).all())
+        self.assertTrue((icr > 0.99/tau).all())
+
+    def test_tau_zero(self):
+        tau = np.array([0.0, -1.e-7, 1.e-7, 0.0])
+        for method in ('lambertw', 'newton'):
+            icr = icr_estimate(self.ocr, tau, method=method)
+            for idet in (0, 1, 3):
+                assert_allclose(icr[:, idet], self.ocr[:, idet])
+            self.assertTrue((icr[:, 2] > self.ocr[:, 2]).all())
+        assert_allclose(icr_estimate(self.ocr, 0.0), self.ocr)
+
+    def test_icr_newton(self):
+        icr = icr_newton(self.ocr, self.taus)
+        assert_allclose(icr, icr_estimate(self.ocr, self.taus), rtol=1.e-6)
+        # tol=0 runs all steps, icr_max caps every step
+        icr = icr_newton(self.ocr, self.taus, maxiter=2, tol=0,
+                         icr_max=1.1*self.ocr)
+        self.assertTrue((icr <= 1.1*self.ocr*(1 + 1.e-12)).all())
+
+    def test_estimate_icr(self):
+        "xsp3_hdf5 estimate_icr() is unchanged"
+        ocr = np.concatenate((self.ocr, 3*E_INV/self.taus[None, :]))
+        for niter in (1, 3, 10):
+            assert_allclose(estimate_icr(ocr, self.taus, niter=niter),
+                            old_estimate_icr(ocr, self.taus, niter=niter),
+                            rtol=1.e-14)
+
+    def test_maprow_factors(self):
+        "factors and summed spectra are as from GSEXRM_MapRow"
+        # times in microseconds, as from xMAP clock ticks
+        rticks = np.random.randint(2800, 3400, size=(NPIX, NDET))
+        lticks = (rticks*np.random.uniform(0.5, 1, size=(NPIX, NDET))).astype(int)
+        rtime, ltime = 0.32*rticks, 0.32*lticks
+        ocounts = np.random.randint(0, 50000, size=(NPIX, NDET))
+        icounts = (ocounts*np.random.uniform(1, 1.5, size=(NPIX, NDET))).astype(int)
+        # zero counts and times
+        ocounts[0, :] = 0
+        icounts[0, :] = 0
+        ltime[1, 1] = 0
+        rtime[2, 2] = ltime[2, 2] = 0
+        ocounts[3, 3] = 0
+        ref = old_maprow_dtfactor(rtime, ltime, ocounts, icounts)
+        out = deadtime_factors(rtime, ltime, ocounts, inpcounts=icounts)
+        assert_allclose(out, ref, rtol=1.e-14)
+        self.assertTrue(np.isfinite(out).all())
+
+        counts = np.random.poisson(5, size=(NPIX, NDET, NCHAN))
+        total = correct_counts(counts, out.astype('float32'))
+        self.assertEqual(total.shape, counts.shape)
+        assert_allclose(total.sum(axis=1).astype('int32'),
+                        old_maprow_total(counts, out), atol=1)
+        assert_allclose(correct_counts(ocounts, out), ocounts*out)
+
+    def test_factors_from_tau(self):
+        rtime = np.random.uniform(0.9, 1.1, size=(NPIX, NDET))
+        ltime = rtime*np.random.uniform(0.5, 1, size=(NPIX, NDET))
+        ocounts = self.ocr*ltime
+        out = deadtime_factors(rtime, ltime, ocounts, tau=self.taus)
+        icr = icr_estimate(self.ocr, self.taus)
+        assert_allclose(out, (icr/self.ocr)*(rtime/ltime), rtol=1.e-8)
+        # times in microseconds
+        out_us = deadtime_factors(rtime*1.e6, ltime*1.e6, ocounts,
+                                  tau=self.taus, time_units=1.e-6)
+        assert_allclose(out_us, out, rtol=1.e-8)
+        # no tau and no input counts: live time correction only
+        ltime[0, 0] = 0
+        ocounts[0, :] = 0
+        out = deadtime_factors(rtime, ltime, ocounts)
+        assert_allclose(out[1:], (rtime/ltime)[1:], rtol=1.e-8)
+        self.assertTrue(np.isfinite(deadtime_factors(rtime, ltime, ocounts,
+                                                     tau=self.taus)).all())
+
+if __name__ == '__main__':  # pragma: no cover
+    for suite in (TestDeadtime,):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+""" Larch Tests:
+  chi(k) for Feff paths, and its caching
+"""
+import unittest
+import numpy as np
+from scipy.interpolate import UnivariateSpline
+
+from utils import TestCase
+import larch
+larch.use_plugin_path('xafs')
+from feffdat import FeffDatFile, ETOK, SMALL
+
+FEFFDIR = '../examples/feffit'
+
+def old_path_chi(fdat, k, degen, s02, e0, ei, deltar, sigma2, third, fourth):
+    "chi(k) for one path, as FeffPathGroup._calc_chi did for each path"
+    reff = fdat.reff
+    en = k*k - e0*ETOK
+    if min(abs(en)) < SMALL:
+        en[np.where(abs(en) < 2*SMALL)] = SMALL
+    q = np.sign(en)*np.sqrt(abs(en))
+    pha = UnivariateSpline(fdat.k, fdat.pha, s=0)(q)
+    amp = UnivariateSpline(fdat.k, fdat.amp, s=0)(q)
+    rep = UnivariateSpline(fdat.k, fdat.rep, s=0)(q)
+    lam = UnivariateSpline(fdat.k, fdat.lam, s=0)(q)
+    pp   = (rep + 1j/lam)**2 + 1j * ei * ETOK
+    p    = np.sqrt(pp)
+    cchi = np.exp(-2*reff*p.imag - 2*pp*(sigma2 - pp*fourth/3) +
+                  1j*(2*q*reff + pha +
+                      2*p*(deltar - 2*sigma2/reff - 2*pp*third/3) ))
+    cchi = degen * s02 * amp * cchi / (q*(reff + deltar)**2)
+    cchi[0] = 2*cchi[1] - cchi[2]
+    return cchi
+
+class TestFeffPathChi(TestCase):
+    '''cached chi(k) for feff paths'''
+    def setUp(self):
+        TestCase.setUp(self)
+        self.trytext("""
+p1 = feffpath('%s/feff0001.dat', sigma2=0.003)
+p2 = feffpath('%s/feff0002.dat', sigma2=0.003)
+g1 = ff2chi([p1])
+chi1 = g1.chi
+""" % (FEFFDIR, FEFFDIR))
+        self.NoExceptionRaised()
+
+    def test_repeat(self):
+        self.trytext("g = ff2chi([p1])")
+        self.NoExceptionRaised()
+        self.isTrue("allclose(g.chi, chi1)")
+
+    def test_path_params(self):
+        self.trytext("p1.sigma2 = 0.006\ng = ff2chi([p1])")
+        self.NoExceptionRaised()
+        self.isFalse("allclose(g.chi, chi1)")
+        self.trytext("p1.sigma2 = 0.003\ng = ff2chi([p1])")
+        self.isTrue("allclose(g.chi, chi1)")
+
+    def test_k_grid(self):
+        self.trytext("g = ff2chi([p1], k=g1.k*1.001)")
+        self.NoExceptionRaised()
+        self.isFalse("allclose(g.chi, chi1)")
+
+    def test_replace_feffdat(self):
+        self.trytext("""
+g2 = ff2chi([p2])
+p1._feffdat = p2._feffdat
+p1.degen = p2.degen
+g = ff2chi([p1])
+""")
+        self.NoExceptionRaised()
+        self.isTrue("allclose(g.chi, g2.chi)")
+        self.isFalse("allclose(g.chi, chi1)")
+
+    def test_replace_array(self):
+        self.trytext("""
+p1._feffdat.amp = 2*p1._feffdat.amp
+g = ff2chi([p1])
+""")
+        self.NoExceptionRaised()
+        self.isTrue("allclose(g.chi, 2*chi1)")
+
+    def test_replace_array_linear(self):
+        "a replaced array may reuse the id of the one it replaces"
+        fdat = FeffDatFile('%s/feff0001.dat' % FEFFDIR,
+                           _larch=self.session._larch)
+        k = np.linspace(0, 15, 301)
+        amp = fdat._interp(k, interp='linear')[2].copy()
+        vals = fdat.amp.tolist()
+        fdat.amp = None
+        new = np.array(vals)
+        new *= 2
+        fdat.amp = new
+        out = fdat._interp(k, interp='linear')[2]
+        self.assertTrue(np.allclose(out, 2*amp))
+
+    def test_change_array_in_place(self):
+        self.trytext("""
+p1._feffdat.amp *= 2
+p1._feffdat._clear_cache()
+g = ff2chi([p1])
+""")
+        self.NoExceptionRaised()
+        self.isTrue("allclose(g.chi, 2*chi1)")
+
+class TestFF2ChiStack(TestCase):
+    '''ff2chi for all paths at once, compared to one path at a time'''
+    PARS = ((2, 0.9, 0.0, 0.0, 0.0, 0.003, 0.0, 0.0),
+            (4, 0.8, 3.1, 0.0, 0.02, 0.005, 0.0, 0.0),
+            (6, 1.1, -2.2, 0.5, -0.01, 0.008, 1.e-4, 1.e-5),
+            (1, 0.7, 0.0, 1.5, 0.03, 0.010, -2.e-4, 0.0))
+
+    def setUp(self):
+        TestCase.setUp(self)
+        lines = []
+        for i, pars in enumerate(self.PARS):
+            lines.append("p%i = feffpath('%s/feff%4.4i.dat', degen=%g, s02=%g,"
+                         " e0=%g, ei=%g, deltar=%g, sigma2=%g, third=%g,"
+                         " fourth=%g)" % ((i+1, FEFFDIR, i%3 + 1) + pars))
+        self.trytext('\n'.join(lines))
+        self.NoExceptionRaised()
+        self.paths = [self.session.get_symbol('p%i' % (i+1)) for i in range(len(self.PARS))]
+
+    def check(self, k):
+        total = np.zeros(len(k))
+        for path, pars in zip(self.paths, self.PARS):
+            cchi = old_path_chi(path._feffdat, k, *pars)
+            self.assertTrue(np.allclose(path.k, k))
+            self.assertTrue(np.allclose(path.chi, cchi.imag,
+                                        rtol=1.e-10, atol=1.e-12))
+            self.assertTrue(np.allclose(path.chi_imag, -cchi.real,
+                                        rtol=1.e-10, atol=1.e-12))
+            total += cchi.imag
+        g = self.session.get_symbol('g')
+        self.assertTrue(np.allclose(g.k, k))
+        self.assertTrue(np.allclose(g.chi, total, rtol=1.e-10, atol=1.e-12))
+
+    def test_default_k(self):
+        self.trytext("g = ff2chi([p1, p2, p3, p4])")
+        self.NoExceptionRaised()
+        kmax = min(max(self.paths[0]._feffdat.k), 30.0)
+        self.check(0.05*np.arange(int(1.01 + kmax/0.05)))
+
+    def test_given_k(self):
+        k = np.linspace(0.0, 14.0, 113)
+        self.session.symtable.set_symbol('kin', k)
+        self.trytext("g = ff2chi([p1, p2, p3, p4], k=kin)")
+        self.NoExceptionRaised()
+        self.check(k)
+
+    def test_path2chi(self):
+        self.trytext("g = ff2chi([p3, p1, p4, p2], kmax=12, kstep=0.1)")
+        self.NoExceptionRaised()
+        k = 0.1*np.arange(int(1.01 + 12.0/0.1))
+        self.check(k)
+        for i, path in enumerate(self.paths):
+            chi = path.chi.copy()
+            self.trytext("path2chi(p%i, kmax=12, kstep=0.1)" % (i+1))
+            self.assertTrue(np.allclose(path.chi, chi, rtol=1.e-10,
+                                        atol=1.e-12))
+
+if __name__ == '__main__':  # pragma: no cover
+    for suite in (TestFeffPathChi, TestFF2ChiStack):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+""" Larch Tests:
+  feffit with several datasets, in threads, with analytic derivatives,
+  and in fit sessions
+"""
+import unittest
+import numpy as np
+
+from utils import TestCase
+import larch
+larch.use_plugin_path('xafs')
+from feffdat import _ff2chi_deriv
+
+FEFFDIR = '../examples/feffit'
+DATADIR = '../examples/xafsdata'
+
+SETUP = """
+cu_data = read_ascii('%s/cu.chi', labels='k, chi')
+pars = group(amp    = param(1, vary=True),
+             del_e0 = guess(0.1),
+             sig2   = param(0.002, vary=True),
+             del_r  = guess(0.) )
+path1 = feffpath('%s/feffcu01.dat', s02='amp', e0='del_e0',
+                 sigma2='sig2', deltar='del_r')
+trans1 = feffit_transform(kmin=3, kmax=17, kw=2, dk=4, window='kaiser',
+                          rmin=1.4, rmax=3.0)
+trans2 = feffit_transform(kmin=3, kmax=14, kw=1, dk=4, window='kaiser',
+                          rmin=1.4, rmax=3.0)
+dset1 = feffit_dataset(data=cu_data, pathlist=[path1], transform=trans1)
+dset2 = feffit_dataset(data=cu_data, pathlist=[path1], transform=trans2)
+""" % (DATADIR, FEFFDIR)
+
+class TestFeffitThreads(TestCase):
+    '''feffit with datasets evaluated in threads'''
+    def fit(self, nthreads):
+        self.trytext(SETUP)
+        self.trytext("out = feffit(pars, [dset1, dset2], nthreads=%i)" % nthreads)
+        self.NoExceptionRaised()
+        out = {}
+        for name in ('amp', 'del_e0', 'sig2', 'del_r'):
+            out[name] = self.session.run("pars.%s.value" % name)
+        for name in ('dset1.model.chi', 'dset2.model.chi', 'path1.chi',
+                     'dset1.nresid', 'dset2.nresid',
+                     'pars.fit_details.nfev'):
+            out[name] = self.session.run(name)
+        return out
+
+    def test_threads_match_serial(self):
+        serial = self.fit(1)
+        threaded = self.fit(2)
+        for name, val in serial.items():
+            self.assertTrue(np.allclose(val, threaded[name]), name)
+
+    def test_residual_calls(self):
+        out = self.fit(2)
+        self.assertTrue(out['dset1.nresid'] >= out['pars.fit_details.nfev'])
+        self.assertEqual(out['dset1.nresid'], out['dset2.nresid'])
+        # residual of the data alone is not counted
+        self.trytext("x = dset1._residual(data_only=True)")
+        self.NoExceptionRaised()
+        self.isValue('dset1.nresid', out['dset1.nresid'])
+        report = self.session.run("feffit_report(out)")
+        lines = [l for l in report.split('\n') if 'residual calls' in l]
+        self.assertEqual(len(lines), 2)
+        for line, name in zip(lines, ('dset1', 'dset2')):
+            ncalls = int(line.split('=')[1].split('(')[0])
+            self.assertEqual(ncalls, out['%s.nresid' % name])
+            self.assertTrue(line.strip().endswith('sec)'))
+
+class TestFeffitJacobian(TestCase):
+    '''analytic derivatives of chi(k), compared to finite differences'''
+    PATHPARS = ('degen', 's02', 'e0', 'ei', 'deltar', 'sigma2',
+                'third', 'fourth')
+
+    def test_path_derivs(self):
+        self.trytext("""
+p = feffpath('%s/feffcu01.dat', s02=0.9, e0=2.5, ei=0.8, deltar=0.02,
+             sigma2=0.006, third=2.e-4, fourth=1.e-5)
+kin = linspace(0, 16, 321)
+g = ff2chi([p], k=kin)
+""" % FEFFDIR)
+        self.NoExceptionRaised()
+        path = self.session.get_symbol('p')
+        k = self.session.get_symbol('kin')
+        dchi = _ff2chi_deriv([path], k)
+        self.assertEqual(dchi.shape, (1, 8, len(k)))
+        for ipar, name in enumerate(self.PATHPARS):
+            val = getattr(path, name)
+            step = 1.e-4*abs(val)
+            chis = []
+            for pval in (val + step, val - step):
+                setattr(path, name, pval)
+                self.trytext("g = ff2chi([p], k=kin)")
+                chis.append(self.session.get_symbol('g.chi'))
+            setattr(path, name, val)
+            fdiff = (chis[0] - chis[1])/(2*step)
+            scale = abs(fdiff).max()
+            self.assertTrue(scale > 0, name)
+            self.assertTrue(abs(dchi[0, ipar] - fdiff).max() < 1.e-4*scale,
+                            name)
+
+    def fit(self, jacobian):
+        self.trytext(SETUP)
+        self.trytext("out = feffit(pars, [dset1, dset2], jacobian=%s)" %
+                     repr(jacobian))
+        self.NoExceptionRaised()
+        out = {}
+        for name in ('amp', 'del_e0', 'sig2', 'del_r'):
+            out[name] = (self.session.run("pars.%s.value" % name),
+                         self.session.run("pars.%s.stderr" % name))
+        out['chi_square'] = self.session.run("pars.chi_square")
+        return out
+
+    def test_fit(self):
+        fdiff = self.fit(False)
+        analytic = self.fit(True)
+        for name in ('amp', 'del_e0', 'sig2', 'del_r'):
+            val, err = fdiff[name]
+            self.assertTrue(abs(analytic[name][0] - val) < 0.01*err, name)
+            self.assertTrue(abs(analytic[name][1] - err) < 0.01*err, name)
+        self.assertTrue(abs(analytic['chi_square'] - fdiff['chi_square']) <
+                        1.e-4*fdiff['chi_square'])
+
+class TestFeffitSession(TestCase):
+    '''repeated, warm-started fits'''
+    def setUp(self):
+        TestCase.setUp(self)
+        self.trytext(SETUP)
+        self.NoExceptionRaised()
+
+    def values(self):
+        return [self.session.run("pars.%s.value" % name)
+                for name in ('amp', 'del_e0', 'sig2', 'del_r')]
+
+    def test_matches_feffit(self):
+        self.trytext("""
+out = feffit(pars, [dset1, dset2])
+best = [pars.amp.value, pars.del_e0.value, pars.sig2.value, pars.del_r.value]
+pars.amp.value = 1
+pars.del_e0.value = 0.1
+pars.sig2.value = 0.002
+pars.del_r.value = 0
+sess = feffit_session(pars, [dset1, dset2])
+sout = sess.fit()
+""")
+        self.NoExceptionRaised()
+        self.assertTrue(np.allclose(self.values(), self.session.run('best')))
+        self.isValue('sess.nfits', 1)
+        self.isTrue("allclose(sout.datasets[0].model.chi, dset1.model.chi)")
+
+    def test_warm_start(self):
+        self.trytext("""
+sess = feffit_session(pars, [dset1, dset2])
+out1 = sess.fit()
+nfev1 = pars.fit_details.nfev
+out2 = sess.fit()
+""")
+        self.NoExceptionRaised()
+        best = self.values()
+        # nothing changed: the last result is returned
+        self.isTrue("out1 is out2")
+        self.isValue('sess.nfits', 1)
+
+        # a changed model is re-fit, starting from the best-fit values
+        self.trytext("""
+trans1.kmax = 16.5
+out3 = sess.fit()
+nfev3 = pars.fit_details.nfev
+""")
+        self.NoExceptionRaised()
+        self.isFalse("out3 is out1")
+        self.isValue('sess.nfits', 2)
+        self.isTrue("nfev3 < nfev1")
+        warm = self.values()
+
+        # a cold start from the initial values gives the same fit
+        self.trytext("""
+pars.amp.value = 1
+pars.del_e0.value = 0.1
+pars.sig2.value = 0.002
+pars.del_r.value = 0
+sess.reset()
+out4 = sess.fit()
+""")
+        self.NoExceptionRaised()
+        self.isValue('sess.nfits', 1)
+        cold = self.values()
+        for wval, cval, bval in zip(warm, cold, best):
+            self.assertTrue(abs(wval - cval) < 1.e-3*max(abs(bval), 1.e-3))
+
+    def test_no_warm_start(self):
+        self.trytext("""
+sess = feffit_session(pars, [dset1, dset2])
+out1 = sess.fit()
+nfev1 = pars.fit_details.nfev
+pars.amp.value = 1
+pars.del_e0.value = 0.1
+pars.sig2.value = 0.002
+pars.del_r.value = 0
+out2 = sess.fit(warm_start=False)
+""")
+        self.NoExceptionRaised()
+        self.isValue('sess.nfits', 2)
+        self.isValue('pars.fit_details.nfev', self.session.run('nfev1'))
+
+if __name__ == '__main__':  # pragma: no cover
+    for suite in (TestFeffitThreads, TestFeffitJacobian, TestFeffitSession):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=2).run(suite)
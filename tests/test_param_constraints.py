@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+""" Larch Tests:
+  compiled constraint expressions for Parameters, compared to the
+  interpreter, and dependency-ordered constraint updates
+"""
+import unittest
+import numpy as np
+
+from utils import TestCase
+from larch.fitting.parameter import ConstraintEvaluator
+
+SETUP = """
+pars = group(a=param(2.0, vary=True), x=param(0.5, vary=True))
+pars.b = param(expr='a*3 + sqrt(a)')
+pars.c = param(expr='b - x')
+pars.d = param(expr='c*b + a')
+pars.e = param(expr='a*2')
+_sys.paramGroup = pars
+"""
+
+class TestConstraints(TestCase):
+    '''constraint expressions'''
+    def setUp(self):
+        TestCase.setUp(self)
+        self.trytext(SETUP)
+        self.NoExceptionRaised()
+        self.pars = self.getSym('pars')
+
+    def interp(self, expr):
+        "value of expr from the interpreter, with Parameter values"
+        return self.session.run(expr)
+
+    def check(self, name, expr):
+        par = getattr(self.pars, name)
+        self.assertAlmostEqual(par.value, self.interp(expr), places=12)
+        self.assertTrue(par._code is not None)
+
+    def test_values(self):
+        self.check('b', 'pars.a.value*3 + sqrt(pars.a.value)')
+        self.check('d', '(pars.b.value - pars.x.value)*pars.b.value + pars.a.value')
+        self.trytext("pars.a.value = 5.0")
+        self.check('b', 'a*3 + sqrt(a)')
+        self.check('c', 'b - x')
+        self.check('d', 'c*b + a')
+
+    def test_shadowed_parameter(self):
+        "a local Parameter shadows one in the parameter group"
+        self.trytext("""
+def local_b():
+    a = param(10.0)
+    return pars.b.value
+enddef
+bval = local_b()
+""")
+        self.NoExceptionRaised()
+        self.isNear('bval', 30 + np.sqrt(10.))
+        self.isNear('pars.b.value', 6 + np.sqrt(2.))
+
+    def test_shadowed_function(self):
+        "a Procedure defined later shadows a compiled function"
+        self.isNear('pars.b.value', 6 + np.sqrt(2.))
+        self.trytext("""
+def sqrt(x):
+    return 100.0
+enddef
+""")
+        self.isNear('pars.b.value', 106.0)
+        self.assertTrue(self.pars.b._code is None)
+        self.trytext("del sqrt")
+        self.isNear('pars.b.value', 6 + np.sqrt(2.))
+
+    def test_replaced_parameter(self):
+        self.isNear('pars.c.value', 6 + np.sqrt(2.) - 0.5)
+        self.trytext("pars.x = param(1.5)")
+        self.isNear('pars.c.value', 6 + np.sqrt(2.) - 1.5)
+
+    def test_update_order(self):
+        cons = ConstraintEvaluator(self.pars)
+        order = cons.order
+        self.assertEqual(sorted(order), ['b', 'c', 'd', 'e'])
+        self.assertTrue(order.index('b') < order.index('c') < order.index('d'))
+        self.assertEqual(cons.downstream['a'], set(['b', 'c', 'd', 'e']))
+        self.assertEqual(cons.downstream['x'], set(['c', 'd']))
+
+        pars = self.pars
+        pars.a._val = 4.0
+        cons.update(['a'])
+        b = 12 + np.sqrt(4.)
+        self.assertAlmostEqual(pars.b._val, b)
+        self.assertAlmostEqual(pars.c._val, b - 0.5)
+        self.assertAlmostEqual(pars.d._val, (b - 0.5)*b + 4.0)
+
+        self.assertAlmostEqual(pars.e._val, 8.0)
+
+        # only constraints downstream of changed values are evaluated
+        pars.a._val = 1.0
+        pars.x._val = 2.5
+        cons.update(['x'])
+        self.assertAlmostEqual(pars.e._val, 8.0)
+        self.assertAlmostEqual(pars.c._val, 4.0 - 2.5)
+        self.assertAlmostEqual(pars.d._val, (4.0 - 2.5)*4.0 + 1.0)
+        cons.update()
+        self.assertAlmostEqual(pars.e._val, 2.0)
+
+    def test_update_uncompiled(self):
+        "constraints that cannot be compiled are always evaluated"
+        self.trytext("""
+scale = 2.0
+pars.f = param(expr='a*scale')
+""")
+        cons = ConstraintEvaluator(self.pars)
+        self.assertEqual(cons.always, set(['f']))
+        self.trytext("scale = 3.0")
+        cons.update([])
+        self.assertAlmostEqual(self.pars.f._val, 6.0)
+
+if __name__ == '__main__':  # pragma: no cover
+    for suite in (TestConstraints,):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=2).run(suite)
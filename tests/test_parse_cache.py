@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+""" Larch Tests:
+  caches of parsed statements and translated scripts
+"""
+import unittest
+import os
+import shutil
+import tempfile
+
+from utils import TestCase
+from larch.utils import LRUCache
+
+class TestLRUCache(unittest.TestCase):
+    '''bounded cache'''
+    def test_eviction_order(self):
+        cache = LRUCache(maxsize=3)
+        for key in 'abc':
+            cache.put(key, key.upper())
+        self.assertEqual(cache.get('a'), 'A')
+        cache.put('d', 'D')
+        # 'b' was least recently used
+        self.assertFalse('b' in cache)
+        self.assertEqual(list(cache.data.keys()), ['c', 'a', 'd'])
+        # putting an existing key also marks it as recently used
+        cache.put('c', 'C2')
+        cache.put('e', 'E')
+        self.assertEqual(list(cache.data.keys()), ['d', 'c', 'e'])
+        self.assertEqual(cache.get('c'), 'C2')
+        self.assertEqual(len(cache), 3)
+
+    def test_counts(self):
+        cache = LRUCache(maxsize=2)
+        self.assertEqual(cache.get('a', -1), -1)
+        cache.put('a', 1)
+        cache.put('b', None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertTrue(cache.get('b', 2) is None)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+        self.assertEqual((stats['size'], stats['maxsize']), (2, 2))
+        self.assertAlmostEqual(stats['hit_rate'], 200/3.)
+        stats = cache.stats(reset=True)
+        self.assertEqual(stats['hits'], 2)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (0, 0))
+        self.assertEqual(stats['hit_rate'], 0.0)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_maxsize_zero(self):
+        cache = LRUCache(maxsize=0)
+        cache.put('a', 1)
+        self.assertEqual(len(cache), 0)
+        self.assertTrue(cache.get('a') is None)
+
+class TestParseCache(TestCase):
+    '''cached parsing of statements and scripts'''
+    def setUp(self):
+        TestCase.setUp(self)
+        self.dirname = tempfile.mkdtemp(prefix='larch_scripts_')
+        self.fname = os.path.join(self.dirname, 'script.lar')
+        self.session._larch.parse_cache_stats(reset=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def write(self, text, mtime=None):
+        with open(self.fname, 'w') as fh:
+            fh.write(text)
+        if mtime is not None:
+            os.utime(self.fname, (mtime, mtime))
+
+    def stats(self, cache='scripts'):
+        return self.session._larch.parse_cache_stats()[cache]
+
+    def test_parse_cache_stats(self):
+        self.trytext("x = 1\nx = 1\nx = 1")
+        self.trytext("stats = parse_cache_stats()")
+        self.NoExceptionRaised()
+        stats = self.session.get_symbol('stats')
+        self.assertEqual(sorted(stats.keys()), ['ast', 'scripts'])
+        self.assertTrue(stats['ast']['hits'] >= 2)
+        self.assertEqual(stats['scripts']['hits'], 0)
+        self.trytext("stats = parse_cache_stats(reset=True)")
+        self.assertEqual(self.stats('ast')['hits'], 0)
+
+    def test_rerun(self):
+        self.write("x = 1\nfor i in range(3):\n    x = x + i\nendfor\n",
+                   mtime=1.e9)
+        for i in range(2):
+            self.trytext("run('%s')" % self.fname)
+            self.NoExceptionRaised()
+            self.isValue('x', 4)
+        stats = self.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+        # same size, new modification time
+        self.write("x = 2\nfor i in range(3):\n    x = x + i\nendfor\n",
+                   mtime=1.e9 + 10)
+        self.trytext("run('%s')" % self.fname)
+        self.isValue('x', 5)
+        # same modification time, new size
+        self.write("x = 20\nfor i in range(3):\n    x = x + i\nendfor\n",
+                   mtime=1.e9 + 10)
+        self.trytext("run('%s')" % self.fname)
+        self.isValue('x', 23)
+        stats = self.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 3))
+        self.assertEqual(stats['size'], 3)
+
+    def test_failed_translation(self):
+        self.write("x = 1\nfor i in range(3):\n    x = x + i\n", mtime=1.e9)
+        for i in range(2):
+            self.session._larch.error = []
+            self.trytext("run('%s')" % self.fname)
+            self.assertTrue(len(self.session.get_errors()) > 0)
+        stats = self.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (0, 2))
+        self.assertEqual(stats['size'], 0)
+
+if __name__ == '__main__':  # pragma: no cover
+    for suite in (TestLRUCache, TestParseCache):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+""" Larch Tests:
+  lazily loaded plugins and the plugin manifest
+"""
+import unittest
+import os
+import shutil
+import tempfile
+
+from larch import Interpreter
+from larch.builtins import PluginManifest
+
+BROKEN = """x = 1/0
+def f():
+    return 1
+def registerLarchPlugin():
+    return ('_lazytest', {'f': f})
+"""
+
+FIXED = """def f():
+    return 1
+def registerLarchPlugin():
+    return ('_lazytest', {'f': f})
+"""
+
+class TestPluginLoader(unittest.TestCase):
+    '''testing plugin stubs and manifest'''
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp(prefix='larch_test_')
+        self.symtable = Interpreter().symtable
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def write_plugin(self, text):
+        for fname in os.listdir(self.dirname):
+            if fname.endswith('.pyc'):
+                os.unlink(os.path.join(self.dirname, fname))
+        with open(os.path.join(self.dirname, 'lazytest.py'), 'w') as fh:
+            fh.write(text)
+
+    def test_failed_import(self):
+        "a plugin that fails to import raises its error on each use"
+        self.write_plugin(BROKEN)
+        errors = []
+        loader = self.symtable.add_plugin_stubs('lazytest', self.dirname,
+                                                '_lazytest', ['f'],
+                                                errors.append)
+        for i in range(2):
+            self.assertRaises(ZeroDivisionError,
+                              self.symtable.get_symbol('_lazytest.f'))
+            self.assertFalse(loader.loaded)
+        self.write_plugin(FIXED)
+        self.assertEqual(self.symtable.get_symbol('_lazytest.f')(), 1)
+        self.assertTrue(loader.loaded)
+
+    def test_manifest_save(self):
+        fname = os.path.join(self.dirname, 'manifest.json')
+        manifest = PluginManifest(fname=fname)
+        self.write_plugin(FIXED)
+        path = os.path.join(self.dirname, 'lazytest.py')
+        manifest.set(path, {'group': '_lazytest', 'symbols': ['f'],
+                            'lazy': True})
+        manifest.save()
+        self.assertFalse(manifest.changed)
+        self.assertEqual(sorted(os.listdir(self.dirname)),
+                         ['lazytest.py', 'manifest.json'])
+        manifest = PluginManifest(fname=fname)
+        self.assertEqual(manifest.get(path)['symbols'], ['f'])
+
+if __name__ == '__main__':  # pragma: no cover
+    for suite in (TestPluginLoader,):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=2).run(suite)
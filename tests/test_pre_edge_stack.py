@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+""" Larch Tests:
+  pre_edge and find_e0 for stacks of spectra, compared to one spectrum
+  at a time
+"""
+import unittest
+import numpy as np
+
+from utils import TestCase
+
+ATTRS = ('e0', 'edge_step', 'norm', 'pre_edge', 'post_edge', 'pre_slope',
+         'pre_offset', 'norm_c0', 'norm_c1', 'norm_c2', 'norm_c3',
+         'pre1', 'pre2', 'norm1', 'norm2')
+
+# shifted edges, so that spectra have different e0 and ranges
+SETUP = """
+d = read_ascii('../examples/xafsdata/cu_rt01.xmu', labels='energy mu i0')
+en = d.energy
+g = group(energy=en, mu=array([d.mu,
+                               interp(en, d.mu, clip(en - 4.0, en[0], en[-1])),
+                               2*interp(en, d.mu, clip(en + 9.0, en[0], en[-1])),
+                               0.5*d.mu + 0.1]))
+"""
+
+PRE_EDGE = """
+pre_edge(g%(kws)s)
+singles = []
+for i in range(len(g.mu)):
+    s = group(energy=g.energy, mu=g.mu[i])
+    pre_edge(s%(kws)s)
+    singles.append(s)
+endfor
+"""
+
+class TestPreEdgeStack(TestCase):
+    '''pre_edge with 2-D mu'''
+    def setUp(self):
+        TestCase.setUp(self)
+        self.trytext(SETUP)
+        self.NoExceptionRaised()
+
+    def run_stack(self, kws=''):
+        self.trytext(PRE_EDGE % {'kws': kws})
+        self.NoExceptionRaised()
+        return self.getSym('g'), self.getSym('singles')
+
+    def test_attributes(self):
+        for kws in ('', ', pre1=-150, norm1=50, norm2=700',
+                    ', e0=8985.0, nvict=1'):
+            stack, singles = self.run_stack(kws)
+            self.assertEqual(len(singles), 4)
+            if 'e0' not in kws:
+                self.assertTrue(len(set(stack.e0)) > 1)
+            for i, single in enumerate(singles):
+                for attr in ATTRS:
+                    sval = getattr(single, attr)
+                    self.assertTrue(np.allclose(getattr(stack, attr)[i], sval,
+                                                rtol=1.e-7, atol=1.e-9),
+                                    (kws, attr))
+
+    def test_find_e0(self):
+        self.trytext("""
+e0_stack = find_e0(g.energy, g.mu)
+e0_single = [find_e0(g.energy, mu) for mu in g.mu]
+""")
+        self.NoExceptionRaised()
+        self.isTrue("allclose(e0_stack, e0_single)")
+        self.isTrue("e0_stack[1] > e0_stack[0] and e0_stack[2] < e0_stack[0]")
+
+    def test_flat(self):
+        "flat uses an exact least-squares quadratic"
+        self.run_stack()
+        self.trytext("""
+flats = []
+for i in range(len(g.mu)):
+    s = singles[i]
+    ie0 = index_nearest(g.energy, s.e0)
+    p1 = index_of(g.energy, s.norm1 + s.e0)
+    p2 = index_nearest(g.energy, s.norm2 + s.e0)
+    coefs = polyfit(g.energy[p1:p2], s.norm[p1:p2], 2)
+    diff = polyval(coefs, g.energy)
+    flat = s.norm - diff + diff[ie0]
+    flat[:ie0] = s.norm[:ie0]
+    flats.append(flat)
+endfor
+""")
+        self.NoExceptionRaised()
+        self.isTrue("allclose(g.flat, array(flats), rtol=0, atol=1.e-9)")
+        # the 1-d fit to the same quadratic stops at its tolerance
+        for i in range(4):
+            self.isTrue("max(abs(g.flat[%i] - singles[%i].flat)) < 0.02"
+                        % (i, i))
+
+if __name__ == '__main__':  # pragma: no cover
+    for suite in (TestPreEdgeStack,):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+""" Larch Tests:
+  cached symbol lookups in the SymbolTable
+"""
+import unittest
+
+from utils import TestCase
+from larch.symboltable import Group
+
+class TestLookupCache(TestCase):
+    '''symbol lookup cache'''
+    def setUp(self):
+        TestCase.setUp(self)
+        self.symtable = self.session.symtable
+        self.trytext("""
+x = 1
+g = group(a=10, sub=group(b=20))
+""")
+        self.NoExceptionRaised()
+        self.symtable.lookup_stats(reset=True)
+
+    def lookup(self, name):
+        return self.symtable.get_symbol(name)
+
+    def test_hits(self):
+        for i in range(3):
+            self.assertEqual(self.lookup('x'), 1)
+            self.assertEqual(self.lookup('g.sub.b'), 20)
+        stats = self.symtable.lookup_stats()
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['hits'], 4)
+        self.assertTrue(stats['size'] >= 2)
+        self.assertAlmostEqual(stats['hit_rate'], 400/6.)
+        # values of members are not cached
+        self.trytext("g.sub.b = 30")
+        self.assertEqual(self.lookup('g.sub.b'), 30)
+        stats = self.symtable.lookup_stats(reset=True)
+        self.assertEqual(stats['invalidations'], 0)
+        stats = self.symtable.lookup_stats()
+        self.assertEqual(stats['hits'], 0)
+        self.assertEqual(stats['misses'], 0)
+        self.assertEqual(stats['hit_rate'], 0.0)
+
+    def test_set_del_symbol(self):
+        self.assertEqual(self.lookup('g.sub.b'), 20)
+        self.symtable.set_symbol('g.sub', Group(b=-1))
+        self.assertEqual(self.lookup('g.sub.b'), -1)
+        self.symtable.del_symbol('g.sub.b')
+        self.assertRaises(LookupError, self.lookup, 'g.sub.b')
+        self.assertEqual(self.lookup('x'), 1)
+        self.symtable.del_symbol('x')
+        self.assertRaises(NameError, self.lookup, 'x')
+        self.assertTrue(self.symtable.lookup_stats()['invalidations'] >= 2)
+
+    def test_shadowing(self):
+        "a name added to an earlier search group shadows a cached one"
+        self.assertEqual(self.lookup('pi'), self.lookup('_math.pi'))
+        self.trytext("pi = 3")
+        self.assertEqual(self.lookup('pi'), 3)
+        self.trytext("del pi")
+        self.assertTrue(self.lookup('pi') > 3.14)
+
+    def test_group_mutation(self):
+        "changes to a Group outside the SymbolTable methods"
+        sub = self.lookup('g.sub')
+        g = self.lookup('g')
+        self.assertEqual(self.lookup('g.sub.b'), 20)
+        g.sub = Group(b=5)
+        self.assertEqual(self.lookup('g.sub.b'), 5)
+        del g.sub
+        self.assertRaises(LookupError, self.lookup, 'g.sub.b')
+        g.sub = sub
+        self.assertEqual(self.lookup('g.sub.b'), 20)
+        delattr(sub, 'b')
+        self.assertRaises(LookupError, self.lookup, 'g.sub.b')
+
+    def test_unrelated_groups(self):
+        "changes to other Groups do not invalidate cached names"
+        self.assertEqual(self.lookup('x'), 1)
+        self.assertEqual(self.lookup('g.a'), 10)
+        other = Group()
+        for i in range(5):
+            setattr(other, 'v%i' % i, i)
+        self.trytext("g.sub.c = 1")
+        self.assertEqual(self.lookup('x'), 1)
+        self.assertEqual(self.lookup('g.a'), 10)
+        stats = self.symtable.lookup_stats()
+        self.assertEqual(stats['invalidations'], 0)
+        self.assertEqual(stats['hits'], 2)
+
+    def test_hidden_generation(self):
+        g = self.lookup('g')
+        self.assertEqual(sorted(dir(g)), ['a', 'sub'])
+        self.assertEqual(sorted(g._members().keys()), ['a', 'sub'])
+
+if __name__ == '__main__':  # pragma: no cover
+    for suite in (TestLookupCache,):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+""" Larch Tests:
+  batched XAFS Fourier transforms and cached FT windows, compared to
+  transforming one array at a time
+"""
+import unittest
+import numpy as np
+from numpy.fft import fft, ifft
+
+from utils import TestCase
+
+def old_realimag(arr):
+    "realimag() before it was vectorized"
+    return np.array([(i.real, i.imag) for i in arr]).flatten()
+
+def old_xftf_fast(chi, nfft=2048, kstep=0.05):
+    "xftf_fast() for a single 1-d array, without work arrays"
+    cchi = np.zeros(nfft, dtype='complex128')
+    cchi[0:len(chi)] = chi
+    return (kstep / np.sqrt(np.pi)) * fft(cchi)[:nfft//2]
+
+def old_xftr_fast(chir, nfft=2048, kstep=0.05):
+    "xftr_fast() for a single 1-d array, without work arrays"
+    cchi = np.zeros(nfft, dtype='complex128')
+    cchi[0:len(chir)] = chir
+    return (4*np.sqrt(np.pi)/kstep) * ifft(cchi)[:nfft//2]
+
+def old_transform(dset, diff):
+    "FeffitDataSet._transform() for a single 1-d chi(k) difference"
+    trans = dset.transform
+    iqmin = max(0, int(0.01 + trans.kmin/trans.kstep))
+    iqmax = min(trans.nfft//2,  int(0.01 + trans.kmax/trans.kstep))
+    if trans.fitspace == 'k':
+        eps_k = max(1.e-12, dset.epsilon_k)
+        k = trans.k_[:len(diff)]
+        return ((diff/eps_k) * k**trans.kweight)[iqmin:iqmax]
+    kweights = trans.kweight
+    eps_r = dset.epsilon_r
+    if not isinstance(kweights, list):
+        kweights, eps_r = [kweights], [eps_r]
+    out = []
+    chir = [trans.fftf(diff, kweight=kw) for kw in kweights]
+    if trans.fitspace == 'r':
+        irmin = max(0, int(0.01 + trans.rmin/trans.rstep))
+        irmax = min(trans.nfft//2,  int(0.01 + trans.rmax/trans.rstep))
+        for chir_, eps in zip(chir, eps_r):
+            out.append(old_realimag((chir_/eps)[irmin:irmax]))
+    else:
+        for chir_, eps in zip(chir, eps_r):
+            chiq = trans.fftr(chir_)/eps
+            out.append(old_realimag(chiq[iqmin:iqmax])[::2])
+    return np.concatenate(out)
+
+class TestBatchedFT(TestCase):
+    '''2-d transforms, row by row'''
+    def setUp(self):
+        TestCase.setUp(self)
+        np.random.seed(3)
+        self.chi = np.random.normal(size=(5, 301))
+        self.chir = (np.random.normal(size=(5, 200)) +
+                     1j*np.random.normal(size=(5, 200)))
+        self.session.symtable.set_symbol('chi2d', self.chi)
+        self.session.symtable.set_symbol('chir2d', self.chir)
+
+    def calc(self, expr):
+        out = self.session.run(expr)
+        self.NoExceptionRaised()
+        return out
+
+    def test_realimag(self):
+        out = self.calc("realimag(chir2d[0])")
+        self.assertTrue(np.all(out == old_realimag(self.chir[0])))
+        out = self.calc("realimag(chir2d)")
+        self.assertEqual(out.shape, (5, 400))
+        for row, chir in zip(out, self.chir):
+            self.assertTrue(np.all(row == old_realimag(chir)))
+        out = self.calc("realimag(chi2d[1])")
+        self.assertTrue(np.all(out == old_realimag(self.chi[1])))
+
+    def test_xftf_fast(self):
+        out = self.calc("xftf_fast(chi2d, nfft=1024, kstep=0.05)")
+        self.assertEqual(out.shape, (5, 512))
+        for row, chi in zip(out, self.chi):
+            self.assertTrue(np.allclose(row, old_xftf_fast(chi, nfft=1024),
+                                        rtol=1.e-12, atol=1.e-14))
+        # work arrays are re-used: shorter arrays must be zero-padded
+        for npts in (301, 120, 250, 7):
+            out = self.calc("xftf_fast(chi2d[:, :%i], nfft=1024)" % npts)
+            ref = old_xftf_fast(self.chi[2, :npts], nfft=1024)
+            self.assertTrue(np.allclose(out[2], ref, rtol=1.e-12, atol=1.e-14))
+            out = self.calc("xftf_fast(chi2d[3, :%i], nfft=1024)" % npts)
+            ref = old_xftf_fast(self.chi[3, :npts], nfft=1024)
+            self.assertTrue(np.allclose(out, ref, rtol=1.e-12, atol=1.e-14))
+
+    def test_xftr_fast(self):
+        out = self.calc("xftr_fast(chir2d, nfft=1024, kstep=0.04)")
+        self.assertEqual(out.shape, (5, 512))
+        for row, chir in zip(out, self.chir):
+            ref = old_xftr_fast(chir, nfft=1024, kstep=0.04)
+            self.assertTrue(np.allclose(row, ref, rtol=1.e-12, atol=1.e-14))
+        for npts in (200, 31, 150):
+            out = self.calc("xftr_fast(chir2d[:, :%i], nfft=1024)" % npts)
+            ref = old_xftr_fast(self.chir[4, :npts], nfft=1024)
+            self.assertTrue(np.allclose(out[4], ref, rtol=1.e-12, atol=1.e-14))
+
+class TestTransformWindows(TestCase):
+    '''FT windows cached by the transform parameters'''
+    def setUp(self):
+        TestCase.setUp(self)
+        self.trytext("""
+trans = feffit_transform(kmin=3, kmax=14, kw=2, dk=2, window='hanning',
+                         rmin=1, rmax=3, dr=0.2)
+chi = sin(2.3*trans.k_[:300])*exp(-0.01*trans.k_[:300]**2)
+""")
+        self.NoExceptionRaised()
+        self.trans = self.session.get_symbol('trans')
+        self.chi = self.session.get_symbol('chi')
+
+    def old_fftf(self, kweight):
+        "fftf() with windows made for each transform"
+        self.trytext("""
+_win = ftwindow(trans.k_, xmin=trans.kmin, xmax=trans.kmax, dx=trans.dk,
+                dx2=trans.dk2, window=trans.window)
+""")
+        trans = self.trans
+        win = self.session.get_symbol('_win')
+        cx = self.chi * win[:300] * trans.k_[:300]**kweight
+        return old_xftf_fast(cx, kstep=trans.kstep, nfft=trans.nfft)
+
+    def old_fftr(self, chir):
+        "fftr() with windows made for each transform"
+        self.trytext("""
+_win = ftwindow(trans.r_, xmin=trans.rmin, xmax=trans.rmax, dx=trans.dr,
+                dx2=trans.dr2, window=trans.rwindow)
+""")
+        trans = self.trans
+        win = self.session.get_symbol('_win')
+        cx = chir * win[:len(chir)]
+        return old_xftr_fast(cx, kstep=trans.kstep, nfft=trans.nfft)
+
+    def test_fftf(self):
+        trans = self.trans
+        self.assertTrue(np.allclose(trans.fftf(self.chi), self.old_fftf(2)))
+        self.assertTrue(np.allclose(trans.fftf(self.chi, kweight=3),
+                                    self.old_fftf(3)))
+        for attr, val in (('kmin', 4.0), ('kmax', 11.0), ('dk', 1),
+                          ('window', 'kaiser'), ('kweight', 1)):
+            setattr(trans, attr, val)
+            self.assertTrue(np.allclose(trans.fftf(self.chi),
+                                        self.old_fftf(trans.kweight)), attr)
+        # 2-d arrays give the transform of each row
+        chis = np.array([self.chi, 2*self.chi, self.chi**2])
+        out = trans.fftf(chis)
+        for row, chi in zip(out, chis):
+            self.assertTrue(np.allclose(row, trans.fftf(chi)))
+
+    def test_fftr(self):
+        trans = self.trans
+        chir = trans.fftf(self.chi)[:400]
+        self.assertTrue(np.allclose(trans.fftr(chir), self.old_fftr(chir)))
+        for attr, val in (('rmin', 1.5), ('rmax', 2.2), ('dr', 0.5),
+                          ('rwindow', 'kaiser')):
+            setattr(trans, attr, val)
+            self.assertTrue(np.allclose(trans.fftr(chir),
+                                        self.old_fftr(chir)), attr)
+        chirs = np.array([chir, 1j*chir])
+        out = trans.fftr(chirs)
+        for row, chir_ in zip(out, chirs):
+            self.assertTrue(np.allclose(row, trans.fftr(chir_)))
+
+class TestDatasetTransform(TestCase):
+    '''the feffit transform of many chi(k) at once'''
+    def check(self, fitspace, kweight):
+        self.trytext("""
+data = group(k=0.05*arange(341))
+data.chi = sin(2.3*data.k)*exp(-0.01*data.k**2)
+path = feffpath('../examples/feffit/feff0001.dat')
+trans = feffit_transform(kmin=3, kmax=14, kw=%s, dk=2, rmin=1, rmax=3,
+                         fitspace='%s')
+dset = feffit_dataset(data=data, pathlist=[path], transform=trans)
+dset.prepare_fit()
+""" % (repr(kweight), fitspace))
+        self.NoExceptionRaised()
+        dset = self.session.get_symbol('dset')
+        np.random.seed(5)
+        diffs = np.random.normal(size=(4, 341))
+        out = dset._transform(diffs)
+        self.assertEqual(out.ndim, 2)
+        self.assertEqual(out.shape[0], 4)
+        for row, diff in zip(out, diffs):
+            ref = old_transform(dset, diff)
+            self.assertTrue(np.allclose(dset._transform(diff), ref,
+                                        rtol=1.e-12, atol=1.e-14),
+                            (fitspace, kweight))
+            self.assertTrue(np.allclose(row, ref, rtol=1.e-12, atol=1.e-14),
+                            (fitspace, kweight))
+
+    def test_fitspaces(self):
+        for fitspace in ('k', 'r', 'q'):
+            self.check(fitspace, 2)
+        # fits in k space need a single kweight
+        for fitspace in ('r', 'q'):
+            self.check(fitspace, [1, 2, 3])
+
+if __name__ == '__main__':  # pragma: no cover
+    for suite in (TestBatchedFT, TestTransformWindows, TestDatasetTransform):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+""" Larch Tests:
+  decoding of xMAP netCDF buffers, compared to decoding one pixel at a time
+"""
+import unittest
+import os
+import shutil
+import tempfile
+import warnings
+import numpy as np
+import scipy.io.netcdf
+from numpy.testing import assert_array_equal, assert_allclose
+
+import larch
+larch.use_plugin_path('xrfmap')
+from xmap_netcdf import (decode_xmap_buffers, read_xmap_netcdf, aslong,
+                         xMAPBufferHeader, xMAPData, CLOCKTICK)
+
+MODPIXS = 124
+
+def make_buffers(mapmode, nchans, narrays=3, nmodules=2, lastpix=50, seed=7):
+    """array_data for an xMAP map, with the last array partly filled"""
+    np.random.seed(seed)
+    if mapmode == 1:
+        blocksize = 256 + 4*nchans
+    else:
+        blocksize = 64 + 8*nchans + 8
+    buffersize = 256 + MODPIXS*blocksize
+    out = np.zeros((narrays, nmodules, buffersize), dtype=np.int16)
+    for iarr in range(narrays):
+        npix = MODPIXS
+        if iarr == narrays-1:
+            npix = lastpix
+        for imod in range(nmodules):
+            buff = out[iarr, imod]
+            buff[3] = mapmode
+            buff[8] = npix
+            buff[9:11] = np.array([iarr*MODPIXS], dtype=np.int32).view(np.int16)
+            buff[20] = nchans
+            for ipix in range(npix):
+                block = buff[256+ipix*blocksize:256+(ipix+1)*blocksize]
+                block[3] = mapmode
+                block[8:12] = nchans
+                times = np.random.randint(1, 2**31-1, 16).astype(np.int32)
+                block[32:64] = times.view(np.int16)
+                if mapmode == 1:
+                    data = np.random.poisson(40, 4*nchans)
+                    block[256:256+4*nchans] = data.astype(np.int16)
+                else:
+                    data = np.random.randint(0, 2**31-1, 4*nchans)
+                    data = data.astype(np.int32).view(np.int16)
+                    block[64:64+8*nchans] = data
+    return out
+
+def decode_per_pixel(array_data):
+    """decode buffers one pixel block at a time, as the previous
+    read_xmap_netcdf did, with spectra from each module in turn"""
+    narrays, nmodules, buffersize = array_data.shape
+    modpixs = max(124, array_data[0, 0, 8])
+    npix_total = 0
+    for array in range(narrays):
+        for module in range(nmodules):
+            d   = array_data[array, module, :]
+            bh  = xMAPBufferHeader(d)
+            dat = d[256:].reshape(modpixs, (d.size-256)//modpixs)
+            npix = bh.numPixels
+            if module == 0:
+                npix_total += npix
+                if array == 0:
+                    mapmode = dat[0, 3]
+                    if mapmode == 1:
+                        nchans = d[20]
+                        data_slice = slice(256, 256+4*nchans)
+                    elif mapmode == 2:
+                        nchans     = max(d[264:268])
+                        data_slice = slice(64, 64+8*nchans)
+                    xmapdat = xMAPData(narrays*modpixs, nmodules, nchans)
+                    xmapdat.firstPixel = bh.startingPixel
+            t_times = aslong(dat[:npix, 32:64]).reshape(npix, 4, 4)
+            p1, p2 = npix_total - npix, npix_total
+            d1, d2 = 4*module, 4*module + 4
+            xmapdat.realTime[p1:p2, d1:d2]     = t_times[:, :, 0]
+            xmapdat.liveTime[p1:p2, d1:d2]     = t_times[:, :, 1]
+            xmapdat.inputCounts[p1:p2, d1:d2]  = t_times[:, :, 2]
+            xmapdat.outputCounts[p1:p2, d1:d2] = t_times[:, :, 3]
+            t_data = dat[:npix, data_slice]
+            if mapmode == 2:
+                if xmapdat.counts.dtype.itemsize < 4:
+                    xmapdat.counts = xmapdat.counts.astype(np.int32)
+                t_data = aslong(t_data)
+            xmapdat.counts[p1:p2, d1:d2, :] = t_data.reshape(npix, 4, nchans)
+
+    xmapdat.numPixels = npix_total
+    xmapdat.counts    = xmapdat.counts[:npix_total]
+    xmapdat.realTime  = CLOCKTICK * xmapdat.realTime[:npix_total]
+    xmapdat.liveTime  = CLOCKTICK * xmapdat.liveTime[:npix_total]
+    xmapdat.inputCounts  = xmapdat.inputCounts[:npix_total]
+    xmapdat.outputCounts = xmapdat.outputCounts[:npix_total]
+    return xmapdat
+
+class TestXMAPDecode(unittest.TestCase):
+    '''decode_xmap_buffers matches the per-pixel decoder'''
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp(prefix='larch_xmap_')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def compare(self, out, ref):
+        self.assertEqual(out.numPixels, ref.numPixels)
+        self.assertEqual(out.firstPixel, ref.firstPixel)
+        self.assertEqual(out.counts.shape, ref.counts.shape)
+        assert_array_equal(out.counts, ref.counts)
+        for attr in ('realTime', 'liveTime', 'inputCounts', 'outputCounts'):
+            assert_allclose(getattr(out, attr), getattr(ref, attr),
+                            rtol=1.e-12, err_msg=attr)
+
+    def check(self, mapmode, nchans, **kws):
+        array_data = make_buffers(mapmode, nchans, **kws)
+        ref = decode_per_pixel(array_data)
+        self.assertEqual(ref.numPixels, (kws.get('narrays', 3) - 1)*MODPIXS +
+                         kws.get('lastpix', 50))
+        self.compare(decode_xmap_buffers(array_data), ref)
+        # as read from file, with big-endian words
+        self.compare(decode_xmap_buffers(array_data.astype('>i2')), ref)
+
+        fname = os.path.join(self.dirname, 'xmap_%i.nc' % mapmode)
+        fh = scipy.io.netcdf.netcdf_file(fname, 'w')
+        fh.createDimension('array', array_data.shape[0])
+        fh.createDimension('module', array_data.shape[1])
+        fh.createDimension('word', array_data.shape[2])
+        var = fh.createVariable('array_data', 'h', ('array', 'module', 'word'))
+        var[:] = array_data
+        fh.close()
+        for mmap in (False, True):
+            with warnings.catch_warnings():
+                warnings.simplefilter('error', RuntimeWarning)
+                out = read_xmap_netcdf(fname, mmap=mmap)
+            self.compare(out, ref)
+
+    def test_mapping_mode(self):
+        self.check(1, 2048)
+        self.check(1, 512, narrays=2, nmodules=1, lastpix=MODPIXS)
+        # spectra are views of a single full buffer
+        self.check(1, 512, narrays=1, nmodules=1, lastpix=MODPIXS)
+
+    def test_roi_mode(self):
+        self.check(2, 16)
+        self.check(2, 5, narrays=1, nmodules=3, lastpix=7)
+
+if __name__ == '__main__':  # pragma: no cover
+    for suite in (TestXMAPDecode,):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,91 @@
+#
+"""
+tests for sessions and asynchronous jobs of the Larch XML-RPC server
+(used directly, without a client connection)
+"""
+from __future__ import print_function
+import unittest
+import threading
+import nose
+from numpy.testing import assert_
+
+from larch.xmlrpc_server import LarchServer
+
+class LarchServerJobs_Test(unittest.TestCase):
+    def setUp(self):
+        self.server = LarchServer(host='127.0.0.1', port=0, with_wx=False,
+                                  local_echo=False, quiet=True, workers=2)
+
+    def tearDown(self):
+        self.server.server_close()
+
+    def run_job(self, text, session=None):
+        jobid = self.server.submit(text, session=session)
+        return self.server.job_result(jobid, timeout=60)
+
+    def test_xraydb_consecutive_jobs(self):
+        "xraydb calls in consecutive jobs (on any worker) share one session"
+        out = self.run_job("m1 = mu_elam('Fe', 10000)")
+        assert_(out['status'] == 'done')
+        out = self.run_job("m2 = mu_elam('Cu', 10000)")
+        assert_(out['status'] == 'done')
+        out = self.run_job("m3 = mu_elam('Fe', 10000)")
+        assert_(out['status'] == 'done')
+        m1 = float(self.server.get_data('m1'))
+        m2 = float(self.server.get_data('m2'))
+        assert_(m1 > 0 and m2 > 0 and m1 != m2)
+        assert_(float(self.server.get_data('m3')) == m1)
+
+    def test_sync_and_jobs_share_session(self):
+        self.server.larch_exec("m = mu_elam('Fe', 10000)")
+        out = self.run_job("m = mu_elam('Cu', 10000)")
+        assert_(out['status'] == 'done')
+        self.server.larch_exec("m = mu_elam('Fe', 10000)")
+        out = self.run_job("mfe = m")
+        assert_(out['status'] == 'done')
+        assert_(self.server.get_data('mfe') == self.server.get_data('m'))
+        assert_(float(self.server.get_data('m')) ==
+                float(self.server.get_data("mu_elam('Fe', 10000)")))
+
+    def test_separate_sessions(self):
+        name = self.server.new_session()
+        self.run_job("x = 1")
+        out = self.run_job("x = mu_elam('Cu', 10000)", session=name)
+        assert_(out['status'] == 'done')
+        assert_(self.server.get_data('x') == 1)
+        assert_(float(self.server.get_data('x', session=name)) > 1)
+        self.server.close_session(name)
+        assert_(name not in self.server.list_sessions())
+
+    def test_close_session_with_queued_job(self):
+        "jobs for a closed session fail, and the workers keep running"
+        server = LarchServer(host='127.0.0.1', port=0, with_wx=False,
+                             local_echo=False, quiet=True, workers=1)
+        try:
+            hold = threading.Event()
+            server.get_session().larch.symtable.set_symbol('_hold', hold.wait)
+            name = server.new_session()
+            busy = server.submit("_hold(30)")
+            queued = server.submit("x = 1", session=name)
+            server.close_session(name)
+            hold.set()
+            assert_(server.job_result(busy, timeout=30)['status'] == 'done')
+            out = server.job_result(queued, timeout=30)
+            assert_(out['status'] == 'error')
+            assert_('closed' in out['output'])
+            out = server.job_result(server.submit("y = 2"), timeout=30)
+            assert_(out['status'] == 'done')
+            assert_([j['status'] for j in server.list_jobs()] ==
+                    ['done', 'error', 'done'])
+        finally:
+            server.server_close()
+
+    def test_job_error(self):
+        out = self.run_job("y = undefined_name + 1")
+        assert_(out['status'] == 'error')
+        assert_('undefined_name' in out['output'])
+
+if __name__ == '__main__':
+    for suite in (LarchServerJobs_Test,):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=0).run(suite)
@@ -0,0 +1,130 @@
+#
+"""
+tests for the XRF background of plugins/xrf/xrf_bgr.py, compared
+to the original channel-by-channel calculation
+"""
+from __future__ import print_function
+import unittest
+import nose
+import numpy as np
+from numpy.testing import assert_, assert_array_equal
+
+import larch
+larch.use_plugin_path('xrf')
+from xrf_bgr import (XRFBackground, compress_array, expand_array,
+                     REFERENCE_AMPL, TINY, HUGE, MAX_TANGENT)
+
+def ref_background(data, width=4, slope=1.0, exponent=2, compress=2,
+                   tangent=False):
+    "background of one spectrum, as calculated by the original loop"
+    nchans   = len(data)
+    scratch  = data[:]
+    if compress > 1:
+        tmp = compress_array(scratch, compress)
+        if tmp is None:
+            compress = 1
+        else:
+            scratch = tmp
+            slope = slope * compress
+            nchans = nchans / compress
+
+    max_counts = max(scratch)
+    bckgnd = np.arange(nchans, dtype=np.float) - HUGE
+    denom = max(TINY, (width / (2. * slope)**exponent))
+
+    indices     = np.arange(nchans*2+1, dtype=np.float) - nchans
+    power_funct = indices**exponent  * (REFERENCE_AMPL / denom)
+    power_funct = np.compress((power_funct <= max_counts), power_funct)
+    max_index   = len(power_funct)/2 - 1
+    for chan in range(nchans-1):
+        tan_slope = 0.
+        if tangent:
+            chan0  = max((chan - MAX_TANGENT), 0)
+            chan1  = min((chan + MAX_TANGENT), (nchans-1))
+            denom  = chan - np.arange(chan1 - chan0 + 1, dtype=np.float)
+            denom   = max(max(denom), 1)
+            tan_slope = (scratch[chan] - scratch[chan0:chan1+1]) / denom
+            tan_slope = np.sum(tan_slope) / (chan1 - chan0)
+
+        chan0 = max((chan - max_index), 0)
+        chan1 = min((chan + max_index), (nchans-1))
+        chan1 = max(chan1, chan0)
+        nc    = chan1 - chan0 + 1
+        lin_offset = scratch[chan] + (np.arange(float(nc)) - nc/2) * tan_slope
+
+        f      = chan0 - chan + max_index
+        l      = chan1 - chan + max_index
+        test   = scratch[chan0:chan1+1] - lin_offset + power_funct[f:l+1]
+        height = min(test)
+        test = height + lin_offset - power_funct[f:l+1]
+        sub  = bckgnd[chan0:chan1+1]
+        bckgnd[chan0:chan1+1] = np.maximum(sub, test)
+
+    if compress > 1:
+        bckgnd = expand_array(bckgnd, compress)
+    bgr = bckgnd.astype(int)
+    bgr[np.where(bgr <= 0)] = 0
+    return bgr
+
+def make_spectrum(nchans=256, scale=1000.0, seed=1):
+    np.random.seed(seed)
+    x = np.arange(nchans, dtype=np.float)
+    y = (scale*np.exp(-x/(0.4*nchans)) +
+         8*scale*np.exp(-(x-0.3*nchans)**2/8.0) +
+         3*scale*np.exp(-(x-0.7*nchans)**2/18.0))
+    return np.random.poisson(y).astype(np.float)
+
+class XRFBackground_Test(unittest.TestCase):
+    def check(self, data, **kws):
+        out = XRFBackground(data, **kws).bgr
+        assert_array_equal(out, ref_background(data, **kws))
+
+    def test_float(self):
+        data = make_spectrum()
+        for compress in (1, 2, 4):
+            for tangent in (False, True):
+                self.check(data, compress=compress, tangent=tangent)
+
+    def test_int(self):
+        data = make_spectrum(seed=2).astype(np.int)
+        for compress in (1, 2, 4):
+            for tangent in (False, True):
+                self.check(data, compress=compress, tangent=tangent)
+
+    def test_int_tangent_channel0(self):
+        # integer slope at channel 0 is rounded down
+        data = np.array([5, 8, 14, 3, 2, 40, 3, 1]*8)
+        self.check(data, compress=1, tangent=True)
+        self.check(data, compress=1, tangent=True, width=0.5)
+
+    def test_exponent_width(self):
+        data = make_spectrum(seed=3)
+        for exponent in (2, 4):
+            for width in (0.5, 4, 20):
+                self.check(data, exponent=exponent, width=width, slope=0.5)
+
+    def test_negative_max_index(self):
+        # low counts: no power function fits below the maximum counts
+        data = make_spectrum(scale=4.0, seed=4)
+        assert_(data.max() < REFERENCE_AMPL)
+        for compress in (1, 2):
+            for tangent in (False, True):
+                self.check(data, compress=compress, tangent=tangent)
+                self.check(data.astype(np.int), compress=compress,
+                           tangent=tangent)
+
+    def test_stack(self):
+        data = np.array([make_spectrum(seed=5),
+                         make_spectrum(scale=4.0, seed=6),
+                         make_spectrum(scale=50.0, seed=7)])
+        for tangent in (False, True):
+            out = XRFBackground(data, tangent=tangent).bgr
+            assert_(out.shape == data.shape)
+            for spectrum, bgr in zip(data, out):
+                assert_array_equal(bgr, ref_background(spectrum,
+                                                       tangent=tangent))
+
+if __name__ == '__main__':
+    for suite in (XRFBackground_Test,):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=0).run(suite)
@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+""" Larch Tests:
+  GSE XRF map files, built from small synthetic raw map folders
+"""
+import unittest
+import os
+import sys
+import time
+import traceback
+import shutil
+import tempfile
+import numpy as np
+import h5py
+from numpy.testing import assert_array_equal, assert_allclose
+
+import larch
+larch.use_plugin_path('xrfmap')
+import xrm_mapfile
+from xrm_mapfile import (GSEXRM_MapFile, GSEXRM_ROIIndex,
+                         get_storage_profile, counts_dataset_kws)
+
+SCAN_INI = """[general]
+basedir = .
+scandir = .
+[xps]
+host = localhost
+group = FINE
+positioners = X, Y
+[scan]
+filename = testmap
+dimension = 2
+comments = test map
+pos1 = 13XRM:m1
+start1 = 0.0
+stop1 = %(stop1)f
+step1 = 0.1
+time1 = 2.0
+pos2 = 13XRM:m2
+start2 = 0.0
+stop2 = 1.0
+step2 = 0.1
+[xrf]
+use = True
+type = xsp3
+prefix = 13QX4:
+plugin = HDF1:
+[fast_positioners]
+1 = 13XRM:m1 | X
+2 = 13XRM:m2 | Y
+[slow_positioners]
+1 = 13XRM:m1 | X
+2 = 13XRM:m2 | Y
+"""
+
+def make_map_folder(dirname, rois, nrows=4, npts=12, ndet=2, nchan=256,
+                    seed=1, scale=None):
+    """write a raw map folder with xspress3 spectra, with rois a list of
+    (name, left, right) channels, and spectra for each row multiplied
+    by scale[irow], if given"""
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    with open(os.path.join(dirname, 'Scan.ini'), 'w') as fh:
+        fh.write(SCAN_INI % {'stop1': 0.1*(npts-1)})
+    with open(os.path.join(dirname, 'Environ.dat'), 'w') as fh:
+        fh.write("; Ring Current (S:SRcurrentAI.VAL) = 100.0\n")
+    lines = ['[rois]']
+    for i, (name, lo, hi) in enumerate(rois):
+        limits = ' '.join(['%i %i' % (lo, hi)]*ndet)
+        lines.append('roi%2.2i = %s | %s' % (i, name, limits))
+    lines.append('[calibration]')
+    lines.append('offset = %s' % ' '.join(['-0.01']*ndet))
+    lines.append('slope = %s' % ' '.join(['0.04']*ndet))
+    lines.append('quad = %s' % ' '.join(['0.0']*ndet))
+    with open(os.path.join(dirname, 'ROI.dat'), 'w') as fh:
+        fh.write('\n'.join(lines) + '\n')
+
+    np.random.seed(seed)
+    chan = np.arange(nchan)
+    master = ['# scan.version = 1.4', '# scan.starttime = today',
+              '# y  xrf  struck  xps  time']
+    for irow in range(nrows):
+        npix = npts + 1
+        xrf = 'xsp3.%4.4i' % (irow+1)
+        sis = 'struck.%4.4i' % (irow+1)
+        xps = 'xps.%4.4i' % (irow+1)
+        master.append('%.3f %s %s %s %.1f' % (0.1*irow, xrf, sis, xps, 2.0*irow))
+        peaks = 300*np.exp(-(chan-80)**2/20.0) + 100*np.exp(-(chan-170)**2/30.0)
+        lam = (peaks + 5)[np.newaxis, np.newaxis, :] * \
+              np.random.uniform(0.5, 1.5, size=(npix, ndet, 1))
+        if scale is not None:
+            lam = lam * scale[irow]
+        counts = np.random.poisson(lam).astype('uint32')
+        with h5py.File(os.path.join(dirname, xrf), 'w') as h5:
+            det = h5.create_group('entry/instrument/detector')
+            det.create_dataset('data', data=counts)
+            nda = det.create_group('NDAttributes')
+            for i in range(ndet):
+                nda.create_dataset('CHAN%iSCA0' % (i+1),
+                                   data=np.random.uniform(1.5e5, 1.7e5, npix))
+        with open(os.path.join(dirname, sis), 'w') as fh:
+            fh.write('# 13IDE:SIS1:mca1 | 13IDE:SIS1:mca2\n')
+            fh.write('# TSCALER | I0\n')
+            for i in range(npix):
+                fh.write('%i %i\n' % (50000, np.random.randint(1000, 2000)))
+        with open(os.path.join(dirname, xps), 'w') as fh:
+            fh.write('# xps gathering\n')
+            for i in range(npix):
+                fh.write('%.4f %.4f\n' % (0.1*i - 0.05, 0.1*irow))
+    with open(os.path.join(dirname, 'Master.dat'), 'w') as fh:
+        fh.write('\n'.join(master) + '\n')
+
+def make_map(dirname, rois, storage=None, **kws):
+    "make a raw map folder in dirname and process it to an HDF5 map file"
+    folder = os.path.join(dirname, 'rawmap')
+    make_map_folder(folder, rois, **kws)
+    xrmfile = GSEXRM_MapFile(filename=os.path.join(dirname, 'map.h5'),
+                             folder=folder, storage=storage)
+    xrmfile.process(verbose=False)
+    return xrmfile
+
+ROIS = [('Fe', 70, 90), ('Zn', 160, 180), ('Cu', 110, 130)]
+
+def old_roi_sums(counts, dtfactor, limits):
+    """raw and corrected ROI columns and sums for a row, as add_rowdata()
+    built them with a slice for each ROI and detector"""
+    nrois, nmca = limits.shape[:2]
+    detraw, detcor, sumraw, sumcor = [], [], [], []
+    for iroi in range(nrois):
+        slices = [slice(limits[iroi, i, 0], limits[iroi, i, 1])
+                  for i in range(nmca)]
+        iraw = [counts[i, :, slices[i]].sum(axis=1) for i in range(nmca)]
+        icor = [counts[i, :, slices[i]].sum(axis=1)*dtfactor[i, :]
+                for i in range(nmca)]
+        detraw.extend(iraw)
+        detcor.extend(icor)
+        sumraw.append(np.array(iraw).sum(axis=0))
+        sumcor.append(np.array(icor).sum(axis=0))
+    return [np.array(x).transpose() for x in (detraw, detcor, sumraw, sumcor)]
+
+class MapFileTest(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp(prefix='larch_xrm_')
+        self.maps = []
+
+    def tearDown(self):
+        for xrmfile in self.maps:
+            xrmfile.close()
+        shutil.rmtree(self.dirname)
+
+    def make_map(self, name, rois, **kws):
+        xrmfile = make_map(os.path.join(self.dirname, name), rois, **kws)
+        self.maps.append(xrmfile)
+        return xrmfile
+
+class TestMapROIs(MapFileTest):
+    """add_roi() and del_roi() give the same ROI maps as processing
+    a map folder with those ROIs"""
+    def assert_same_rois(self, map1, map2):
+        for name in ('det_raw', 'det_cor', 'sum_raw', 'sum_cor', 'sum_list',
+                     'det_name', 'sum_name'):
+            dat1 = map1.xrfmap['roimap/%s' % name].value
+            dat2 = map2.xrfmap['roimap/%s' % name].value
+            self.assertEqual(dat1.shape, dat2.shape, name)
+            if dat1.dtype.kind == 'f':
+                assert_allclose(dat1, dat2, rtol=1.e-6, err_msg=name)
+            else:
+                assert_array_equal(dat1, dat2, err_msg=name)
+        assert_array_equal(map1.xrfmap['config/rois/limits'].value,
+                           map2.xrfmap['config/rois/limits'].value)
+        assert_array_equal(list(map1.xrfmap['config/rois/name']),
+                           list(map2.xrfmap['config/rois/name']))
+        for det in ('det1', 'det2', 'detsum'):
+            assert_array_equal(map1.xrfmap['%s/roi_limits' % det].value,
+                               map2.xrfmap['%s/roi_limits' % det].value)
+
+    def test_add_roi(self):
+        xrmfile = self.make_map('map1', ROIS[:2])
+        xrmfile.add_roi('Cu', 130, 110)
+        self.assert_same_rois(xrmfile, self.make_map('map2', ROIS))
+
+    def test_del_roi(self):
+        xrmfile = self.make_map('map1', ROIS)
+        xrmfile.del_roi('Zn')
+        self.assert_same_rois(xrmfile, self.make_map('map2',
+                                                     [ROIS[0], ROIS[2]]))
+
+    def test_add_del_roi(self):
+        xrmfile = self.make_map('map1', ROIS[:2])
+        xrmfile.add_roi('Cu', 110, 130)
+        xrmfile.del_roi('Fe')
+        self.assert_same_rois(xrmfile, self.make_map('map2', ROIS[1:]))
+
+    def test_roimap(self):
+        xrmfile = self.make_map('map1', ROIS[:2])
+        xrmfile.add_roi('Cu', 130, 110)
+        counts = xrmfile.xrfmap['det2/counts'].value
+        assert_allclose(xrmfile.get_roimap('Cu', det=2, dtcorrect=False),
+                        counts[:, 1:-1, 110:130].sum(axis=2))
+
+class TestROIIndex(MapFileTest):
+    """ROI sums from one cumulative sum match summing channel slices"""
+    def test_sums(self):
+        np.random.seed(2)
+        limits = np.array([[[70, 90], [71, 92]],
+                           [[0, 1], [0, 256]],
+                           [[200, 300], [255, 256]],
+                           [[40, 40], [50, 45]]])
+        for dtype in ('uint16', 'uint32', 'int32', 'float32'):
+            counts = np.random.poisson(40, size=(2, 7, 256)).astype(dtype)
+            dtfactor = np.random.uniform(1, 1.5, size=(2, 7))
+            sums = GSEXRM_ROIIndex(limits).sums(counts)
+            self.assertEqual(sums.shape, (2, 4, 7))
+            ref = old_roi_sums(counts, dtfactor, limits)[0]
+            assert_allclose(sums.transpose(2, 1, 0).reshape((7, 8)), ref,
+                            rtol=1.e-6, err_msg=dtype)
+        # large counts do not overflow
+        counts = 60000*np.ones((2, 3, 256), dtype='uint16')
+        assert_array_equal(GSEXRM_ROIIndex(limits).sums(counts)[:, 1, 0],
+                           [60000, 60000*256])
+        sums = GSEXRM_ROIIndex(np.zeros((0, 2, 2))).sums(counts)
+        self.assertEqual(sums.shape, (2, 0, 3))
+
+    def test_rowdata(self):
+        xrmfile = self.make_map('map1', ROIS)
+        roimap = xrmfile.xrfmap['roimap']
+        limits = xrmfile.xrfmap['config/rois/limits'].value
+        counts = np.array([xrmfile.xrfmap['det%i/counts' % i].value
+                           for i in (1, 2)])
+        dtfactor = np.array([xrmfile.xrfmap['det%i/dtfactor' % i].value
+                             for i in (1, 2)])
+        nrow = counts.shape[1]
+        ncols = len(ROIS)*2
+        for irow in range(nrow):
+            ref = old_roi_sums(counts[:, irow], dtfactor[:, irow], limits)
+            for name, val in zip(('det_raw', 'det_cor', 'sum_raw', 'sum_cor'),
+                                 ref):
+                out = roimap[name][irow]
+                nscalers = out.shape[1] - val.shape[1]
+                self.assertTrue(nscalers > 0)
+                assert_allclose(out[:, nscalers:], val, rtol=1.e-5,
+                                err_msg=name)
+                assert_array_equal(out[:, :nscalers],
+                                   roimap['det_raw'][irow, :, :nscalers])
+
+def old_counts_area(xrmfile, area, det=None, dtcorrect=True, nchunksize=16384):
+    "counts in an area, as get_mca_area() summed them in nchunksize slabs"
+    mapdat = xrmfile._det_group(det)
+    ix, iy, nmca = mapdat['counts'].shape
+    sy, sx = [slice(min(_a), max(_a)+1) for _a in np.where(area)]
+    xmin, xmax, ymin, ymax = sx.start, sx.stop, sy.start, sy.stop
+    nx, ny = (xmax-xmin), (ymax-ymin)
+    step = int((nx*ny)/nchunksize)
+    if nx*ny <= nchunksize:
+        return xrmfile.get_counts_rect(ymin, ymax, xmin, xmax, mapdat=mapdat,
+                                       det=det, area=area, dtcorrect=dtcorrect)
+    counts = np.zeros(nmca)
+    if nx > ny:
+        for i in range(step+1):
+            x1 = xmin + int(i*nx/step)
+            x2 = min(xmax, xmin + int((i+1)*nx/step))
+            if x1 >= x2: break
+            counts += xrmfile.get_counts_rect(ymin, ymax, x1, x2, mapdat=mapdat,
+                                              det=det, area=area,
+                                              dtcorrect=dtcorrect)
+    else:
+        for i in range(step+1):
+            y1 = ymin + int(i*ny/step)
+            y2 = min(ymax, ymin + int((i+1)*ny/step))
+            if y1 >= y2: break
+            counts += xrmfile.get_counts_rect(y1, y2, xmin, xmax, mapdat=mapdat,
+                                              det=det, area=area,
+                                              dtcorrect=dtcorrect)
+    return counts
+
+class TestMapAreas(MapFileTest):
+    """area spectra summed by HDF5 chunk match the summed rectangles
+    and slabs of the previous get_mca_area()"""
+    def setUp(self):
+        MapFileTest.setUp(self)
+        np.random.seed(4)
+        self.nrows, self.npts = 6, 12
+        shape = (self.nrows, self.npts)
+        rect = np.zeros(shape, dtype=bool)
+        rect[1:4, 2:9] = True
+        pixel = np.zeros(shape, dtype=bool)
+        pixel[5, 11] = True
+        self.areas = [rect, pixel, np.ones(shape, dtype=bool),
+                      np.random.uniform(size=shape) > 0.6,
+                      np.random.uniform(size=shape) > 0.2]
+
+    def check(self, xrmfile):
+        for area in self.areas:
+            for det in (None, 1, 2):
+                for dtcorrect in (True, False):
+                    for nchunk in (16384, 20, 8):
+                        ref = old_counts_area(xrmfile, area, det=det,
+                                              dtcorrect=dtcorrect,
+                                              nchunksize=nchunk)
+                        out = xrmfile.get_counts_area(area, det=det,
+                                                      dtcorrect=dtcorrect)
+                        assert_allclose(out, ref, rtol=1.e-6,
+                                        err_msg=repr((det, dtcorrect)))
+
+    def test_areas(self):
+        xrmfile = self.make_map('map1', ROIS[:2], nrows=self.nrows,
+                                npts=self.npts)
+        self.check(xrmfile)
+
+    def test_chunked(self):
+        xrmfile = self.make_map('map1', ROIS[:2], nrows=self.nrows,
+                                npts=self.npts,
+                                storage={'chunks': (2, 5, 64)})
+        self.assertEqual(xrmfile.xrfmap['det1/counts'].chunks, (2, 5, 64))
+        self.check(xrmfile)
+        calls = []
+        xrmfile.get_counts_area(self.areas[0], det=1,
+                                callback=lambda *args: calls.append(args))
+        # bands of 2 rows for rows 1 to 3
+        self.assertEqual(calls, [(0, 2, 7), (1, 2, 14)])
+
+    def test_cache(self):
+        xrmfile = self.make_map('map1', ROIS[:2], nrows=self.nrows,
+                                npts=self.npts,
+                                storage={'chunks': (2, 5, 64)})
+        area = self.areas[3]
+        first = xrmfile.get_counts_area(area, det=1)
+        ncache = len(xrmfile._area_cache)
+        self.assertTrue(ncache > 0)
+        assert_array_equal(xrmfile.get_counts_area(area, det=1), first)
+        self.assertEqual(len(xrmfile._area_cache), ncache)
+        saved = xrm_mapfile.NAREA_CACHE
+        try:
+            xrm_mapfile.NAREA_CACHE = 2
+            self.check(xrmfile)
+            self.assertTrue(len(xrmfile._area_cache) <= 2)
+        finally:
+            xrm_mapfile.NAREA_CACHE = saved
+
+class TestMapErange(MapFileTest):
+    """get_map_erange() with a cumulative sum index gives the same map
+    as summing the counts, with channels rounded to the index step"""
+    ranges = [(None, None), (0, 1), (70, 90), (75, 176), (3, 254),
+              (110, None), (None, 41), (100, 100), (255, 256)]
+
+    def plain_maps(self, xrmfile, step):
+        "maps by channel sums, for ranges rounded to step channels"
+        nchan = xrmfile.xrfmap['det1/counts'].shape[2]
+        out = {}
+        for det in (None, 1, 2):
+            for emin, emax in self.ranges:
+                ilo, ihi = emin, emax
+                if ilo is None:
+                    ilo = 0
+                if ihi is None:
+                    ihi = nchan
+                ilo = min(nchan//step, int(round(ilo*1.0/step)))
+                ihi = min(nchan//step, int(round(ihi*1.0/step)))
+                out[(det, emin, emax)] = xrmfile.get_map_erange(
+                    det=det, emin=ilo*step, emax=ihi*step, by_energy=False)
+        return out
+
+    def test_index(self):
+        xrmfile = self.make_map('map1', ROIS[:2])
+        for step in (1, 2, 3, 8):
+            expected = self.plain_maps(xrmfile, step)
+            for det in (None, 1, 2):
+                xrmfile.add_erange_index(det=det, step=step, overwrite=True)
+            csum = xrmfile._det_group(1)['counts_csum']
+            nrow, npts, ncsum = csum.shape
+            self.assertEqual(ncsum, 256//step + 1)
+            self.assertEqual(csum.chunks, (1, npts, min(ncsum, 256)))
+            for det in (None, 1, 2):
+                for emin, emax in self.ranges:
+                    out = xrmfile.get_map_erange(det=det, emin=emin,
+                                                 emax=emax, by_energy=False)
+                    assert_allclose(out, expected[(det, emin, emax)],
+                                    rtol=1.e-6, err_msg=repr((step, det,
+                                                              emin, emax)))
+            for det in (None, 1, 2):
+                del xrmfile._det_group(det)['counts_csum']
+
+    def test_plain_sum(self):
+        xrmfile = self.make_map('map1', ROIS[:2])
+        counts = xrmfile.xrfmap['det1/counts'].value
+        dtfactor = xrmfile.xrfmap['det1/dtfactor'].value
+        out = xrmfile.get_map_erange(det=1, emin=70, emax=90,
+                                     by_energy=False, dtcorrect=False)
+        assert_allclose(out, counts[:, 1:-1, 70:90].sum(axis=2))
+        out = xrmfile.get_map_erange(det=1, emin=70, emax=90,
+                                     by_energy=False)
+        assert_allclose(out, (counts[:, :, 70:90].sum(axis=2) *
+                              dtfactor)[:, 1:-1])
+
+    def test_by_energy(self):
+        xrmfile = self.make_map('map1', ROIS[:2])
+        energy = xrmfile.xrfmap['det1/energy'].value
+        for det in (None, 1):
+            expected = xrmfile.get_map_erange(det=det, emin=70, emax=91,
+                                              by_energy=False)
+            out = xrmfile.get_map_erange(det=det, emin=energy[70],
+                                         emax=energy[90])
+            assert_allclose(out, expected)
+            xrmfile.add_erange_index(det=det)
+            out = xrmfile.get_map_erange(det=det, emin=energy[70],
+                                         emax=energy[90])
+            assert_allclose(out, expected, rtol=1.e-6)
+
+class TestMapStorage(MapFileTest):
+    """counts datasets use the storage profile, and are promoted to int32
+    or clipped when a row overflows int16"""
+    scale = [1, 1, 250, 1]
+
+    def counts(self, xrmfile):
+        return [xrmfile.xrfmap['%s/counts' % det]
+                for det in ('det1', 'det2', 'detsum')]
+
+    def test_chunks(self):
+        xrmfile = self.make_map('map1', ROIS[:2])
+        profile = get_storage_profile(None)
+        for dset in self.counts(xrmfile):
+            nrow, npts, nchan = dset.shape
+            kws = counts_dataset_kws(profile, npts, nchan)
+            self.assertEqual(dset.chunks, kws['chunks'])
+            self.assertEqual(dset.dtype, np.int16)
+
+    def test_promote(self):
+        xrmfile = self.make_map('map1', ROIS[:2], scale=self.scale)
+        ref = self.make_map('map2', ROIS[:2], scale=self.scale,
+                            storage={'dtype': 'int32'})
+        for dset, rset in zip(self.counts(xrmfile), self.counts(ref)):
+            self.assertTrue(rset.value.max() > 32767)
+            self.assertEqual(dset.dtype, np.int32)
+            assert_array_equal(dset.value, rset.value)
+
+    def test_clip(self):
+        xrmfile = self.make_map('map1', ROIS[:2], scale=self.scale,
+                                storage={'promote': False})
+        ref = self.make_map('map2', ROIS[:2], scale=self.scale,
+                            storage={'dtype': 'int32'})
+        for dset, rset in zip(self.counts(xrmfile), self.counts(ref)):
+            self.assertEqual(dset.dtype, np.int16)
+            assert_array_equal(dset.value, np.minimum(rset.value, 32767))
+
+class TestMapRowReaders(MapFileTest):
+    """rows read by several threads in iter_rowdata()"""
+    def setUp(self):
+        MapFileTest.setUp(self)
+        self.xrmfile = self.make_map('map1', ROIS[:2], nrows=8)
+        self.started = []
+        read_row = self.xrmfile._read_row
+        def counted(rowdata, irow):
+            self.started.append(irow)
+            if irow == self.bad_row:
+                raise KeyError('bad row %i' % irow)
+            return read_row(rowdata, irow)
+        self.bad_row = None
+        self.xrmfile._read_row = counted
+
+    def test_order(self):
+        nrows = len(self.xrmfile.rowdata)
+        self.assertEqual(nrows, 8)
+        expected = [self.xrmfile.read_rowdata(i).counts for i in range(nrows)]
+        self.started = []
+        out = list(self.xrmfile.iter_rowdata(0, nrows, nworkers=3))
+        self.assertEqual([irow for irow, row in out], list(range(nrows)))
+        self.assertEqual(sorted(self.started), list(range(nrows)))
+        for (irow, row), counts in zip(out, expected):
+            assert_array_equal(row.counts, counts)
+
+    def test_maxpending(self):
+        maxpending = 2
+        for irow, row in self.xrmfile.iter_rowdata(0, 8, nworkers=4,
+                                                   maxpending=maxpending):
+            time.sleep(0.05)
+            self.assertTrue(len(self.started) <= irow + 1 + maxpending)
+            self.assertEqual(row.irow, irow)
+
+    def test_error(self):
+        self.bad_row = 3
+        rows = []
+        try:
+            for irow, row in self.xrmfile.iter_rowdata(0, 8, nworkers=3):
+                rows.append(irow)
+        except KeyError:
+            tback = traceback.extract_tb(sys.exc_info()[2])
+            self.assertEqual(tback[-1][2], 'counted')
+        else:
+            self.fail('no exception raised for bad row')
+        self.assertEqual(rows, [0, 1, 2])
+
+if __name__ == '__main__':  # pragma: no cover
+    for suite in (TestMapROIs, TestROIIndex, TestMapAreas, TestMapErange, TestMapStorage,
+                  TestMapRowReaders):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+""" Larch Tests:
+  lazy reading of Xspress3 HDF5 files
+"""
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+import h5py
+from numpy.testing import assert_array_equal, assert_allclose
+
+import larch
+larch.use_plugin_path('xrfmap')
+from xsp3_hdf5 import XSP3Counts, read_xsp3_hdf5, pixel_blocks
+
+NPIX, NDPIX, NDET, NCHAN = 12, 10, 3, 64
+
+class TestXSP3Counts(unittest.TestCase):
+    '''XSP3Counts slices match a zero-padded array'''
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp(prefix='larch_xsp3_')
+        self.fname = os.path.join(self.dirname, 'xsp3.0001')
+        np.random.seed(3)
+        data = np.random.poisson(20, size=(NDPIX, NDET, NCHAN))
+        self.data = data.astype('uint32')
+        with h5py.File(self.fname, 'w') as h5:
+            det = h5.create_group('entry/instrument/detector')
+            det.create_dataset('data', data=self.data, chunks=(2, NDET, NCHAN))
+            nda = det.create_group('NDAttributes')
+            for i in range(NDET):
+                nda.create_dataset('CHAN%iSCA0' % (i+1),
+                                   data=np.random.uniform(1.5e5, 1.7e5, NPIX))
+        self.ref = np.zeros((NPIX, NDET, NCHAN), dtype='uint32')
+        self.ref[:NDPIX] = self.data
+        self.h5 = h5py.File(self.fname, 'r')
+        self.counts = XSP3Counts(self.h5['entry/instrument/detector/data'],
+                                 NPIX)
+
+    def tearDown(self):
+        self.h5.close()
+        shutil.rmtree(self.dirname)
+
+    def check(self, key):
+        out = self.counts[key]
+        ref = self.ref[key]
+        self.assertEqual(out.shape, ref.shape, repr(key))
+        self.assertEqual(out.dtype, ref.dtype)
+        assert_array_equal(out, ref, err_msg=repr(key))
+
+    def test_shape(self):
+        self.assertEqual(self.counts.shape, (NPIX, NDET, NCHAN))
+        self.assertEqual(len(self.counts), NPIX)
+        assert_array_equal(np.asarray(self.counts), self.ref)
+
+    def test_slices(self):
+        for key in (slice(None), slice(2, 5), slice(8, 12), slice(10, 12),
+                    slice(None, None, 3), slice(None, None, -1),
+                    slice(11, 3, -2), slice(-3, None), slice(5, 5)):
+            self.check(key)
+            self.check((key, 1))
+            self.check((slice(None), key))
+            self.check((key, slice(None), slice(1, -1)))
+
+    def test_integers(self):
+        for key in (0, 3, 9, 10, 11, -1, -3, (2, 1), (-1, -1), (4, 0, 7),
+                    (slice(None), -1, 5), (3, slice(None, None, -1), -2)):
+            self.check(key)
+        self.assertRaises(IndexError, self.counts.__getitem__, NPIX)
+        self.assertRaises(IndexError, self.counts.__getitem__, (0, NDET))
+
+    def test_ellipsis(self):
+        for key in (Ellipsis, (Ellipsis, 3), (Ellipsis, slice(1, -1)),
+                    (2, Ellipsis), (slice(4, 11), Ellipsis, 5),
+                    (1, 2, 3, Ellipsis)):
+            self.check(key)
+
+    def test_index_arrays(self):
+        for key in ([0, 11, 5], np.array([9, 10, 2, 2]),
+                    (slice(None), [2, 0]), (Ellipsis, [63, 0, 1])):
+            self.check(key)
+
+    def test_read(self):
+        full = read_xsp3_hdf5(self.fname)
+        lazy = read_xsp3_hdf5(self.fname, lazy=True)
+        self.assertFalse(isinstance(lazy.counts, np.ndarray))
+        assert_array_equal(full.counts, self.ref)
+        assert_array_equal(lazy.counts[:], self.ref)
+        for attr in ('realTime', 'liveTime', 'outputCounts', 'inputCounts'):
+            assert_allclose(getattr(full, attr), getattr(lazy, attr))
+        lazy.close()
+
+    def test_pixel_blocks(self):
+        for nbytes in (1, 2000, 2**24):
+            blocks = pixel_blocks(self.counts, nbytes=nbytes)
+            self.assertEqual(blocks[0][0], 0)
+            self.assertEqual(blocks[-1][1], NPIX)
+            for (a0, a1), (b0, b1) in zip(blocks[:-1], blocks[1:]):
+                self.assertEqual(a1, b0)
+                self.assertEqual(a0 % 2, 0)
+
+if __name__ == '__main__':  # pragma: no cover
+    for suite in (TestXSP3Counts,):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=2).run(suite)